@@ -6,6 +6,8 @@ import torch
 import os
 import random
 
+from celeba_attributes import CelebAAttributes
+
 
 class CelebA(data.Dataset):
     """Dataset class for the CelebA dataset."""
@@ -19,8 +21,6 @@ class CelebA(data.Dataset):
         self.mode = mode
         self.train_dataset = []
         self.test_dataset = []
-        self.attr2idx = {}
-        self.idx2attr = {}
         self.preprocess()
 
         if mode == 'train':
@@ -30,38 +30,25 @@ class CelebA(data.Dataset):
 
     def preprocess(self):
         """Preprocess the CelebA attribute file."""
-        lines = [line.rstrip() for line in open(self.attr_path, 'r')]
-        all_attr_names = lines[1].split()
-        for i, attr_name in enumerate(all_attr_names):
-            self.attr2idx[attr_name] = i
-            self.idx2attr[i] = attr_name
+        self.attributes = CelebAAttributes(self.attr_path)
+        self.attr2idx = self.attributes.attr2idx
+        self.idx2attr = {i: attr_name for attr_name, i in self.attr2idx.items()}
+        self.labels = self.attributes.select(self.selected_attrs)
 
-        lines = lines[2:]
+        rows = list(range(len(self.attributes.filenames)))
         random.seed(1234)
-        random.shuffle(lines)
-        for i, line in enumerate(lines):
-            split = line.split()
-            filename = split[0]
-            values = split[1:]
-
-            label = []
-            for attr_name in self.selected_attrs:
-                idx = self.attr2idx[attr_name]
-                label.append(values[idx] == '1')
-
-            if (i+1) < 2000:
-                self.test_dataset.append([filename, label])
-            else:
-                self.train_dataset.append([filename, label])
+        random.shuffle(rows)
+        self.test_dataset = rows[:1999]
+        self.train_dataset = rows[1999:]
 
         print('Finished preprocessing the CelebA dataset...')
 
     def __getitem__(self, index):
         """Return one image and its corresponding attribute label."""
         dataset = self.train_dataset if self.mode == 'train' else self.test_dataset
-        filename, label = dataset[index]
-        image = Image.open(os.path.join(self.image_dir, filename))
-        return self.transform(image), torch.FloatTensor(label)
+        row = dataset[index]
+        image = Image.open(os.path.join(self.image_dir, self.attributes.filenames[row]))
+        return self.transform(image), self.labels[row]
 
     def __len__(self):
         """Return the number of images."""
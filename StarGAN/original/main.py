@@ -76,6 +76,7 @@ if __name__ == '__main__':
     parser.add_argument('--g_lr', type=float, default=0.0001, help='learning rate for G')
     parser.add_argument('--d_lr', type=float, default=0.0001, help='learning rate for D')
     parser.add_argument('--n_critic', type=int, default=5, help='number of D updates per each G update')
+    parser.add_argument('--gp_interval', type=int, default=1, help='compute the gradient penalty every n D updates, with its weight scaled by n')
     parser.add_argument('--beta1', type=float, default=0.5, help='beta1 for Adam optimizer')
     parser.add_argument('--beta2', type=float, default=0.999, help='beta2 for Adam optimizer')
     parser.add_argument('--resume_iters', type=int, default=None, help='resume training from this step')
@@ -84,6 +85,7 @@ if __name__ == '__main__':
 
     # Test configuration.
     parser.add_argument('--test_iters', type=int, default=200000, help='test model from this step')
+    parser.add_argument('--test_batch_size', type=int, default=64, help='max images per G pass at test time (0: all targets of a loader batch in one pass)')
 
     # Miscellaneous.
     parser.add_argument('--num_workers', type=int, default=1)
@@ -103,6 +105,7 @@ if __name__ == '__main__':
     parser.add_argument('--log_step', type=int, default=10)
     parser.add_argument('--sample_step', type=int, default=1000)
     parser.add_argument('--model_save_step', type=int, default=10000)
+    parser.add_argument('--keep_checkpoints', type=int, default=0, help='number of most recent checkpoints to keep, 0 keeps all')
     parser.add_argument('--lr_update_step', type=int, default=1000)
 
     config = parser.parse_args()
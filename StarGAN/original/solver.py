@@ -2,17 +2,25 @@ from model import Generator
 from model import Discriminator
 from torch.autograd import Variable
 from torchvision.utils import save_image
+from lazy_regularizer import LazyRegularizer
+from checkpoint_manager import CheckpointManager
+from metrics import Metrics
 import torch
 import torch.nn.functional as F
 import numpy as np
 import os
 import time
 import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Solver(object):
     """Solver for training and testing StarGAN."""
 
+    # Result grids waiting for the writer thread at test time.
+    max_pending_writes = 4
+
     def __init__(self, celeba_loader, rafd_loader, config):
         """Initialize configurations."""
 
@@ -40,6 +48,7 @@ class Solver(object):
         self.g_lr = config.g_lr
         self.d_lr = config.d_lr
         self.n_critic = config.n_critic
+        self.gp_interval = config.gp_interval
         self.beta1 = config.beta1
         self.beta2 = config.beta2
         self.resume_iters = config.resume_iters
@@ -47,17 +56,25 @@ class Solver(object):
 
         # Test configurations.
         self.test_iters = config.test_iters
+        self.test_batch_size = config.test_batch_size
 
         # Miscellaneous.
         self.use_tensorboard = config.use_tensorboard
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+        # Gradient penalty applied every gp_interval D steps, with its weight scaled to match.
+        self.gp = LazyRegularizer(self.lambda_gp, self.gp_interval, self.device)
+
         # Directories.
         self.log_dir = config.log_dir
         self.sample_dir = config.sample_dir
         self.model_save_dir = config.model_save_dir
         self.result_dir = config.result_dir
 
+        # Checkpoints are bundled and written in the background; old {step}-G/D.ckpt files still load.
+        self.checkpoints = CheckpointManager(self.model_save_dir, keep=config.keep_checkpoints, prefix='',
+                                             suffix='-checkpoint.ckpt', legacy='{step}-{name}.ckpt')
+
         # Step size.
         self.log_step = config.log_step
         self.sample_step = config.sample_step
@@ -95,13 +112,14 @@ class Solver(object):
         print(name)
         print("The number of parameters: {}".format(num_params))
 
+    def checkpoint_state(self):
+        """Objects whose state a checkpoint holds."""
+        return dict(G=self.G, D=self.D, g_optimizer=self.g_optimizer, d_optimizer=self.d_optimizer, gp=self.gp)
+
     def restore_model(self, resume_iters):
-        """Restore the trained generator and discriminator."""
+        """Restore the trained generator and discriminator, with the optimizers if saved."""
         print('Loading the trained models from step {}...'.format(resume_iters))
-        G_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(resume_iters))
-        D_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(resume_iters))
-        self.G.load_state_dict(torch.load(G_path, map_location=lambda storage, loc: storage))
-        self.D.load_state_dict(torch.load(D_path, map_location=lambda storage, loc: storage))
+        self.checkpoints.restore(resume_iters, **self.checkpoint_state())
 
     def build_tensorboard(self):
         """Build a tensorboard logger."""
@@ -139,6 +157,13 @@ class Solver(object):
         dydx_l2norm = torch.sqrt(torch.sum(dydx**2, dim=1))
         return torch.mean((dydx_l2norm-1)**2)
 
+    def interpolation_penalty(self, x_real, x_fake):
+        """Compute the gradient penalty at random interpolates of real and fake images."""
+        alpha = torch.rand(x_real.size(0), 1, 1, 1).to(self.device)
+        x_hat = (alpha * x_real.data + (1 - alpha) * x_fake.data).requires_grad_(True)
+        out_src, _ = self.D(x_hat)
+        return self.gradient_penalty(out_src, x_hat)
+
     def label2onehot(self, labels, dim):
         """Convert label indices to one-hot vectors."""
         batch_size = labels.size(0)
@@ -148,29 +173,43 @@ class Solver(object):
 
     def create_labels(self, c_org, c_dim=5, dataset='CelebA', selected_attrs=None):
         """Generate target domain labels for debugging and testing."""
-        # Get hair color indices.
-        if dataset == 'CelebA':
-            hair_color_indices = []
-            for i, attr_name in enumerate(selected_attrs):
-                if attr_name in ['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Gray_Hair']:
-                    hair_color_indices.append(i)
-
-        c_trg_list = []
-        for i in range(c_dim):
-            if dataset == 'CelebA':
-                c_trg = c_org.clone()
-                if i in hair_color_indices:  # Set one hair color to 1 and the rest to 0.
-                    c_trg[:, i] = 1
-                    for j in hair_color_indices:
-                        if j != i:
-                            c_trg[:, j] = 0
-                else:
-                    c_trg[:, i] = (c_trg[:, i] == 0)  # Reverse attribute value.
-            elif dataset == 'RaFD':
-                c_trg = self.label2onehot(torch.ones(c_org.size(0))*i, c_dim)
-
-            c_trg_list.append(c_trg.to(self.device))
-        return c_trg_list
+        return list(self.create_label_batch(c_org, c_dim, dataset, selected_attrs).unbind(0))
+
+    def create_label_batch(self, c_org, c_dim=5, dataset='CelebA', selected_attrs=None):
+        """Generate all c_dim target domain labels at once as a (c_dim, batch, c_dim) tensor."""
+        c_org = c_org.float().to(self.device)
+        eye = torch.eye(c_dim, device=self.device)
+        if dataset == 'RaFD':
+            return eye.unsqueeze(1).expand(c_dim, c_org.size(0), c_dim).contiguous()
+
+        # Target i sets hair color i (clearing the other hair colors) or flips attribute i.
+        hair = torch.zeros(c_dim, device=self.device)
+        for i, attr_name in enumerate(selected_attrs):
+            if attr_name in ['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Gray_Hair']:
+                hair[i] = 1
+        is_hair = hair.view(c_dim, 1)
+        keep = 1 - is_hair * hair.view(1, c_dim)    # (target, column)
+        flip = eye * (1 - is_hair)
+        set_ = eye * is_hair
+        c_org = c_org.unsqueeze(0)                  # (1, batch, column)
+        return c_org * keep.unsqueeze(1) + set_.unsqueeze(1) + flip.unsqueeze(1) * (1 - 2 * c_org)
+
+    def translate_batch(self, x_real, c_trg):
+        """Translate x_real into every target label of c_trg (targets, batch, c) with batched G passes.
+
+        The inputs are expanded across all targets and sent through G in chunks of at most
+        test_batch_size images (0 means all at once). Returns the image grid with the input
+        followed by each translation along the width, as in the per-target loop.
+        """
+        n_trg, batch_size = c_trg.size(0), x_real.size(0)
+        x_all = x_real.unsqueeze(0).expand(n_trg, *x_real.shape).reshape(n_trg * batch_size, *x_real.shape[1:])
+        c_all = c_trg.reshape(n_trg * batch_size, -1)
+
+        chunk = self.test_batch_size or x_all.size(0)
+        x_fake = torch.cat([self.G(x, c) for x, c in zip(x_all.split(chunk), c_all.split(chunk))])
+
+        x_concat = torch.cat([x_real.unsqueeze(0), x_fake.view(n_trg, *x_real.shape)])
+        return x_concat.permute(1, 2, 3, 0, 4).reshape(batch_size, x_real.size(1), x_real.size(2), -1)
 
     def classification_loss(self, logit, target, dataset='CelebA'):
         """Compute binary or softmax cross entropy loss."""
@@ -202,6 +241,12 @@ class Solver(object):
         if self.resume_iters:
             start_iters = self.resume_iters
             self.restore_model(self.resume_iters)
+            # Continue the decay from the learning rates saved with the optimizers.
+            g_lr = self.g_optimizer.param_groups[0]['lr']
+            d_lr = self.d_optimizer.param_groups[0]['lr']
+
+        # Running means of the losses, kept on the device between log steps.
+        metrics = Metrics()
 
         # Start training.
         print('Start training...')
@@ -250,24 +295,19 @@ class Solver(object):
             out_src, out_cls = self.D(x_fake.detach())
             d_loss_fake = torch.mean(out_src)
 
-            # Compute loss for gradient penalty.
-            alpha = torch.rand(x_real.size(0), 1, 1, 1).to(self.device)
-            x_hat = (alpha * x_real.data + (1 - alpha) * x_fake.data).requires_grad_(True)
-            out_src, _ = self.D(x_hat)
-            d_loss_gp = self.gradient_penalty(out_src, x_hat)
+            # Compute loss for gradient penalty, already weighted and only every gp_interval steps.
+            d_loss_gp = self.gp(lambda: self.interpolation_penalty(x_real, x_fake))
 
             # Backward and optimize.
-            d_loss = d_loss_real + d_loss_fake + self.lambda_cls * d_loss_cls + self.lambda_gp * d_loss_gp
+            d_loss = d_loss_real + d_loss_fake + self.lambda_cls * d_loss_cls + d_loss_gp
             self.reset_grad()
             d_loss.backward()
             self.d_optimizer.step()
 
-            # Logging.
-            loss = {}
-            loss['D/loss_real'] = d_loss_real.item()
-            loss['D/loss_fake'] = d_loss_fake.item()
-            loss['D/loss_cls'] = d_loss_cls.item()
-            loss['D/loss_gp'] = d_loss_gp.item()
+            # Logging (summed on the device, read back at log steps).
+            metrics.update(**{'D/loss_real': d_loss_real, 'D/loss_fake': d_loss_fake, 'D/loss_cls': d_loss_cls})
+            if torch.is_tensor(d_loss_gp):
+                metrics.update(**{'D/loss_gp': self.gp.value})
             
             # =================================================================================== #
             #                               3. Train the generator                                #
@@ -291,9 +331,7 @@ class Solver(object):
                 self.g_optimizer.step()
 
                 # Logging.
-                loss['G/loss_fake'] = g_loss_fake.item()
-                loss['G/loss_rec'] = g_loss_rec.item()
-                loss['G/loss_cls'] = g_loss_cls.item()
+                metrics.update(**{'G/loss_fake': g_loss_fake, 'G/loss_rec': g_loss_rec, 'G/loss_cls': g_loss_cls})
 
             # =================================================================================== #
             #                                 4. Miscellaneous                                    #
@@ -301,6 +339,7 @@ class Solver(object):
 
             # Print out training information.
             if (i+1) % self.log_step == 0:
+                loss = metrics.log(i+1)
                 et = time.time() - start_time
                 et = str(datetime.timedelta(seconds=et))[:-7]
                 log = "Elapsed [{}], Iteration [{}/{}]".format(et, i+1, self.num_iters)
@@ -325,11 +364,10 @@ class Solver(object):
 
             # Save model checkpoints.
             if (i+1) % self.model_save_step == 0:
-                G_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(i+1))
-                D_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(i+1))
-                torch.save(self.G.state_dict(), G_path)
-                torch.save(self.D.state_dict(), D_path)
-                print('Saved model checkpoints into {}...'.format(self.model_save_dir))
+                self.checkpoints.save(i+1, **self.checkpoint_state())
+                print('Saving model checkpoints into {}...'.format(self.model_save_dir))
+                if self.gp_interval > 1:
+                    print(self.gp.report())
 
             # Decay learning rates.
             if (i+1) % self.lr_update_step == 0 and (i+1) > (self.num_iters - self.num_iters_decay):
@@ -338,6 +376,9 @@ class Solver(object):
                 self.update_lr(g_lr, d_lr)
                 print ('Decayed learning rates, g_lr: {}, d_lr: {}.'.format(g_lr, d_lr))
 
+        # Let the last checkpoint finish writing.
+        self.checkpoints.wait()
+
     def train_multi(self):
         """Train StarGAN with multiple datasets."""        
         # Data iterators.
@@ -363,12 +404,19 @@ class Solver(object):
         if self.resume_iters:
             start_iters = self.resume_iters
             self.restore_model(self.resume_iters)
+            # Continue the decay from the learning rates saved with the optimizers.
+            g_lr = self.g_optimizer.param_groups[0]['lr']
+            d_lr = self.d_optimizer.param_groups[0]['lr']
+
+        # Running means of the losses per dataset, kept on the device between log steps.
+        metrics_per_dataset = {'CelebA': Metrics(), 'RaFD': Metrics()}
 
         # Start training.
         print('Start training...')
         start_time = time.time()
         for i in range(start_iters, self.num_iters):
             for dataset in ['CelebA', 'RaFD']:
+                metrics = metrics_per_dataset[dataset]
 
                 # =================================================================================== #
                 #                             1. Preprocess input data                                #
@@ -427,24 +475,19 @@ class Solver(object):
                 out_src, _ = self.D(x_fake.detach())
                 d_loss_fake = torch.mean(out_src)
 
-                # Compute loss for gradient penalty.
-                alpha = torch.rand(x_real.size(0), 1, 1, 1).to(self.device)
-                x_hat = (alpha * x_real.data + (1 - alpha) * x_fake.data).requires_grad_(True)
-                out_src, _ = self.D(x_hat)
-                d_loss_gp = self.gradient_penalty(out_src, x_hat)
+                # Compute loss for gradient penalty, already weighted and only every gp_interval steps.
+                d_loss_gp = self.gp(lambda: self.interpolation_penalty(x_real, x_fake))
 
                 # Backward and optimize.
-                d_loss = d_loss_real + d_loss_fake + self.lambda_cls * d_loss_cls + self.lambda_gp * d_loss_gp
+                d_loss = d_loss_real + d_loss_fake + self.lambda_cls * d_loss_cls + d_loss_gp
                 self.reset_grad()
                 d_loss.backward()
                 self.d_optimizer.step()
 
-                # Logging.
-                loss = {}
-                loss['D/loss_real'] = d_loss_real.item()
-                loss['D/loss_fake'] = d_loss_fake.item()
-                loss['D/loss_cls'] = d_loss_cls.item()
-                loss['D/loss_gp'] = d_loss_gp.item()
+                # Logging (summed on the device, read back at log steps).
+                metrics.update(**{'D/loss_real': d_loss_real, 'D/loss_fake': d_loss_fake, 'D/loss_cls': d_loss_cls})
+                if torch.is_tensor(d_loss_gp):
+                    metrics.update(**{'D/loss_gp': self.gp.value})
             
                 # =================================================================================== #
                 #                               3. Train the generator                                #
@@ -469,9 +512,7 @@ class Solver(object):
                     self.g_optimizer.step()
 
                     # Logging.
-                    loss['G/loss_fake'] = g_loss_fake.item()
-                    loss['G/loss_rec'] = g_loss_rec.item()
-                    loss['G/loss_cls'] = g_loss_cls.item()
+                    metrics.update(**{'G/loss_fake': g_loss_fake, 'G/loss_rec': g_loss_rec, 'G/loss_cls': g_loss_cls})
 
                 # =================================================================================== #
                 #                                 4. Miscellaneous                                    #
@@ -479,6 +520,7 @@ class Solver(object):
 
                 # Print out training info.
                 if (i+1) % self.log_step == 0:
+                    loss = metrics.log(i+1)
                     et = time.time() - start_time
                     et = str(datetime.timedelta(seconds=et))[:-7]
                     log = "Elapsed [{}], Iteration [{}/{}], Dataset [{}]".format(et, i+1, self.num_iters, dataset)
@@ -507,11 +549,10 @@ class Solver(object):
 
             # Save model checkpoints.
             if (i+1) % self.model_save_step == 0:
-                G_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(i+1))
-                D_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(i+1))
-                torch.save(self.G.state_dict(), G_path)
-                torch.save(self.D.state_dict(), D_path)
-                print('Saved model checkpoints into {}...'.format(self.model_save_dir))
+                self.checkpoints.save(i+1, **self.checkpoint_state())
+                print('Saving model checkpoints into {}...'.format(self.model_save_dir))
+                if self.gp_interval > 1:
+                    print(self.gp.report())
 
             # Decay learning rates.
             if (i+1) % self.lr_update_step == 0 and (i+1) > (self.num_iters - self.num_iters_decay):
@@ -520,6 +561,9 @@ class Solver(object):
                 self.update_lr(g_lr, d_lr)
                 print ('Decayed learning rates, g_lr: {}, d_lr: {}.'.format(g_lr, d_lr))
 
+        # Let the last checkpoint finish writing.
+        self.checkpoints.wait()
+
     def test(self):
         """Translate images using StarGAN trained on a single dataset."""
         # Load the trained generator.
@@ -531,52 +575,66 @@ class Solver(object):
         elif self.dataset == 'RaFD':
             data_loader = self.rafd_loader
         
-        with torch.no_grad():
+        pending = deque()
+        with torch.no_grad(), ThreadPoolExecutor(max_workers=1) as writer:
             for i, (x_real, c_org) in enumerate(data_loader):
 
                 # Prepare input images and target domain labels.
                 x_real = x_real.to(self.device)
-                c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
+                c_trg = self.create_label_batch(c_org, self.c_dim, self.dataset, self.selected_attrs)
 
-                # Translate images.
-                x_fake_list = [x_real]
-                for c_trg in c_trg_list:
-                    x_fake_list.append(self.G(x_real, c_trg))
+                # Translate images into all target domains at once.
+                x_concat = self.translate_batch(x_real, c_trg)
 
-                # Save the translated images.
-                x_concat = torch.cat(x_fake_list, dim=3)
+                # Save the translated images in the background.
                 result_path = os.path.join(self.result_dir, '{}-images.jpg'.format(i+1))
-                save_image(self.denorm(x_concat.data.cpu()), result_path, nrow=1, padding=0)
-                print('Saved real and fake images into {}...'.format(result_path))
+                self.submit_result(writer, pending, self.denorm(x_concat.cpu()), result_path)
+
+            self.wait_results(pending)
 
     def test_multi(self):
         """Translate images using StarGAN trained on multiple datasets."""
         # Load the trained generator.
         self.restore_model(self.test_iters)
         
-        with torch.no_grad():
+        pending = deque()
+        with torch.no_grad(), ThreadPoolExecutor(max_workers=1) as writer:
             for i, (x_real, c_org) in enumerate(self.celeba_loader):
 
                 # Prepare input images and target domain labels.
                 x_real = x_real.to(self.device)
-                c_celeba_list = self.create_labels(c_org, self.c_dim, 'CelebA', self.selected_attrs)
-                c_rafd_list = self.create_labels(c_org, self.c2_dim, 'RaFD')
-                zero_celeba = torch.zeros(x_real.size(0), self.c_dim).to(self.device)            # Zero vector for CelebA.
-                zero_rafd = torch.zeros(x_real.size(0), self.c2_dim).to(self.device)             # Zero vector for RaFD.
-                mask_celeba = self.label2onehot(torch.zeros(x_real.size(0)), 2).to(self.device)  # Mask vector: [1, 0].
-                mask_rafd = self.label2onehot(torch.ones(x_real.size(0)), 2).to(self.device)     # Mask vector: [0, 1].
-
-                # Translate images.
-                x_fake_list = [x_real]
-                for c_celeba in c_celeba_list:
-                    c_trg = torch.cat([c_celeba, zero_rafd, mask_celeba], dim=1)
-                    x_fake_list.append(self.G(x_real, c_trg))
-                for c_rafd in c_rafd_list:
-                    c_trg = torch.cat([zero_celeba, c_rafd, mask_rafd], dim=1)
-                    x_fake_list.append(self.G(x_real, c_trg))
-
-                # Save the translated images.
-                x_concat = torch.cat(x_fake_list, dim=3)
+                c_celeba = self.create_label_batch(c_org, self.c_dim, 'CelebA', self.selected_attrs)
+                c_rafd = self.create_label_batch(c_org, self.c2_dim, 'RaFD')
+                n_celeba, n_rafd, batch_size = c_celeba.size(0), c_rafd.size(0), x_real.size(0)
+                zero_celeba = torch.zeros(n_rafd, batch_size, self.c_dim, device=self.device)      # Zero vector for CelebA.
+                zero_rafd = torch.zeros(n_celeba, batch_size, self.c2_dim, device=self.device)     # Zero vector for RaFD.
+                mask_celeba = torch.tensor([1., 0.], device=self.device).expand(n_celeba, batch_size, 2)  # Mask vector: [1, 0].
+                mask_rafd = torch.tensor([0., 1.], device=self.device).expand(n_rafd, batch_size, 2)      # Mask vector: [0, 1].
+
+                # Translate images into all CelebA and RaFD target domains at once.
+                c_trg = torch.cat([torch.cat([c_celeba, zero_rafd, mask_celeba], dim=2),
+                                   torch.cat([zero_celeba, c_rafd, mask_rafd], dim=2)])
+                x_concat = self.translate_batch(x_real, c_trg)
+
+                # Save the translated images in the background.
                 result_path = os.path.join(self.result_dir, '{}-images.jpg'.format(i+1))
-                save_image(self.denorm(x_concat.data.cpu()), result_path, nrow=1, padding=0)
-                print('Saved real and fake images into {}...'.format(result_path))
\ No newline at end of file
+                self.submit_result(writer, pending, self.denorm(x_concat.cpu()), result_path)
+
+            self.wait_results(pending)
+
+    def submit_result(self, writer, pending, x_concat, result_path):
+        """Queue a result grid on the writer, first waiting for the oldest one if too many are queued."""
+        if len(pending) >= self.max_pending_writes:
+            # result() re-raises any error from save_image.
+            pending.popleft().result()
+        pending.append(writer.submit(self.save_result, x_concat, result_path))
+
+    def wait_results(self, pending):
+        """Wait for the queued result grids to be written."""
+        while pending:
+            pending.popleft().result()
+
+    def save_result(self, x_concat, result_path):
+        """Write a grid of real and translated images (called from the writer thread)."""
+        save_image(x_concat, result_path, nrow=1, padding=0)
+        print('Saved real and fake images into {}...'.format(result_path))
\ No newline at end of file
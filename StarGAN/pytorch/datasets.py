@@ -8,6 +8,8 @@ from torch.utils.data import Dataset
 from PIL import Image
 import torchvision.transforms as transforms
 
+from celeba_attributes import CelebAAttributes
+
 
 class CelebADataset(Dataset):
     def __init__(self, root, transforms_=None, mode='train', attributes=['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Male', 'Young']):
@@ -21,26 +23,16 @@ class CelebADataset(Dataset):
 
     def get_annotations(self):
         """Extracts annotations for CelebA"""
-        annotations = {}
-        lines = [line.rstrip() for line in open(self.label_path, 'r')]
-        self.label_names = lines[1].split()
-
-        for _, line in enumerate(lines[2:]):
-            filename, *values = line.split()
-            labels = []
-            for attr in self.selected_attrs:
-                idx = self.label_names.index(attr)
-                labels.append(1 * (values[idx] == '1'))
-            annotations[filename] = labels
+        attributes = CelebAAttributes(self.label_path)
+        self.label_names = attributes.attr_names
+        self.rows = [attributes.file2row[os.path.basename(filepath)] for filepath in self.files]
 
-        return annotations
+        return attributes.select(self.selected_attrs)
 
     def __getitem__(self, index):
-        filepath = self.files[index % len(self.files)]
-        filename = filepath.split('\\')[-1]
-        img = self.transform(Image.open(filepath))
-        label = self.annotations[filename]
-        label = torch.FloatTensor(np.array(label))
+        index = index % len(self.files)
+        img = self.transform(Image.open(self.files[index]))
+        label = self.annotations[self.rows[index]]
 
         return img, label
 
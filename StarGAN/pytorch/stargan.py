@@ -32,6 +32,11 @@ from datasets import *
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from latent_sampler import LatentSampler
+from precision import Precision
+from lazy_regularizer import LazyRegularizer
+from checkpoint_manager import CheckpointManager
+from metrics import Metrics
 
 os.makedirs('images', exist_ok=True)
 os.makedirs('saved_models', exist_ok=True)
@@ -52,9 +57,15 @@ parser.add_argument('--channels', type=int, default=3, help='number of image cha
 parser.add_argument('--sample_interval', type=int, default=400,
                     help='interval between sampling of images from generators')
 parser.add_argument('--checkpoint_interval', type=int, default=-1, help='interval between model checkpoints')
+parser.add_argument('--log_interval', type=int, default=10, help='interval (in generator steps) between printing the running mean losses (each print waits for the device)')
+parser.add_argument('--metrics_csv', type=str, default=None, help='also append the logged losses to this CSV file')
+parser.add_argument('--tensorboard_dir', type=str, default=None, help='also write the logged losses as TensorBoard scalars (needs tensorboardX)')
+parser.add_argument('--keep_checkpoints', type=int, default=0, help='number of most recent checkpoints to keep, 0 keeps all')
 parser.add_argument('--residual_blocks', type=int, default=6, help='number of residual blocks in generator')
 parser.add_argument('--selected_attrs', '--list', nargs='+', help='selected attributes for the CelebA dataset',
                     default=['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Male', 'Young'])
+parser.add_argument('--gp_interval', type=int, default=1, help='compute the gradient penalty every n discriminator steps, with its weight scaled by n')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='precision of the forward passes (bf16/fp16 run under autocast)')
 parser.add_argument('--n_critic', type=int, default=5, help='number of training iterations for WGAN discriminator')
 opt = parser.parse_args()
 print(opt)
@@ -63,6 +74,8 @@ c_dim = len(opt.selected_attrs)
 img_shape = (opt.channels, opt.img_height, opt.img_width)
 
 cuda = True if torch.cuda.is_available() else False
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
+amp = Precision(opt.precision, device='cuda' if cuda else 'cpu')
 
 # Loss functions
 criterion_cycle = torch.nn.L1Loss()
@@ -77,6 +90,9 @@ lambda_cls = 1
 lambda_rec = 10
 lambda_gp = 10
 
+# Gradient penalty applied every opt.gp_interval discriminator steps
+gp = LazyRegularizer(lambda_gp, opt.gp_interval, device='cuda' if cuda else 'cpu')
+
 # Initialize generator and discriminator
 generator = GeneratorResNet(img_shape=img_shape, res_blocks=opt.residual_blocks, c_dim=c_dim)
 discriminator = Discriminator(img_shape=img_shape, c_dim=c_dim)
@@ -86,17 +102,22 @@ if cuda:
     discriminator = discriminator.cuda()
     criterion_cycle.cuda()
 
-if opt.epoch != 0:
-    # Load pretrained models
-    generator.load_state_dict(torch.load('saved_models/generator_%d.pth' % opt.epoch))
-    discriminator.load_state_dict(torch.load('saved_models/discriminator_%d.pth' % opt.epoch))
-else:
+if opt.epoch == 0:
     generator.apply(weights_init_normal)
     discriminator.apply(weights_init_normal)
 # Optimizers
 optimizer_G = torch.optim.Adam(generator.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
 optimizer_D = torch.optim.Adam(discriminator.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
 
+# Everything a checkpoint holds, including the sampler's RNG state and the penalty's phase
+state = dict(generator=generator, discriminator=discriminator, optimizer_G=optimizer_G,
+             optimizer_D=optimizer_D, sampler=sampler, amp=amp, gp=gp)
+
+checkpoints = CheckpointManager('saved_models', keep=opt.keep_checkpoints, legacy='{name}_{step}.pth')
+if opt.epoch != 0:
+    # Load pretrained models
+    checkpoints.restore(opt.epoch, **state)
+
 # Configure dataloaders
 train_transforms = [transforms.Resize(int(1.12 * opt.img_height), Image.BICUBIC),
                     transforms.RandomCrop(opt.img_height),
@@ -124,19 +145,22 @@ Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 
 def compute_gradient_penalty(D, real_samples, fake_samples):
     """Calculates the gradient penalty loss for WGAN GP"""
-    # Random weight term for interpolation between real and fake samples
-    alpha = Tensor(np.random.random((real_samples.size(0), 1, 1, 1)))
-    # Get random interpolation between real and fake samples
-    interpolates = (alpha * real_samples + ((1 - alpha) * fake_samples)).requires_grad_(True)
-    d_interpolates, _ = D(interpolates)
-    fake = Variable(Tensor(np.ones(d_interpolates.shape)), requires_grad=False)
-    # Get gradient w.r.t. interpolates
-    gradients = autograd.grad(outputs=d_interpolates, inputs=interpolates,
-                              grad_outputs=fake, create_graph=True, retain_graph=True,
-                              only_inputs=True)[0]
-    gradients = gradients.view(gradients.size(0), -1)
-    gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
-    return gradient_penalty
+    # Interpolation, D and the gradient norm run in float32 whatever --precision is
+    with amp.fp32():
+        real_samples, fake_samples = real_samples.float(), fake_samples.float()
+        # Random weight term for interpolation between real and fake samples
+        alpha = Tensor(np.random.random((real_samples.size(0), 1, 1, 1)))
+        # Get random interpolation between real and fake samples
+        interpolates = (alpha * real_samples + ((1 - alpha) * fake_samples)).requires_grad_(True)
+        d_interpolates, _ = D(interpolates)
+        fake = Variable(Tensor(np.ones(d_interpolates.shape)), requires_grad=False)
+        # Get gradient w.r.t. interpolates
+        gradients = autograd.grad(outputs=d_interpolates, inputs=interpolates,
+                                  grad_outputs=fake, create_graph=True, retain_graph=True,
+                                  only_inputs=True)[0]
+        gradients = gradients.view(gradients.size(0), -1)
+        gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
+        return gradient_penalty
 
 
 label_changes = [
@@ -179,8 +203,11 @@ def sample_images(batches_done):
 #  Training
 # ----------
 
+metrics = Metrics("\r[Epoch {epoch}/{n_epochs}] [Batch {batch}/{n_batches}] [D adv: {D_adv:f}, aux: {D_cls:f}] "
+                  "[G loss: {G:f}, adv: {G_adv:f}, aux: {G_cls:f}, cycle: {G_rec:f}] ETA: {eta}",
+                  csv_path=opt.metrics_csv, log_dir=opt.tensorboard_dir)
+
 saved_samples = []
-start_time = time.time()
 for epoch in range(opt.epoch, opt.n_epochs):
     for i, (imgs, labels) in enumerate(dataloader):
 
@@ -189,9 +216,10 @@ for epoch in range(opt.epoch, opt.n_epochs):
         labels = Variable(labels.type(Tensor))
 
         # Sample labels as generator inputs
-        sampled_c = Variable(Tensor(np.random.randint(0, 2, (imgs.size(0), c_dim))))
+        sampled_c = sampler.bernoulli((imgs.size(0), c_dim), key='c')
         # Generate fake batch of images
-        fake_imgs = generator(imgs, sampled_c)
+        with amp.autocast():
+            fake_imgs = generator(imgs, sampled_c)
 
         # ---------------------
         #  Train Discriminator
@@ -199,21 +227,23 @@ for epoch in range(opt.epoch, opt.n_epochs):
 
         optimizer_D.zero_grad()
 
-        # Real images
-        real_validity, pred_cls = discriminator(imgs)
-        # Fake images
-        fake_validity, _ = discriminator(fake_imgs.detach())
-        # Gradient penalty
-        gradient_penalty = compute_gradient_penalty(discriminator, imgs.data, fake_imgs.data)
-        # Adversarial loss
-        loss_D_adv = - torch.mean(real_validity) + torch.mean(fake_validity) + lambda_gp * gradient_penalty
-        # Classification loss
-        loss_D_cls = criterion_cls(pred_cls, labels)
-        # Total loss
-        loss_D = loss_D_adv + lambda_cls * loss_D_cls
-
-        loss_D.backward()
-        optimizer_D.step()
+        with amp.autocast():
+            # Real images
+            real_validity, pred_cls = discriminator(imgs)
+            # Fake images
+            fake_validity, _ = discriminator(fake_imgs.detach())
+            # Adversarial loss with the (lazily applied) gradient penalty
+            loss_D_adv = - torch.mean(real_validity) + torch.mean(fake_validity) + \
+                         gp(lambda: compute_gradient_penalty(discriminator, imgs.data, fake_imgs.data))
+            # Classification loss
+            loss_D_cls = criterion_cls(pred_cls, labels)
+            # Total loss
+            loss_D = loss_D_adv + lambda_cls * loss_D_cls
+
+        amp.backward(loss_D)
+        amp.step(optimizer_D)
+        metrics.update(D_adv=loss_D_adv, D_cls=loss_D_cls)
+        metrics.tick()
 
         optimizer_G.zero_grad()
 
@@ -224,48 +254,48 @@ for epoch in range(opt.epoch, opt.n_epochs):
             #  Train Generator
             # -----------------
 
-            # Translate and reconstruct image
-            gen_imgs = generator(imgs, sampled_c)
-            recov_imgs = generator(gen_imgs, labels)
-
-            # Discriminator evaluates translated image
-            fake_validity, pred_cls = discriminator(gen_imgs)
-            # Adversarial loss
-            loss_G_adv = -torch.mean(fake_validity)
-            # Classification loss
-            loss_G_cls = criterion_cls(pred_cls, sampled_c)
-            # Reconstruction loss
-            loss_G_rec = criterion_cycle(recov_imgs, imgs)
-            # Total loss
-            loss_G = loss_G_adv + lambda_cls * loss_G_cls + lambda_rec * loss_G_rec
-
-            loss_G.backward()
-            optimizer_G.step()
+            with amp.autocast():
+                # Translate and reconstruct image
+                gen_imgs = generator(imgs, sampled_c)
+                recov_imgs = generator(gen_imgs, labels)
+
+                # Discriminator evaluates translated image
+                fake_validity, pred_cls = discriminator(gen_imgs)
+                # Adversarial loss
+                loss_G_adv = -torch.mean(fake_validity)
+                # Classification loss
+                loss_G_cls = criterion_cls(pred_cls, sampled_c)
+                # Reconstruction loss
+                loss_G_rec = criterion_cycle(recov_imgs, imgs)
+                # Total loss
+                loss_G = loss_G_adv + lambda_cls * loss_G_cls + lambda_rec * loss_G_rec
+
+            amp.backward(loss_G)
+            amp.step(optimizer_G)
 
             # --------------
             #  Log Progress
             # --------------
 
-            # Determine approximate time left
+            metrics.update(G=loss_G, G_adv=loss_G_adv, G_cls=loss_G_cls, G_rec=loss_G_rec)
+
+            # Print log, with the approximate time left
             batches_done = epoch * len(dataloader) + i
-            batches_left = opt.n_epochs * len(dataloader) - batches_done
-            time_left = datetime.timedelta(seconds=batches_left * (time.time() - start_time) / (batches_done + 1))
-
-            # Print log
-            sys.stdout.write(
-                "\r[Epoch %d/%d] [Batch %d/%d] [D adv: %f, aux: %f] [G loss: %f, adv: %f, aux: %f, cycle: %f] ETA: %s" %
-                (epoch, opt.n_epochs,
-                 i, len(dataloader),
-                 loss_D_adv.item(), loss_D_cls.item(),
-                 loss_G.item(), loss_G_adv.item(),
-                 loss_G_cls.item(), loss_G_rec.item(),
-                 time_left))
+            if (i // opt.n_critic) % opt.log_interval == 0:
+                metrics.log(batches_done, remaining=opt.n_epochs * len(dataloader) - batches_done,
+                            epoch=epoch, n_epochs=opt.n_epochs, batch=i, n_batches=len(dataloader))
 
             # If at sample interval sample and save image
             if batches_done % opt.sample_interval == 0:
                 sample_images(batches_done)
 
+        amp.update()
+
+    if opt.gp_interval > 1:
+        print(gp.report())
+
     if opt.checkpoint_interval != -1 and epoch % opt.checkpoint_interval == 0:
         # Save model checkpoints
-        torch.save(generator.state_dict(), 'saved_models/generator_%d.pth' % epoch)
-        torch.save(discriminator.state_dict(), 'saved_models/discriminator_%d.pth' % epoch)
+        checkpoints.save(epoch, **state)
+
+checkpoints.close()
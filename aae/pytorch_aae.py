@@ -15,6 +15,8 @@ from torch.autograd import Variable
 import torchvision.transforms as transforms
 from torchvision.utils import save_image
 import itertools
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 # Defining the global variables
 n_epochs = 200
@@ -31,6 +33,8 @@ os.makedirs('aae/images', exist_ok=True)
 
 img_shape = (channels, img_size, img_size)
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 FloatTensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 LongTensor = torch.cuda.LongTensor if cuda else torch.LongTensor
@@ -38,7 +42,7 @@ LongTensor = torch.cuda.LongTensor if cuda else torch.LongTensor
 
 def reparameterization(mu, logvar):
     std = torch.exp(logvar / 2)
-    sampled_z = Variable(FloatTensor(np.random.normal(0, 1, (mu.size(0), latent_dim))))
+    sampled_z = sampler.normal((mu.size(0), latent_dim))
     z = sampled_z * std + mu
     return z
 
@@ -143,7 +147,7 @@ Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 def sample_image(n_row, batches_done):
     """Saves a grid of generated digits"""
     # Sample noise
-    z = Variable(Tensor(np.random.normal(0, 1, (n_row ** 2, latent_dim))))
+    z = sampler.normal((n_row ** 2, latent_dim))
     gen_imgs = decoder(z)
     save_image(gen_imgs.data, 'aae/images/%d.png' % batches_done, nrow=n_row, normalize=True)
 
@@ -156,8 +160,8 @@ for epoch in range(n_epochs):
     for i, (imgs, _) in enumerate(dataloader):
 
         # Adversarial ground truths
-        valid = Variable(Tensor(imgs.shape[0], 1).fill_(1.0), requires_grad=False)
-        fake = Variable(Tensor(imgs.shape[0], 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((imgs.shape[0], 1))
+        fake = targets.zeros((imgs.shape[0], 1))
 
         # Configure input
         real_imgs = Variable(imgs.type(Tensor))
@@ -185,7 +189,7 @@ for epoch in range(n_epochs):
         optimizer_D.zero_grad()
 
         # Sample noise as discriminator ground truth
-        z = Variable(Tensor(np.random.normal(0, 1, (imgs.shape[0], latent_dim))))
+        z = sampler.normal((imgs.shape[0], latent_dim), key='z')
 
         # Measure discriminator's ability to classify real from generated samples
         real_loss = adversarial_loss(discriminator(z), valid)
@@ -13,6 +13,8 @@ from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 os.makedirs('images', exist_ok=True)
 
@@ -32,6 +34,8 @@ opt = parser.parse_args()
 print(opt)
 
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 
 
 def weights_init_normal(m):
@@ -152,7 +156,7 @@ LongTensor = torch.cuda.LongTensor if cuda else torch.LongTensor
 def sample_image(n_row, batches_done):
     """Saves a grid of generated digits ranging from 0 to n_classes"""
     # Sample noise
-    z = Variable(FloatTensor(np.random.normal(0, 1, (n_row ** 2, opt.latent_dim))))
+    z = sampler.normal((n_row ** 2, opt.latent_dim))
     # Get labels ranging from 0 to n_classes for n rows
     labels = np.array([num for _ in range(n_row) for num in range(n_row)])
     labels = Variable(LongTensor(labels))
@@ -170,8 +174,8 @@ for epoch in range(opt.n_epochs):
         batch_size = imgs.shape[0]
 
         # Adversarial ground truths
-        valid = Variable(FloatTensor(batch_size, 1).fill_(1.0), requires_grad=False)
-        fake = Variable(FloatTensor(batch_size, 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((batch_size, 1))
+        fake = targets.zeros((batch_size, 1))
 
         # Configure input
         real_imgs = Variable(imgs.type(FloatTensor))
@@ -184,8 +188,8 @@ for epoch in range(opt.n_epochs):
         optimizer_G.zero_grad()
 
         # Sample noise and labels as generator input
-        z = Variable(FloatTensor(np.random.normal(0, 1, (batch_size, opt.latent_dim))))
-        gen_labels = Variable(LongTensor(np.random.randint(0, opt.n_classes, batch_size)))
+        z = sampler.normal((batch_size, opt.latent_dim), key='z')
+        gen_labels = sampler.categorical(batch_size, opt.n_classes, key='labels')
 
         # Generate a batch of images
         gen_imgs = generator(z, gen_labels)
@@ -20,12 +20,18 @@ from datasets import *
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from latent_sampler import LatentSampler
+from grad_accumulation import GradientAccumulator
+from precision import Precision
+from checkpoint_manager import CheckpointManager
+from metrics import Metrics
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--epoch', type=int, default=0, help='epoch to start training from')
 parser.add_argument('--n_epochs', type=int, default=200, help='number of epochs of training')
 parser.add_argument('--dataset_name', type=str, default="edges2shoes", help='name of the dataset')
 parser.add_argument('--batch_size', type=int, default=32, help='size of the batches')
+parser.add_argument('--micro_batch_size', type=int, default=0, help='samples per forward/backward pass, 0 picks the largest that fits in memory (the Encoder uses BatchNorm, so splitting the batch changes training)')
 parser.add_argument('--lr', type=float, default=0.0002, help='adam: learning rate')
 parser.add_argument('--b1', type=float, default=0.5, help='adam: decay of first order momentum of gradient')
 parser.add_argument('--b2', type=float, default=0.999, help='adam: decay of first order momentum of gradient')
@@ -34,9 +40,14 @@ parser.add_argument('--img_height', type=int, default=128, help='size of image h
 parser.add_argument('--img_width', type=int, default=128, help='size of image width')
 parser.add_argument('--channels', type=int, default=3, help='number of image channels')
 parser.add_argument('--latent_dim', type=int, default=8, help='number of latent codes')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='precision of the forward passes (bf16/fp16 run under autocast)')
 parser.add_argument('--sample_interval', type=int, default=400,
                     help='interval between sampling of images from generators')
 parser.add_argument('--checkpoint_interval', type=int, default=-1, help='interval between model checkpoints')
+parser.add_argument('--log_interval', type=int, default=20, help='interval between printing the running mean losses (each print waits for the device)')
+parser.add_argument('--metrics_csv', type=str, default=None, help='also append the logged losses to this CSV file')
+parser.add_argument('--tensorboard_dir', type=str, default=None, help='also write the logged losses as TensorBoard scalars (needs tensorboardX)')
+parser.add_argument('--keep_checkpoints', type=int, default=0, help='number of most recent checkpoints to keep, 0 keeps all')
 opt = parser.parse_args()
 print(opt)
 
@@ -44,6 +55,8 @@ os.makedirs('images/%s' % opt.dataset_name, exist_ok=True)
 os.makedirs('saved_models/%s' % opt.dataset_name, exist_ok=True)
 
 cuda = True if torch.cuda.is_available() else False
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
+amp = Precision(opt.precision, device='cuda' if cuda else 'cpu')
 
 img_shape = (opt.channels, opt.img_height, opt.img_width)
 
@@ -63,13 +76,7 @@ if cuda:
     D_LR = D_LR.cuda()
     mae_loss.cuda()
 
-if opt.epoch != 0:
-    # Load pretrained models
-    generator.load_state_dict(torch.load('saved_models/%s/generator_%d.pth' % (opt.dataset_name, opt.epoch)))
-    encoder.load_state_dict(torch.load('saved_models/%s/encoder_%d.pth' % (opt.dataset_name, opt.epoch)))
-    D_VAE.load_state_dict(torch.load('saved_models/%s/D_VAE_%d.pth' % (opt.dataset_name, opt.epoch)))
-    D_LR.load_state_dict(torch.load('saved_models/%s/D_LR_%d.pth' % (opt.dataset_name, opt.epoch)))
-else:
+if opt.epoch == 0:
     # Initialize weights
     generator.apply(weights_init_normal)
     D_VAE.apply(weights_init_normal)
@@ -86,6 +93,17 @@ optimizer_G = torch.optim.Adam(generator.parameters(), lr=opt.lr, betas=(opt.b1,
 optimizer_D_VAE = torch.optim.Adam(D_VAE.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
 optimizer_D_LR = torch.optim.Adam(D_LR.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
 
+# Everything a checkpoint holds, including the latent sampler's RNG state
+state = dict(generator=generator, encoder=encoder, D_VAE=D_VAE, D_LR=D_LR,
+             optimizer_E=optimizer_E, optimizer_G=optimizer_G, optimizer_D_VAE=optimizer_D_VAE,
+             optimizer_D_LR=optimizer_D_LR, sampler=sampler, amp=amp)
+
+checkpoints = CheckpointManager('saved_models/%s' % opt.dataset_name, keep=opt.keep_checkpoints,
+                                legacy='{name}_{step}.pth')
+if opt.epoch != 0:
+    # Load pretrained models
+    checkpoints.restore(opt.epoch, **state)
+
 Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
 
 # Dataset loader
@@ -122,34 +140,17 @@ def sample_images(batches_done):
 
 def reparameterization(mu, logvar):
     std = torch.exp(logvar / 2)
-    sampled_z = Variable(Tensor(np.random.normal(0, 1, (mu.size(0), opt.latent_dim))))
+    sampled_z = sampler.normal((mu.size(0), opt.latent_dim))
     z = sampled_z * std + mu
     return z
 
 
-# ----------
-#  Training
-# ----------
-
-# Adversarial loss
-valid = 1
-fake = 0
+accum = GradientAccumulator(opt.micro_batch_size, precision=amp)
 
-prev_time = time.time()
-for epoch in range(opt.epoch, opt.n_epochs):
-    for i, batch in enumerate(dataloader):
-
-        # Set model input
-        real_A = Variable(batch['A'].type(Tensor))
-        real_B = Variable(batch['B'].type(Tensor))
-
-        # -------------------------------
-        #  Train Generator and Encoder
-        # -------------------------------
-
-        optimizer_E.zero_grad()
-        optimizer_G.zero_grad()
 
+def generator_step(real_A, real_B):
+    """Generator/encoder forward and backward passes over one micro-batch"""
+    with amp.autocast():
         # ----------
         # cVAE-GAN
         # ----------
@@ -161,8 +162,12 @@ for epoch in range(opt.epoch, opt.n_epochs):
 
         # Pixelwise loss of translated image by VAE
         loss_pixel = mae_loss(fake_B, real_B)
-        # Kullback-Leibler divergence of encoded B
-        loss_kl = torch.sum(0.5 * (mu ** 2 + torch.exp(logvar) - logvar - 1))
+        # Kullback-Leibler divergence of encoded B. It is a sum over the micro-batch, not a
+        # mean, so dividing by accum.scale cancels the share accum.backward() weights it by
+        # and the micro-batch sums add up to the full batch's
+        with amp.fp32():
+            mu_, logvar_ = mu.float(), logvar.float()
+            loss_kl = torch.sum(0.5 * (mu_ ** 2 + torch.exp(logvar_) - logvar_ - 1)) / accum.scale
         # Adversarial loss
         loss_VAE_GAN = D_VAE.compute_loss(fake_B, valid)
 
@@ -171,7 +176,7 @@ for epoch in range(opt.epoch, opt.n_epochs):
         # ---------
 
         # Produce output using sampled z (cLR-GAN)
-        sampled_z = Variable(Tensor(np.random.normal(0, 1, (real_A.size(0), opt.latent_dim))))
+        sampled_z = sampler.normal((real_A.size(0), opt.latent_dim), key='z')
         _fake_B = generator(real_A, sampled_z)
         # cLR Loss: Adversarial loss
         loss_LR_GAN = D_LR.compute_loss(_fake_B, valid)
@@ -185,69 +190,103 @@ for epoch in range(opt.epoch, opt.n_epochs):
                   lambda_pixel * loss_pixel + \
                   lambda_kl * loss_kl
 
-        loss_GE.backward(retain_graph=True)
-        optimizer_E.step()
+    accum.backward(loss_GE, retain_graph=True)
 
-        # ---------------------
-        # Generator Only Loss
-        # ---------------------
+    # ---------------------
+    # Generator Only Loss
+    # ---------------------
 
-        # Latent L1 loss
+    with amp.autocast():
+        # Latent L1 loss, only the generator is updated with it
         _mu, _ = encoder(_fake_B)
         loss_latent = lambda_latent * mae_loss(_mu, sampled_z)
 
-        loss_latent.backward()
-        optimizer_G.step()
+    accum.backward(loss_latent, inputs=list(generator.parameters()))
+    return {'GE': loss_GE, 'pixel': loss_pixel, 'latent': loss_latent,
+            'fake_B': fake_B.detach(), '_fake_B': _fake_B.detach()}
+
+
+def discriminator_step(D, real_B, fake_B):
+    """Discriminator forward and backward passes over one micro-batch"""
+    with amp.autocast():
+        # Real and fake go through the discriminator scales together
+        loss_real, loss_fake = D.compute_losses(real_B, fake_B, valid, fake)
+        loss_D = loss_real + loss_fake
+
+    accum.backward(loss_D)
+    return {'D': loss_D}
+
+
+# ----------
+#  Training
+# ----------
+
+# Adversarial loss
+valid = 1
+fake = 0
+
+metrics = Metrics("\r[Epoch {epoch}/{n_epochs}] [Batch {batch}/{n_batches}] [D VAE_loss: {D_VAE:f}, LR_loss: {D_LR:f}] "
+                  "[G loss: {GE:f}, pixel: {pixel:f}, latent: {latent:f}] ETA: {eta}",
+                  csv_path=opt.metrics_csv, log_dir=opt.tensorboard_dir)
+
+for epoch in range(opt.epoch, opt.n_epochs):
+    for i, batch in enumerate(dataloader):
+
+        # Set model input
+        real_A = Variable(batch['A'].type(Tensor))
+        real_B = Variable(batch['B'].type(Tensor))
+
+        # -------------------------------
+        #  Train Generator and Encoder
+        # -------------------------------
+
+        optimizer_E.zero_grad()
+        optimizer_G.zero_grad()
+
+        outputs = accum.run(generator_step, real_A, real_B, optimizers=[optimizer_E, optimizer_G])
+        loss_GE, loss_pixel, loss_latent = outputs['GE'], outputs['pixel'], outputs['latent']
+        fake_B, _fake_B = outputs['fake_B'], outputs['_fake_B']
+
+        amp.step(optimizer_E)
+        amp.step(optimizer_G)
 
         # ----------------------------------
         #  Train Discriminator (cVAE-GAN)
         # ----------------------------------
 
         optimizer_D_VAE.zero_grad()
-
-        loss_D_VAE = D_VAE.compute_loss(real_B, valid) + \
-                     D_VAE.compute_loss(fake_B.detach(), fake)
-
-        loss_D_VAE.backward()
-        optimizer_D_VAE.step()
+        loss_D_VAE = accum.run(lambda real, fake_: discriminator_step(D_VAE, real, fake_),
+                               real_B, fake_B, optimizers=[optimizer_D_VAE])['D']
+        amp.step(optimizer_D_VAE)
 
         # ---------------------------------
         #  Train Discriminator (cLR-GAN)
         # ---------------------------------
 
         optimizer_D_LR.zero_grad()
-
-        loss_D_LR = D_VAE.compute_loss(real_B, valid) + \
-                    D_VAE.compute_loss(_fake_B.detach(), fake)
-
-        loss_D_LR.backward()
-        optimizer_D_LR.step()
+        loss_D_LR = accum.run(lambda real, fake_: discriminator_step(D_VAE, real, fake_),
+                              real_B, _fake_B, optimizers=[optimizer_D_LR])['D']
+        amp.step(optimizer_D_LR)
+        amp.update()
 
         # --------------
         #  Log Progress
         # --------------
 
-        # Determine approximate time left
+        metrics.update(D_VAE=loss_D_VAE, D_LR=loss_D_LR, GE=loss_GE, pixel=loss_pixel, latent=loss_latent)
+        metrics.tick()
+
+        # Print log, with the approximate time left
         batches_done = epoch * len(dataloader) + i
-        batches_left = opt.n_epochs * len(dataloader) - batches_done
-        time_left = datetime.timedelta(seconds=batches_left * (time.time() - prev_time))
-        prev_time = time.time()
-
-        # Print log
-        sys.stdout.write(
-            "\r[Epoch %d/%d] [Batch %d/%d] [D VAE_loss: %f, LR_loss: %f] [G loss: %f, pixel: %f, latent: %f] ETA: %s" %
-            (epoch, opt.n_epochs,
-             i, len(dataloader),
-             loss_D_VAE.item(), loss_D_LR.item(),
-             loss_GE.item(), loss_pixel.item(),
-             loss_latent.item(), time_left))
+        if batches_done % opt.log_interval == 0:
+            metrics.log(batches_done, remaining=opt.n_epochs * len(dataloader) - batches_done,
+                        epoch=epoch, n_epochs=opt.n_epochs, batch=i, n_batches=len(dataloader))
 
         if batches_done % opt.sample_interval == 0:
             sample_images(batches_done)
 
     if opt.checkpoint_interval != -1 and epoch % opt.checkpoint_interval == 0:
         # Save model checkpoints
-        torch.save(generator.state_dict(), 'saved_models/%s/generator_%d.pth' % (opt.dataset_name, epoch))
-        torch.save(encoder.state_dict(), 'saved_models/%s/encoder_%d.pth' % (opt.dataset_name, epoch))
-        torch.save(D_VAE.state_dict(), 'saved_models/%s/D_VAE_%d.pth' % (opt.dataset_name, epoch))
-        torch.save(D_LR.state_dict(), 'saved_models/%s/D_LR_%d.pth' % (opt.dataset_name, epoch))
+        checkpoints.save(epoch, **state)
+
+checkpoints.close()
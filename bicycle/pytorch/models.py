@@ -161,6 +161,20 @@ class MultiDiscriminator(nn.Module):
         loss = sum([torch.mean((out - gt) ** 2) for out in self.forward(x)])
         return loss
 
+    def compute_losses(self, real, fake, real_gt=1, fake_gt=0):
+        """compute_loss(real, real_gt) and compute_loss(fake, fake_gt) from one pass over both
+
+        The two batches are concatenated, so the input pyramid is pooled once and each
+        scale runs once. The scales normalize per sample (InstanceNorm), so the losses
+        are the same as from two separate calls.
+        """
+        n = real.size(0)
+        loss_real, loss_fake = 0, 0
+        for out in self.forward(torch.cat((real, fake))):
+            loss_real = loss_real + torch.mean((out[:n] - real_gt) ** 2)
+            loss_fake = loss_fake + torch.mean((out[n:] - fake_gt) ** 2)
+        return loss_real, loss_fake
+
     def forward(self, x):
         outputs = []
         for m in self.models:
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import torch
+
+
+class CelebAAttributes(object):
+    """All 40 CelebA attributes compiled into one int8 matrix, cached next to the attribute file
+
+    The cache is '<attr_path>.npz' with the attribute names, the image filenames and the
+    (N, 40) matrix of +1/-1, shared by both StarGAN trees. If it cannot be written (a
+    read-only dataset directory) the parsed matrix is used as is.
+    """
+
+    def __init__(self, attr_path):
+        cache_path = attr_path + '.npz'
+        cache = None
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(attr_path):
+            cache = np.load(cache_path)
+            if 'attr_names' not in cache.files:
+                # Written by an older version with other key names
+                cache = None
+
+        if cache is not None:
+            self.attr_names = list(cache['attr_names'])
+            self.filenames = list(cache['filenames'])
+            self.matrix = cache['matrix']
+        else:
+            self.parse(attr_path)
+            try:
+                np.savez(cache_path, attr_names=np.array(self.attr_names), filenames=np.array(self.filenames),
+                         matrix=self.matrix)
+            except OSError as e:
+                print("Could not cache the CelebA attributes at %s (%s)" % (cache_path, e))
+
+        self.attr2idx = {attr_name: i for i, attr_name in enumerate(self.attr_names)}
+        self.file2row = {filename: i for i, filename in enumerate(self.filenames)}
+
+    def parse(self, attr_path):
+        with open(attr_path, 'r') as f:
+            lines = f.read().split('\n')
+        self.attr_names = lines[1].split()
+        rows = [line.split() for line in lines[2:] if line.strip()]
+        self.filenames = [row[0] for row in rows]
+        self.matrix = np.array([row[1:] for row in rows]).astype(np.int8)
+
+    def select(self, selected_attrs):
+        """(N, len(selected_attrs)) FloatTensor of 0/1 labels, indexed by attribute file row"""
+        cols = [self.attr2idx[attr_name] for attr_name in selected_attrs]
+        return torch.from_numpy((self.matrix[:, cols] == 1).astype(np.float32))
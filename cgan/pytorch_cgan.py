@@ -8,6 +8,8 @@ from torchvision import datasets
 from torch.autograd import Variable
 import torchvision.transforms as transforms
 from torchvision.utils import save_image
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 # Defining the global variables
 n_epochs = 200
@@ -24,6 +26,8 @@ os.makedirs('cgan/images', exist_ok=True)
 
 img_shape = (channels, img_size, img_size)
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 FloatTensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 LongTensor = torch.cuda.LongTensor if cuda else torch.LongTensor
@@ -116,7 +120,7 @@ dataloader = torch.utils.data.DataLoader(
 def sample_image(n_row, batches_done):
     """Saves a grid of generated digits ranging from 0 to n_classes"""
     # Sample noise
-    z = Variable(FloatTensor(np.random.normal(0, 1, (n_row ** 2, latent_dim))))
+    z = sampler.normal((n_row ** 2, latent_dim))
     # Get labels ranging from 0 to n_classes for n rows
     labels = np.array([num for _ in range(n_row) for num in range(n_row)])
     labels = Variable(LongTensor(labels))
@@ -135,8 +139,8 @@ for epoch in range(n_epochs):
 
         batch_size = imgs.size(0)
         # adversarial ground truth
-        valid = Variable(Tensor(imgs.size(0), 1).fill_(1.0), requires_grad=False)
-        fake = Variable(Tensor(imgs.size(0), 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((imgs.size(0), 1))
+        fake = targets.zeros((imgs.size(0), 1))
 
         # configure input
         real_imgs = Variable(imgs.type(FloatTensor))
@@ -148,8 +152,8 @@ for epoch in range(n_epochs):
         optimizer_G.zero_grad()
 
         # sample noise as generator input
-        z = Variable(FloatTensor(np.random.normal(0, 1, (batch_size, latent_dim))))
-        gen_labels = Variable(LongTensor(np.random.randint(0, n_classes, batch_size)))
+        z = sampler.normal((batch_size, latent_dim), key='z')
+        gen_labels = sampler.categorical(batch_size, n_classes, key='labels')
 
         # generate a batch of images
         gen_imgs = generator(z, gen_labels)
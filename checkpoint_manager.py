@@ -0,0 +1,96 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def _to_cpu(obj):
+    """Copy of a (nested) state dict with every tensor copied to CPU memory"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager(object):
+    """Saves training state as one bundle file per step, written on a background thread
+
+    save() snapshots the state_dict() of every object passed (networks, optimizers,
+    LR schedulers, replay buffers, ...) to CPU memory and returns; a single writer
+    thread then serializes the bundle to a temporary file and renames it into place,
+    so a checkpoint on disk is always complete. save() only blocks when the previous
+    bundle is still being written, so at most two snapshots are held in host memory
+    however slow the storage. With keep > 0 only the newest keep bundles are kept.
+
+    restore() falls back to the per-network files older versions of the trainers
+    wrote, given their name pattern in legacy (e.g. '{name}_{step}.pth').
+    """
+
+    def __init__(self, directory, keep=0, prefix='checkpoint_', suffix='.pth', legacy=None):
+        self.directory = directory
+        self.keep = keep
+        self.prefix = prefix
+        self.suffix = suffix
+        self.legacy = legacy
+        self.pattern = re.compile(r'^%s(\d+)%s$' % (re.escape(prefix), re.escape(suffix)))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, step):
+        return os.path.join(self.directory, '%s%d%s' % (self.prefix, step, self.suffix))
+
+    def exists(self, step):
+        return os.path.exists(self.path(step))
+
+    def save(self, step, **objects):
+        bundle = {name: _to_cpu(obj.state_dict()) for name, obj in objects.items()}
+        bundle['step'] = step
+        # The previous write has to finish first; this also surfaces its errors
+        self.wait()
+        self.pending = self.executor.submit(self._write, self.path(step), bundle)
+
+    def _write(self, path, bundle):
+        tmp_path = path + '.tmp'
+        torch.save(bundle, tmp_path)
+        os.replace(tmp_path, path)
+        if self.keep > 0:
+            self._prune()
+
+    def _prune(self):
+        steps = sorted(int(m.group(1)) for m in map(self.pattern.match, os.listdir(self.directory)) if m)
+        for step in steps[:-self.keep]:
+            os.remove(self.path(step))
+
+    def wait(self):
+        """Blocks until the checkpoint being written (if any) is on disk"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def restore(self, step, **objects):
+        """Loads the state of each object saved at step, from the bundle or the legacy files"""
+        self.wait()
+        if self.exists(step):
+            bundle = torch.load(self.path(step), map_location='cpu')
+        else:
+            assert self.legacy is not None, 'No checkpoint at %s' % self.path(step)
+            bundle = {}
+            for name in objects:
+                path = os.path.join(self.directory, self.legacy.format(name=name, step=step))
+                if os.path.exists(path):
+                    bundle[name] = torch.load(path, map_location='cpu')
+
+        for name, obj in objects.items():
+            if name in bundle:
+                obj.load_state_dict(bundle[name])
+            else:
+                print("Checkpoint of step %d has no %s state, keeping it as initialized" % (step, name))
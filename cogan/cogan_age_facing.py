@@ -17,6 +17,8 @@ from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 os.makedirs('images', exist_ok=True)
 
@@ -37,6 +39,8 @@ print(opt)
 img_shape = (opt.channels, opt.img_size, opt.img_size)
 
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 
 
 def weights_init_normal(m):
@@ -174,8 +178,8 @@ for epoch in range(opt.n_epochs):
         batch_size = imgs1.shape[0]
 
         # Adversarial ground truths
-        valid = Variable(Tensor(batch_size, 1).fill_(1.0), requires_grad=False)
-        fake = Variable(Tensor(batch_size, 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((batch_size, 1))
+        fake = targets.zeros((batch_size, 1))
 
         # Configure input
         imgs1 = Variable(imgs1.type(Tensor))
@@ -188,7 +192,7 @@ for epoch in range(opt.n_epochs):
         optimizer_G.zero_grad()
 
         # Sample noise as generator input
-        z = Variable(Tensor(np.random.normal(0, 1, (batch_size, opt.latent_dim))))
+        z = sampler.normal((batch_size, opt.latent_dim), key='z')
 
         # Generate a batch of images
         gen_imgs1, gen_imgs2 = coupled_generators(z)
@@ -117,20 +117,27 @@ class ContextEncoder():
 
         return Model(img, validity)
 
-    def mask_randomly(self, imgs):
-        y1 = np.random.randint(0, self.img_rows - self.mask_height, imgs.shape[0])
+    def mask_randomly(self, imgs, xp=np):
+        """Zeroes a random mask_height x mask_width patch in every image of the batch
+
+        Both the masked batch and the missing patches are built with one fancy-indexing
+        gather/scatter each. `xp` may be any numpy-compatible array module (e.g. cupy)
+        so the masks can be made on the same device as the images.
+        """
+        n = imgs.shape[0]
+        y1 = xp.random.randint(0, self.img_rows - self.mask_height, n)
         y2 = y1 + self.mask_height
-        x1 = np.random.randint(0, self.img_rows - self.mask_width, imgs.shape[0])
+        x1 = xp.random.randint(0, self.img_cols - self.mask_width, n)
         x2 = x1 + self.mask_width
 
-        masked_imgs = np.empty_like(imgs)
-        missing_parts = np.empty((imgs.shape[0], self.mask_height, self.mask_width, self.channels))
-        for i, img in enumerate(imgs):
-            masked_img = img.copy()
-            _y1, _y2, _x1, _x2 = y1[i], y2[i], x1[i], x2[i]
-            missing_parts[i] = masked_img[_y1:_y2, _x1:_x2, :].copy()
-            masked_img[_y1:_y2, _x1:_x2, :] = 0
-            masked_imgs[i] = masked_img
+        # (n, 1, 1), (n, mask_height, 1) and (n, 1, mask_width) index grids of the patches
+        batch = xp.arange(n)[:, None, None]
+        rows = (y1[:, None] + xp.arange(self.mask_height))[:, :, None]
+        cols = (x1[:, None] + xp.arange(self.mask_width))[:, None, :]
+
+        missing_parts = imgs[batch, rows, cols]
+        masked_imgs = imgs.copy()
+        masked_imgs[batch, rows, cols] = 0
 
         return masked_imgs, missing_parts, (y1, y2, x1, x2)
 
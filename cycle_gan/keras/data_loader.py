@@ -1,40 +1,68 @@
-import scipy
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from PIL import Image
+
+from prefetcher import Prefetcher
+
 
 class DataLoader():
-    def __init__(self, dataset_name, img_res=(128, 128)):
+    def __init__(self, dataset_name, img_res=(128, 128), n_workers=4):
         self.dataset_name = dataset_name
         self.img_res = img_res
+        self.n_workers = n_workers
+        self.paths = {}
+
+    def get_paths(self, data_type):
+        # The split is globbed once and reused for every batch
+        if data_type not in self.paths:
+            self.paths[data_type] = sorted(glob('E:\\Datasets\\' + self.dataset_name + '\\' + data_type + '\\*'))
+        return self.paths[data_type]
+
+    def load_one(self, img_path, is_testing=False):
+        img = self.imresize(self.imread(img_path))
+        if not is_testing and np.random.random() > 0.5:
+            img = img[:, ::-1]
+        return img
 
     def load_data(self, domain, batch_size=1, is_testing=False):
         data_type = "train%s" % domain if not is_testing else "test%s" % domain
-        path = glob('E:\\Datasets\\' + self.dataset_name + '\\' + data_type + '\\*')
+        batch_images = np.random.choice(self.get_paths(data_type), size=batch_size)
 
-        batch_images = np.random.choice(path, size=batch_size)
+        return self.collate([self.load_one(img_path, is_testing) for img_path in batch_images])
 
-        imgs = []
-        for img_path in batch_images:
-            img = self.imread(img_path)
-            if not is_testing:
-                img = scipy.misc.imresize(img, self.img_res)
+    def stream(self, domain, batch_size=1, is_testing=False, prefetch=8):
+        """Endless iterator of image batches from one domain
 
-                if np.random.random() > 0.5:
-                    img = np.fliplr(img)
-            else:
-                img = scipy.misc.imresize(img, self.img_res)
-            imgs.append(img)
+        The split is reshuffled every epoch and images are decoded on n_workers threads
+        ahead of the training loop, with at most `prefetch` batches queued.
+        """
+        data_type = "train%s" % domain if not is_testing else "test%s" % domain
+        paths = self.get_paths(data_type)
+        if len(paths) < batch_size:
+            # Only full batches are drawn, so the stream would never yield
+            raise ValueError("%s has %d images, fewer than batch_size=%d" % (data_type, len(paths), batch_size))
+
+        def batches():
+            with ThreadPoolExecutor(self.n_workers) as pool:
+                while True:
+                    order = np.random.permutation(len(paths))
+                    for start in range(0, len(order) - batch_size + 1, batch_size):
+                        batch_images = [paths[i] for i in order[start:start + batch_size]]
+                        yield self.collate(list(pool.map(lambda p: self.load_one(p, is_testing), batch_images)))
 
-        imgs = np.array(imgs)/127.5 - 1.
+        return Prefetcher(batches(), prefetch)
 
-        return imgs
+    def collate(self, imgs):
+        return np.stack(imgs).astype(np.float32) / 127.5 - 1.
 
     def load_img(self, path):
-        img = self.imread(path)
-        img = scipy.misc.imresize(img, self.img_res)
-        img = img/127.5 - 1.
+        img = self.imresize(self.imread(path))
+        img = img.astype(np.float32) / 127.5 - 1.
         return img[np.newaxis, :, :, :]
 
-    def imread(self, path):
-        return scipy.misc.imread(path, mode='RGB').astype(np.float)
+    def imresize(self, img):
+        return np.asarray(img.resize((self.img_res[1], self.img_res[0]), Image.BILINEAR))
 
+    def imread(self, path):
+        return Image.open(path).convert('RGB')
@@ -151,14 +151,19 @@ class CycleGAN():
 
         start_time = datetime.datetime.now()
 
+        # Half batches are decoded on background threads while the models train;
+        # the generator step uses two of them
+        batches_A = self.data_loader.stream(domain="A", batch_size=half_batch)
+        batches_B = self.data_loader.stream(domain="B", batch_size=half_batch)
+
         for epoch in range(epochs):
 
             # ----------------------
             #  Train Discriminators
             # ----------------------
 
-            imgs_A = self.data_loader.load_data(domain="A", batch_size=half_batch)
-            imgs_B = self.data_loader.load_data(domain="B", batch_size=half_batch)
+            imgs_A = next(batches_A)
+            imgs_B = next(batches_B)
 
             # Translate images to opposite domain
             fake_B = self.g_AB.predict(imgs_A)
@@ -184,11 +189,11 @@ class CycleGAN():
             # ------------------
 
             # Sample a batch of images from both domains
-            imgs_A = self.data_loader.load_data(domain="A", batch_size=batch_size)
-            imgs_B = self.data_loader.load_data(domain="B", batch_size=batch_size)
+            imgs_A = np.concatenate([next(batches_A), next(batches_A)])
+            imgs_B = np.concatenate([next(batches_B), next(batches_B)])
 
             # The generators want the discriminators to label the translated images as real
-            valid = np.ones((batch_size,) + self.disc_patch)
+            valid = np.ones((imgs_A.shape[0],) + self.disc_patch)
 
             # Train the generators
             g_loss = self.combined.train_on_batch([imgs_A, imgs_B], [valid, valid, imgs_A, imgs_B, imgs_A, imgs_B])
@@ -20,6 +20,13 @@ from utils import *
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from weighted_losses import WeightedLosses
+from grad_accumulation import GradientAccumulator
+from precision import Precision
+from fused_discriminators import fused_discriminator_losses
+from checkpoint_manager import CheckpointManager
+from metrics import Metrics
 
 
 def sample_images(batches_done):
@@ -41,6 +48,7 @@ if __name__ == '__main__':
     parser.add_argument('--n_epochs', type=int, default=200, help='number of epochs of training')
     parser.add_argument('--dataset_name', type=str, default="sketch2face", help='name of the dataset')
     parser.add_argument('--batch_size', type=int, default=1, help='size of the batches')
+    parser.add_argument('--micro_batch_size', type=int, default=0, help='samples per forward/backward pass, 0 picks the largest that fits in memory')
     parser.add_argument('--lr', type=float, default=0.0002, help='adam: learning rate')
     parser.add_argument('--b1', type=float, default=0.5, help='adam: decay of first order momentum of gradient')
     parser.add_argument('--b2', type=float, default=0.999, help='adam: decay of first order momentum of gradient')
@@ -52,7 +60,14 @@ if __name__ == '__main__':
     parser.add_argument('--channels_B', type=int, default=3, help='number of image channels in domain B')
     parser.add_argument('--sample_interval', type=int, default=100, help='interval between sampling images from generators')
     parser.add_argument('--checkpoint_interval', type=int, default=10, help='interval between saving model checkpoints')
+    parser.add_argument('--log_interval', type=int, default=20, help='interval between printing the running mean losses (each print waits for the device)')
+    parser.add_argument('--metrics_csv', type=str, default=None, help='also append the logged losses to this CSV file')
+    parser.add_argument('--tensorboard_dir', type=str, default=None, help='also write the logged losses as TensorBoard scalars (needs tensorboardX)')
+    parser.add_argument('--keep_checkpoints', type=int, default=0, help='number of most recent checkpoints to keep, 0 keeps all')
     parser.add_argument('--n_residual_blocks', type=int, default=9, help='number of residual blocks in generator')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='precision of the forward passes (bf16/fp16 run under autocast)')
+    parser.add_argument('--fused_D', action='store_true', help='train both discriminators with one forward per domain, one backward and one optimizer')
+    parser.add_argument('--packed_root', type=str, default=None, help='directory of arrays written by datasets.py (skips JPEG decoding)')
     opt = parser.parse_args()
     print(opt)
 
@@ -66,6 +81,8 @@ if __name__ == '__main__':
     criterion_identity = torch.nn.L1Loss()
 
     cuda = True if torch.cuda.is_available() else False
+    targets = TargetCache(device='cuda' if cuda else 'cpu')
+    amp = Precision(opt.precision, device='cuda' if cuda else 'cpu')
 
     # Calculate output of image discriminator (PatchGAN)
     patch = (1, opt.img_height // 2**4, opt.img_width // 2**4)
@@ -85,13 +102,7 @@ if __name__ == '__main__':
         criterion_cycle.cuda()
         criterion_identity.cuda()
 
-    if opt.epoch != 0:
-        # Load pretrained models
-        G_AB.load_state_dict(torch.load('saved_models/%s/G_AB_%d.pth' % (opt.dataset_name, opt.epoch)))
-        G_BA.load_state_dict(torch.load('saved_models/%s/G_BA_%d.pth' % (opt.dataset_name, opt.epoch)))
-        D_A.load_state_dict(torch.load('saved_models/%s/D_A_%d.pth' % (opt.dataset_name, opt.epoch)))
-        D_B.load_state_dict(torch.load('saved_models/%s/D_B_%d.pth' % (opt.dataset_name, opt.epoch)))
-    else:
+    if opt.epoch == 0:
         # Initialize weights
         G_AB.apply(weights_init_normal)
         G_BA.apply(weights_init_normal)
@@ -102,23 +113,52 @@ if __name__ == '__main__':
     lambda_cyc = 10
     lambda_id = 0 # 0.5 * lambda_cyc
 
+    # Generator loss terms; terms with zero weight are not computed at all
+    g_losses = WeightedLosses()
+    g_losses.add('GAN', 1)
+    g_losses.add('cycle', lambda_cyc, passes='G_BA(fake_B), G_AB(fake_A)')
+    g_losses.add('identity', lambda_id, passes='G_BA(real_A), G_AB(real_B)')
+    print(g_losses.summary(opt.epoch))
+
     # Optimizers
     optimizer_G = torch.optim.Adam(itertools.chain(G_AB.parameters(), G_BA.parameters()),
                                     lr=opt.lr, betas=(opt.b1, opt.b2))
-    optimizer_D_A = torch.optim.Adam(D_A.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
-    optimizer_D_B = torch.optim.Adam(D_B.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
+    if opt.fused_D:
+        # Adam keeps per-parameter state, so one optimizer over both parameter groups
+        # takes the same steps as two separate ones
+        optimizer_D = torch.optim.Adam([{'params': D_A.parameters()}, {'params': D_B.parameters()}],
+                                       lr=opt.lr, betas=(opt.b1, opt.b2))
+        optimizers_D = [optimizer_D]
+    else:
+        optimizer_D_A = torch.optim.Adam(D_A.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
+        optimizer_D_B = torch.optim.Adam(D_B.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
+        optimizers_D = [optimizer_D_A, optimizer_D_B]
 
     # Learning rate update schedulers
     lr_scheduler_G = torch.optim.lr_scheduler.LambdaLR(optimizer_G, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
-    lr_scheduler_D_A = torch.optim.lr_scheduler.LambdaLR(optimizer_D_A, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
-    lr_scheduler_D_B = torch.optim.lr_scheduler.LambdaLR(optimizer_D_B, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
+    lr_schedulers_D = [torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
+                       for optimizer in optimizers_D]
 
     Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
 
+    accum = GradientAccumulator(opt.micro_batch_size, precision=amp)
+
     # Buffers of previously generated samples
     fake_A_buffer = ReplayBuffer()
     fake_B_buffer = ReplayBuffer()
 
+    # Everything a checkpoint holds; the sample histories keep the discriminators seeing old fakes.
+    # The LR schedulers are rebuilt from --epoch instead (LambdaLR offsets the decay by it)
+    state = dict(G_AB=G_AB, G_BA=G_BA, D_A=D_A, D_B=D_B, optimizer_G=optimizer_G,
+                 fake_A_buffer=fake_A_buffer, fake_B_buffer=fake_B_buffer, amp=amp)
+    state.update(zip(['optimizer_D'] if opt.fused_D else ['optimizer_D_A', 'optimizer_D_B'], optimizers_D))
+
+    checkpoints = CheckpointManager('saved_models/%s' % opt.dataset_name, keep=opt.keep_checkpoints,
+                                    legacy='{name}_{step}.pth')
+    if opt.epoch != 0:
+        # Load pretrained models
+        checkpoints.restore(opt.epoch, **state)
+
     # Image transformations
     transforms_ = [ transforms.Resize(int(opt.img_height*1.12), Image.BICUBIC),
                     transforms.RandomCrop((opt.img_height, opt.img_width)),
@@ -126,19 +166,73 @@ if __name__ == '__main__':
                     transforms.ToTensor(),
                     transforms.Normalize((0.5,0.5,0.5), (0.5,0.5,0.5)) ]
 
+    if opt.packed_root is not None:
+        train_dataset = PackedImageDataset(opt.packed_root, (opt.img_height, opt.img_width), unaligned=True)
+        val_dataset = PackedImageDataset(opt.packed_root, (opt.img_height, opt.img_width), unaligned=True, mode='test')
+    else:
+        train_dataset = ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, unaligned=True)
+        val_dataset = ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, unaligned=True, mode='test')
+
     # Training data loader
-    dataloader = DataLoader(ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, unaligned=True),
-                            batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu)
+    dataloader = DataLoader(train_dataset, batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu)
     # Test data loader
-    val_dataloader = DataLoader(ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, unaligned=True, mode='test'),
-                            batch_size=5, shuffle=True, num_workers=1)
+    val_dataloader = DataLoader(val_dataset, batch_size=5, shuffle=True, num_workers=1)
+
 
+    # Forward/backward passes over one micro-batch, driven by accum.run
+    def generator_step(real_A, real_B):
+        # Adversarial ground truths
+        valid = targets.ones((real_A.size(0), *patch))
+
+        with amp.autocast():
+            fake_B = G_AB(real_A)
+            fake_A = G_BA(real_B)
+
+            loss_G, terms = g_losses.compute({
+                # Identity loss: This loss is importent only when we want to preserve color of input image in output
+                'identity': lambda: (criterion_identity(G_BA(real_A), real_A) +
+                                     criterion_identity(G_AB(real_B), real_B)) / 2,
+                # GAN loss
+                'GAN': lambda: (criterion_GAN(D_B(fake_B), valid) +
+                                criterion_GAN(D_A(fake_A), valid)) / 2,
+                # Cycle loss
+                'cycle': lambda: (criterion_cycle(G_BA(fake_B), real_A) +
+                                  criterion_cycle(G_AB(fake_A), real_B)) / 2,
+            }, step=epoch)
+
+        accum.backward(loss_G)
+        # Fakes are kept in float32 so the replay buffers do not depend on --precision
+        return dict(terms, G=loss_G, fake_A=fake_A.detach().float(), fake_B=fake_B.detach().float())
+
+    def discriminator_step(D, real, fake_):
+        with amp.autocast():
+            # Real loss
+            loss_real = criterion_GAN(D(real), targets.ones((real.size(0), *patch)))
+            # Fake loss (on batch of previously generated samples)
+            loss_fake = criterion_GAN(D(fake_), targets.zeros((real.size(0), *patch)))
+            # Total loss
+            loss_D = (loss_real + loss_fake) / 2
+
+        accum.backward(loss_D)
+        return {'D': loss_D}
+
+    def fused_discriminator_step(real_A, fake_A_, real_B, fake_B_):
+        with amp.autocast():
+            loss_D_A, loss_D_B = fused_discriminator_losses(criterion_GAN, targets,
+                                                            ((D_A, real_A, fake_A_), (D_B, real_B, fake_B_)))
+
+        accum.backward(loss_D_A + loss_D_B)
+        return {'D_A': loss_D_A, 'D_B': loss_D_B}
+
+
+    metrics = Metrics("\r[Epoch {epoch}/{n_epochs}] [Batch {batch}/{n_batches}] [D loss: {D:f}] "
+                      "[G loss: {G:f}, adv: {GAN:f}, cycle: {cycle:f}, identity: {identity:f}] ETA: {eta}\n",
+                      csv_path=opt.metrics_csv, log_dir=opt.tensorboard_dir)
 
     # ----------
     #  Training
     # ----------
 
-    prev_time = time.time()
     for epoch in range(opt.epoch, opt.n_epochs):
         for i, batch in enumerate(dataloader):
 
@@ -146,79 +240,49 @@ if __name__ == '__main__':
             real_A = Variable(batch['A'].type(Tensor))
             real_B = Variable(batch['B'].type(Tensor))
 
-            # Adversarial ground truths
-            valid = Variable(Tensor(np.ones((real_A.size(0), *patch))), requires_grad=False)
-            fake = Variable(Tensor(np.zeros((real_A.size(0), *patch))), requires_grad=False)
-
             # ------------------
             #  Train Generators
             # ------------------
 
             optimizer_G.zero_grad()
+            terms = accum.run(generator_step, real_A, real_B, optimizers=[optimizer_G])
+            loss_G, fake_A, fake_B = terms['G'], terms['fake_A'], terms['fake_B']
+            amp.step(optimizer_G)
 
-            # Identity loss: This loss is importent only when we want to preserve color of input image in output
-            loss_id_A = criterion_identity(G_BA(real_A), real_A)
-            loss_id_B = criterion_identity(G_AB(real_B), real_B)
-
-            loss_identity = (loss_id_A + loss_id_B) / 2
-
-            # GAN loss
-            fake_B = G_AB(real_A)
-            loss_GAN_AB = criterion_GAN(D_B(fake_B), valid)
-            fake_A = G_BA(real_B)
-            loss_GAN_BA = criterion_GAN(D_A(fake_A), valid)
-
-            loss_GAN = (loss_GAN_AB + loss_GAN_BA) / 2
-
-            # Cycle loss
-            recov_A = G_BA(fake_B)
-            loss_cycle_A = criterion_cycle(recov_A, real_A)
-            recov_B = G_AB(fake_A)
-            loss_cycle_B = criterion_cycle(recov_B, real_B)
-
-            loss_cycle = (loss_cycle_A + loss_cycle_B) / 2
-
-            # Total loss
-            loss_G =    loss_GAN + \
-                        lambda_cyc * loss_cycle + \
-                        lambda_id * loss_identity
-
-            loss_G.backward()
-            optimizer_G.step()
-
-            # -----------------------
-            #  Train Discriminator A
-            # -----------------------
-
-            optimizer_D_A.zero_grad()
-
-            # Real loss
-            loss_real = criterion_GAN(D_A(real_A), valid)
-            # Fake loss (on batch of previously generated samples)
+            # The whole batch goes through the buffers once, as without accumulation
             fake_A_ = fake_A_buffer.push_and_pop(fake_A)
-            loss_fake = criterion_GAN(D_A(fake_A_.detach()), fake)
-            # Total loss
-            loss_D_A = (loss_real + loss_fake) / 2
-
-            loss_D_A.backward()
-            optimizer_D_A.step()
-
-            # -----------------------
-            #  Train Discriminator B
-            # -----------------------
-
-            optimizer_D_B.zero_grad()
-
-            # Real loss
-            loss_real = criterion_GAN(D_B(real_B), valid)
-            # Fake loss (on batch of previously generated samples)
             fake_B_ = fake_B_buffer.push_and_pop(fake_B)
-            loss_fake = criterion_GAN(D_B(fake_B_.detach()), fake)
-            # Total loss
-            loss_D_B = (loss_real + loss_fake) / 2
 
-            loss_D_B.backward()
-            optimizer_D_B.step()
+            if opt.fused_D:
+                # -----------------------------------
+                #  Train Discriminators A and B fused
+                # -----------------------------------
+
+                optimizer_D.zero_grad()
+                losses = accum.run(fused_discriminator_step, real_A, fake_A_, real_B, fake_B_,
+                                   optimizers=[optimizer_D])
+                loss_D_A, loss_D_B = losses['D_A'], losses['D_B']
+                amp.step(optimizer_D)
+            else:
+                # -----------------------
+                #  Train Discriminator A
+                # -----------------------
+
+                optimizer_D_A.zero_grad()
+                loss_D_A = accum.run(lambda real, fake_: discriminator_step(D_A, real, fake_),
+                                     real_A, fake_A_, optimizers=[optimizer_D_A])['D']
+                amp.step(optimizer_D_A)
+
+                # -----------------------
+                #  Train Discriminator B
+                # -----------------------
+
+                optimizer_D_B.zero_grad()
+                loss_D_B = accum.run(lambda real, fake_: discriminator_step(D_B, real, fake_),
+                                     real_B, fake_B_, optimizers=[optimizer_D_B])['D']
+                amp.step(optimizer_D_B)
+
+            amp.update()
 
             loss_D = (loss_D_A + loss_D_B) / 2
 
@@ -226,33 +290,30 @@ if __name__ == '__main__':
             #  Log Progress
             # --------------
 
-            # Determine approximate time left
+            metrics.update(D=loss_D, G=loss_G, GAN=terms['GAN'], cycle=terms['cycle'], identity=terms['identity'])
+            metrics.tick()
+
+            # Print log, with the approximate time left
             batches_done = epoch * len(dataloader) + i
-            batches_left = opt.n_epochs * len(dataloader) - batches_done
-            time_left = datetime.timedelta(seconds=batches_left * (time.time() - prev_time))
-            prev_time = time.time()
-
-            # Print log
-            sys.stdout.write("\r[Epoch %d/%d] [Batch %d/%d] [D loss: %f] [G loss: %f, adv: %f, cycle: %f, identity: %f] ETA: %s\n" %
-                                                            (epoch, opt.n_epochs,
-                                                            i, len(dataloader),
-                                                            loss_D.item(), loss_G.item(),
-                                                            loss_GAN.item(), loss_cycle.item(),
-                                                            loss_identity.item(), time_left))
+            if batches_done % opt.log_interval == 0:
+                metrics.log(batches_done, remaining=opt.n_epochs * len(dataloader) - batches_done,
+                            epoch=epoch, n_epochs=opt.n_epochs, batch=i, n_batches=len(dataloader))
 
             # If at sample interval save image
             if batches_done % opt.sample_interval == 0:
                 sample_images(batches_done)
 
 
+        if g_losses.elided:
+            print(g_losses.report())
+
         # Update learning rates
         lr_scheduler_G.step()
-        lr_scheduler_D_A.step()
-        lr_scheduler_D_B.step()
+        for lr_scheduler_D in lr_schedulers_D:
+            lr_scheduler_D.step()
 
         if opt.checkpoint_interval != -1 and epoch % opt.checkpoint_interval == 0:
             # Save model checkpoints
-            torch.save(G_AB.state_dict(), 'saved_models/%s/G_AB_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(G_BA.state_dict(), 'saved_models/%s/G_BA_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(D_A.state_dict(), 'saved_models/%s/D_A_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(D_B.state_dict(), 'saved_models/%s/D_B_%d.pth' % (opt.dataset_name, epoch))
+            checkpoints.save(epoch, **state)
+
+    checkpoints.close()
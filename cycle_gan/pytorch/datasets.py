@@ -6,6 +6,8 @@ from torch.utils.data import Dataset
 from PIL import Image
 import torchvision.transforms as transforms
 
+from packed_images import PackedImageDataset, pack_dataset, pack_domain, pack_main
+
 
 class ImageDataset(Dataset):
     def __init__(self, root, transforms_=None, unaligned=True, mode='train'):
@@ -31,3 +33,7 @@ class ImageDataset(Dataset):
 
     def __len__(self):
         return max(len(self.files_A), len(self.files_B))
+
+
+if __name__ == '__main__':
+    pack_main(286)
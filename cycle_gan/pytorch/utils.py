@@ -10,26 +10,65 @@ import numpy as np
 from torchvision.utils import save_image
 
 class ReplayBuffer():
+    """History of generated samples kept in one preallocated (max_size, C, H, W) tensor
+
+    Each incoming sample is returned as-is while the buffer is filling up. Once it is
+    full, every sample has a 50% chance of being swapped with a stored one, which is
+    returned in its place. The whole batch is swapped at once with masks and
+    index_copy_, so slots touched within one call are distinct; samples beyond the
+    first max_size of an over-sized batch are passed through untouched.
+    """
     def __init__(self, max_size=50):
         assert (max_size > 0), 'Empty buffer or trying to create a black hole. Be careful.'
         self.max_size = max_size
-        self.data = []
+        self.data = None
+        self.num_stored = 0
 
     def push_and_pop(self, data):
-        to_return = []
-        for element in data.data:
-            element = torch.unsqueeze(element, 0)
-            if len(self.data) < self.max_size:
-                self.data.append(element)
-                to_return.append(element)
+        data = data.detach()
+        batch_size = data.size(0)
+        if self.data is None:
+            # Allocated lazily so it lives on the same device/dtype as the generator output
+            self.data = data.new_empty((self.max_size,) + tuple(data.shape[1:]))
+        elif self.data.device != data.device:
+            # Restored from a checkpoint loaded to CPU
+            self.data = self.data.to(data.device)
+
+        to_return = data
+
+        # Fill free slots first, returning those samples unchanged
+        n_fill = min(self.max_size - self.num_stored, batch_size)
+        if n_fill > 0:
+            self.data[self.num_stored:self.num_stored + n_fill] = data[:n_fill]
+            self.num_stored += n_fill
+
+        # Swap the rest with random distinct slots of the (now full) buffer
+        n_swap = min(batch_size - n_fill, self.max_size)
+        if n_swap > 0:
+            incoming = data[n_fill:n_fill + n_swap]
+            slots = torch.randperm(self.max_size, device=data.device)[:n_swap]
+            swap = torch.rand(n_swap, device=data.device) > 0.5
+            swap = swap.view(-1, *([1] * (data.dim() - 1)))
+
+            stored = self.data.index_select(0, slots)
+            swapped = torch.where(swap, stored, incoming)
+            self.data.index_copy_(0, slots, torch.where(swap, incoming, stored))
+            if n_swap == batch_size:
+                to_return = swapped
             else:
-                if random.uniform(0,1) > 0.5:
-                    i = random.randint(0, self.max_size-1)
-                    to_return.append(self.data[i].clone())
-                    self.data[i] = element
-                else:
-                    to_return.append(element)
-        return Variable(torch.cat(to_return))
+                to_return = torch.cat((data[:n_fill], swapped, data[n_fill + n_swap:]))
+
+        return Variable(to_return)
+
+    def state_dict(self):
+        return {'max_size': self.max_size,
+                'num_stored': self.num_stored,
+                'data': self.data}
+
+    def load_state_dict(self, state_dict):
+        assert (state_dict['max_size'] == self.max_size), 'Buffer size mismatch: %d != %d' % (state_dict['max_size'], self.max_size)
+        self.num_stored = state_dict['num_stored']
+        self.data = state_dict['data']
 
 
 class LambdaLR():
@@ -1,85 +1,123 @@
 import glob
+import os
+from multiprocessing import Pool
+
 import numpy as np
 import matplotlib.image as mpimage
 import matplotlib.pyplot as plt
 import cv2
 
 
-def UTKFace_data(size=(128, 128)):
-    print("load data started")
-    all_images = glob.glob("E:\\Datasets\\UTKFace\\*")
+UTKFACE_DIR = "E:\\Datasets\\UTKFace"
+UTKFACE_CACHE_DIR = "E:\\Datasets\\UTKFace_cache"
 
-    X = []
-    y = []
+# age, gender (0: male, 1: female) and race parsed from '<age>_<gender>_<race>_<date>.jpg',
+# race is -1 for the files whose name has no race field
+UTKFACE_META_DTYPE = np.dtype([('age', np.int16), ('gender', np.int8), ('race', np.int8)])
 
-    for i, image in enumerate(all_images):
-        # # take half data
-        # if i%20 != 0:
-        #     continue
 
-        only_name = image.split('\\')[-1]
-        age = int(only_name.split('_')[0])
+def _parse_utkface_name(path):
+    fields = os.path.basename(path).split('_')
+    try:
+        age, gender = int(fields[0]), int(fields[1])
+    except (IndexError, ValueError):
+        return None
+    try:
+        race = int(fields[2])
+    except (IndexError, ValueError):
+        # A handful of UTKFace files are missing the race field, e.g. '39_1_20170116174525125.jpg.chip.jpg'
+        race = -1
+    return age, gender, race
 
-        img = mpimage.imread(image)
-        img = cv2.resize(img, (size[0], size[1]))
 
-        X.append(img)
-        y.append(min(int(age / 5), 19))
+def _read_resized(args):
+    path, size = args
+    img = mpimage.imread(path)
+    if img.dtype != np.uint8:
+        img = (img * 255).astype(np.uint8)
+    if img.ndim == 2:
+        img = np.stack((img,) * 3, axis=-1)
+    return cv2.resize(np.ascontiguousarray(img[..., :3]), (size[0], size[1]))
 
-    X = np.array(X).astype(np.float32)
-    y = np.array(y).astype(np.int)
-    print("data loaded")
 
-    return X, y
+def build_utkface_cache(size=(128, 128), root=UTKFACE_DIR, cache_dir=UTKFACE_CACHE_DIR, processes=None):
+    """Decodes and resizes every UTKFace image once on a process pool
 
+    Writes 'utkface_<w>x<h>.npy' (uint8 images) and 'utkface_<w>x<h>_meta.npy'
+    (UTKFACE_META_DTYPE records in the same order) to cache_dir.
+    """
+    print("building UTKFace cache at %dx%d" % (size[0], size[1]))
+    os.makedirs(cache_dir, exist_ok=True)
+    images_path, meta_path = _utkface_cache_paths(size, cache_dir)
 
-def UTKFace_male(size=(128, 128)):
-    print("load data started")
-    all_images = glob.glob("E:\\Datasets\\UTKFace\\*")
+    files, meta = [], []
+    for path in sorted(glob.glob(os.path.join(root, '*'))):
+        parsed = _parse_utkface_name(path)
+        if parsed is not None:
+            files.append(path)
+            meta.append(parsed)
+    meta = np.array(meta, dtype=UTKFACE_META_DTYPE)
 
-    X = []
-    y = []
+    X = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                  shape=(len(files), size[1], size[0], 3))
+    with Pool(processes) as pool:
+        for i, img in enumerate(pool.imap(_read_resized, [(path, size) for path in files], chunksize=64)):
+            X[i] = img
+    X.flush()
+    del X
 
-    for i, image in enumerate(all_images):
-        only_name = image.split('\\')[-1]
-        age = int(only_name.split('_')[0])
-        gender = int(only_name.split('_')[1])
+    np.save(meta_path, meta)
+    os.replace(images_path + '.tmp', images_path)
+    print("cached %d images" % len(files))
 
-        if gender == 0:
-            img = mpimage.imread(image)
-            img = cv2.resize(img, (size[0], size[1]))
 
-            X.append(img)
-            y.append(min(int(age / 5), 19))
+def _utkface_cache_paths(size, cache_dir):
+    prefix = os.path.join(cache_dir, 'utkface_%dx%d' % (size[0], size[1]))
+    return prefix + '.npy', prefix + '_meta.npy'
 
-    X = np.array(X).astype(np.float32)
-    y = np.array(y).astype(np.int)
-    print("data loaded")
 
-    return X, y
+def load_utkface(size=(128, 128), cache_dir=UTKFACE_CACHE_DIR):
+    """Returns the memory-mapped uint8 images and metadata table, building the cache if needed"""
+    images_path, meta_path = _utkface_cache_paths(size, cache_dir)
+    if not (os.path.exists(images_path) and os.path.exists(meta_path)):
+        build_utkface_cache(size, cache_dir=cache_dir)
+    return np.load(images_path, mmap_mode='r'), np.load(meta_path)
 
 
-def UTKFace_female(size=(128, 128)):
-    print("load data started")
-    all_images = glob.glob("E:\\Datasets\\UTKFace\\*")
+def age_bucket(age):
+    return np.minimum(age // 5, 19).astype(int)
 
-    X = []
-    y = []
 
-    for i, image in enumerate(all_images):
-        only_name = image.split('\\')[-1]
-        age = int(only_name.split('_')[0])
-        gender = int(only_name.split('_')[1])
+def utkface_indices(meta, gender=None, age_buckets=None):
+    """Row indices of the cached images matching a gender and/or a set of age buckets"""
+    mask = np.ones(len(meta), dtype=bool)
+    if gender is not None:
+        mask &= meta['gender'] == gender
+    if age_buckets is not None:
+        mask &= np.isin(age_bucket(meta['age']), age_buckets)
+    return np.flatnonzero(mask)
 
-        if gender == 1:
-            img = mpimage.imread(image)
-            img = cv2.resize(img, (size[0], size[1]))
 
-            X.append(img)
-            y.append(min(int(age / 5), 19))
+def UTKFace_subset(size=(128, 128), gender=None, age_buckets=None):
+    print("load data started")
+    X, meta = load_utkface(size)
+    if gender is None and age_buckets is None:
+        print("data loaded")
+        return X, age_bucket(meta['age'])
 
-    X = np.array(X).astype(np.float32)
-    y = np.array(y).astype(np.int)
+    idx = utkface_indices(meta, gender, age_buckets)
     print("data loaded")
 
-    return X, y
+    return X[idx], age_bucket(meta['age'][idx])
+
+
+def UTKFace_data(size=(128, 128)):
+    return UTKFace_subset(size)
+
+
+def UTKFace_male(size=(128, 128)):
+    return UTKFace_subset(size, gender=0)
+
+
+def UTKFace_female(size=(128, 128)):
+    return UTKFace_subset(size, gender=1)
@@ -18,6 +18,8 @@ from torchvision import datasets
 from torch.autograd import Variable
 import torchvision.transforms as transforms
 from torchvision.utils import save_image
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 # Defining the global variables
 n_epochs = 200
@@ -34,6 +36,8 @@ os.makedirs('images', exist_ok=True)
 
 img_shape = (channels, img_size, img_size)
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 FloatTensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 LongTensor = torch.cuda.LongTensor if cuda else torch.LongTensor
 
@@ -151,8 +155,8 @@ for epoch in range(n_epochs):
 
         batch_size = imgs.size(0)
         # adversarial ground truth
-        valid = Variable(FloatTensor(imgs.size(0), 1).fill_(1.0), requires_grad=False)
-        fake = Variable(FloatTensor(imgs.size(0), 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((imgs.size(0), 1))
+        fake = targets.zeros((imgs.size(0), 1))
 
         # configure input
         real_imgs = Variable(imgs.type(FloatTensor))
@@ -163,7 +167,7 @@ for epoch in range(n_epochs):
         optimizer_G.zero_grad()
 
         # sample noise as generator input
-        z = Variable(FloatTensor(np.random.normal(0, 1, (batch_size, latent_dim))))
+        z = sampler.normal((batch_size, latent_dim), key='z')
 
         # generate a batch of images
         gen_imgs = generator(z)
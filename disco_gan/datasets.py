@@ -6,6 +6,8 @@ from torch.utils.data import Dataset
 from PIL import Image
 import torchvision.transforms as transforms
 
+import packed_images
+
 
 class ImageDataset(Dataset):
     def __init__(self, root, transforms_=None, unaligned=True, mode='train'):
@@ -31,3 +33,19 @@ class ImageDataset(Dataset):
 
     def __len__(self):
         return max(len(self.files_A), len(self.files_B))
+
+
+class PackedImageDataset(packed_images.PackedImageDataset):
+    """Packed 'A' / 'B' folders, with the domains swapped like ImageDataset"""
+    def __init__(self, root, crop_size, unaligned=True, mode='train', flip=False):
+        super(PackedImageDataset, self).__init__(root, crop_size, unaligned, mode, flip, split_dirs=False,
+                                                 swap_domains=True)
+
+
+def pack_dataset(root, out_dir, base_size):
+    """Packs the 'A' and 'B' domain folders for PackedImageDataset"""
+    packed_images.pack_dataset(root, out_dir, base_size, split_dirs=False)
+
+
+if __name__ == '__main__':
+    packed_images.pack_main(64, split_dirs=False)
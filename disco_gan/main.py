@@ -20,6 +20,10 @@ from datasets import *
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from fused_discriminators import fused_discriminator_losses
+from checkpoint_manager import CheckpointManager
+from metrics import Metrics
 
 
 def weights_init_normal(m):
@@ -47,6 +51,12 @@ if __name__ == '__main__':
     parser.add_argument('--sample_interval', type=int, default=100,
                         help='interval between sampling of images from generators')
     parser.add_argument('--checkpoint_interval', type=int, default=-1, help='interval between model checkpoints')
+    parser.add_argument('--log_interval', type=int, default=20, help='interval between printing the running mean losses (each print waits for the device)')
+    parser.add_argument('--metrics_csv', type=str, default=None, help='also append the logged losses to this CSV file')
+    parser.add_argument('--tensorboard_dir', type=str, default=None, help='also write the logged losses as TensorBoard scalars (needs tensorboardX)')
+    parser.add_argument('--keep_checkpoints', type=int, default=0, help='number of most recent checkpoints to keep, 0 keeps all')
+    parser.add_argument('--fused_D', action='store_true', help='train both discriminators with one forward per domain, one backward and one optimizer')
+    parser.add_argument('--packed_root', type=str, default=None, help='directory of arrays written by datasets.py (skips JPEG decoding)')
     opt = parser.parse_args()
     print(opt)
 
@@ -60,6 +70,7 @@ if __name__ == '__main__':
     pixelwise_loss = torch.nn.L1Loss()
 
     cuda = True if torch.cuda.is_available() else False
+    targets = TargetCache(device='cuda' if cuda else 'cpu')
 
     # Calculate output of image discriminator (PatchGAN)
     patch = (1, opt.img_height // 2 ** 3, opt.img_width // 2 ** 3)
@@ -79,13 +90,7 @@ if __name__ == '__main__':
         cycle_loss.cuda()
         pixelwise_loss.cuda()
 
-    if opt.epoch != 0:
-        # Load pretrained models
-        G_AB.load_state_dict(torch.load('saved_models/%s/G_AB_%d.pth' % (opt.dataset_name, opt.epoch)))
-        G_BA.load_state_dict(torch.load('saved_models/%s/G_BA_%d.pth' % (opt.dataset_name, opt.epoch)))
-        D_A.load_state_dict(torch.load('saved_models/%s/D_A_%d.pth' % (opt.dataset_name, opt.epoch)))
-        D_B.load_state_dict(torch.load('saved_models/%s/D_B_%d.pth' % (opt.dataset_name, opt.epoch)))
-    else:
+    if opt.epoch == 0:
         # Initialize weights
         G_AB.apply(weights_init_normal)
         G_BA.apply(weights_init_normal)
@@ -95,8 +100,26 @@ if __name__ == '__main__':
     # Optimizers
     optimizer_G = torch.optim.Adam(itertools.chain(G_AB.parameters(), G_BA.parameters()),
                                    lr=opt.lr, betas=(opt.b1, opt.b2))
-    optimizer_D_A = torch.optim.Adam(D_A.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
-    optimizer_D_B = torch.optim.Adam(D_B.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
+    if opt.fused_D:
+        # Adam keeps per-parameter state, so one optimizer over both parameter groups
+        # takes the same steps as two separate ones
+        optimizer_D = torch.optim.Adam([{'params': D_A.parameters()}, {'params': D_B.parameters()}],
+                                       lr=opt.lr, betas=(opt.b1, opt.b2))
+    else:
+        optimizer_D_A = torch.optim.Adam(D_A.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
+        optimizer_D_B = torch.optim.Adam(D_B.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
+
+    state = dict(G_AB=G_AB, G_BA=G_BA, D_A=D_A, D_B=D_B, optimizer_G=optimizer_G)
+    if opt.fused_D:
+        state.update(optimizer_D=optimizer_D)
+    else:
+        state.update(optimizer_D_A=optimizer_D_A, optimizer_D_B=optimizer_D_B)
+
+    checkpoints = CheckpointManager('saved_models/%s' % opt.dataset_name, keep=opt.keep_checkpoints,
+                                    legacy='{name}_{step}.pth')
+    if opt.epoch != 0:
+        # Load pretrained models
+        checkpoints.restore(opt.epoch, **state)
 
     # Input tensor type
     Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
@@ -105,10 +128,14 @@ if __name__ == '__main__':
     transforms_ = [transforms.Resize((opt.img_height, opt.img_width), Image.BICUBIC),
                    transforms.ToTensor(),
                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
-    dataloader = DataLoader(ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, mode='train'),
-                            batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu)
-    val_dataloader = DataLoader(ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, mode='val'),
-                                batch_size=16, shuffle=True, num_workers=opt.n_cpu)
+    if opt.packed_root is not None:
+        train_dataset = PackedImageDataset(opt.packed_root, (opt.img_height, opt.img_width), mode='train')
+        val_dataset = PackedImageDataset(opt.packed_root, (opt.img_height, opt.img_width), mode='val')
+    else:
+        train_dataset = ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, mode='train')
+        val_dataset = ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, mode='val')
+    dataloader = DataLoader(train_dataset, batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu)
+    val_dataloader = DataLoader(val_dataset, batch_size=16, shuffle=True, num_workers=opt.n_cpu)
 
 
     def sample_images(batches_done):
@@ -123,11 +150,14 @@ if __name__ == '__main__':
         save_image(img_sample, 'images/%s/%s.png' % (opt.dataset_name, batches_done), nrow=8, normalize=True)
 
 
+    metrics = Metrics("\r[Epoch {epoch}/{n_epochs}] [Batch {batch}/{n_batches}] [D loss: {D:f}] "
+                      "[G loss: {G:f}, adv: {GAN:f}, pixel: {pixel:f}, cycle: {cycle:f}] ETA: {eta}\n",
+                      csv_path=opt.metrics_csv, log_dir=opt.tensorboard_dir)
+
     # ----------
     #  Training
     # ----------
 
-    prev_time = time.time()
     for epoch in range(opt.epoch, opt.n_epochs):
         for i, batch in enumerate(dataloader):
 
@@ -136,8 +166,8 @@ if __name__ == '__main__':
             real_B = Variable(batch['B'].type(Tensor))
 
             # Adversarial ground truths
-            valid = Variable(Tensor(np.ones((real_A.size(0), *patch))), requires_grad=False)
-            fake = Variable(Tensor(np.zeros((real_A.size(0), *patch))), requires_grad=False)
+            valid = targets.ones((real_A.size(0), *patch))
+            fake = targets.zeros((real_A.size(0), *patch))
 
             # ------------------
             #  Train Generators
@@ -168,36 +198,50 @@ if __name__ == '__main__':
             loss_G.backward()
             optimizer_G.step()
 
-            # -----------------------
-            #  Train Discriminator A
-            # -----------------------
+            if opt.fused_D:
+                # -----------------------------------
+                #  Train Discriminators A and B fused
+                # -----------------------------------
 
-            optimizer_D_A.zero_grad()
+                optimizer_D.zero_grad()
 
-            # Real loss
-            loss_real = adversarial_loss(D_A(real_A), valid)
-            # Fake loss (on batch of previously generated samples)
-            loss_fake = adversarial_loss(D_A(fake_A.detach()), fake)
-            # Total loss
-            loss_D_A = (loss_real + loss_fake) / 2
+                loss_D_A, loss_D_B = fused_discriminator_losses(adversarial_loss, targets,
+                                                                ((D_A, real_A, fake_A.detach()),
+                                                                 (D_B, real_B, fake_B.detach())))
 
-            loss_D_A.backward()
-            optimizer_D_A.step()
+                (loss_D_A + loss_D_B).backward()
+                optimizer_D.step()
+            else:
+                # -----------------------
+                #  Train Discriminator A
+                # -----------------------
 
-            # -----------------------
-            #  Train Discriminator B
-            # -----------------------
+                optimizer_D_A.zero_grad()
 
-            optimizer_D_B.zero_grad()
-            # Real loss
-            loss_real = adversarial_loss(D_B(real_B), valid)
-            # Fake loss (on batch of previously generated samples)
-            loss_fake = adversarial_loss(D_B(fake_B.detach()), fake)
-            # Total loss
-            loss_D_B = (loss_real + loss_fake) / 2
+                # Real loss
+                loss_real = adversarial_loss(D_A(real_A), valid)
+                # Fake loss (on batch of previously generated samples)
+                loss_fake = adversarial_loss(D_A(fake_A.detach()), fake)
+                # Total loss
+                loss_D_A = (loss_real + loss_fake) / 2
+
+                loss_D_A.backward()
+                optimizer_D_A.step()
 
-            loss_D_B.backward()
-            optimizer_D_B.step()
+                # -----------------------
+                #  Train Discriminator B
+                # -----------------------
+
+                optimizer_D_B.zero_grad()
+                # Real loss
+                loss_real = adversarial_loss(D_B(real_B), valid)
+                # Fake loss (on batch of previously generated samples)
+                loss_fake = adversarial_loss(D_B(fake_B.detach()), fake)
+                # Total loss
+                loss_D_B = (loss_real + loss_fake) / 2
+
+                loss_D_B.backward()
+                optimizer_D_B.step()
 
             loss_D = 0.5 * (loss_D_A + loss_D_B)
 
@@ -205,20 +249,14 @@ if __name__ == '__main__':
             #  Log Progress
             # --------------
 
-            # Determine approximate time left
+            metrics.update(D=loss_D, G=loss_G, GAN=loss_GAN, pixel=loss_pixelwise, cycle=loss_cycle)
+            metrics.tick()
+
+            # Print log, with the approximate time left
             batches_done = epoch * len(dataloader) + i
-            batches_left = opt.n_epochs * len(dataloader) - batches_done
-            time_left = datetime.timedelta(seconds=batches_left * (time.time() - prev_time))
-            prev_time = time.time()
-
-            # Print log
-            sys.stdout.write(
-                "\r[Epoch %d/%d] [Batch %d/%d] [D loss: %f] [G loss: %f, adv: %f, pixel: %f, cycle: %f] ETA: %s\n" %
-                (epoch, opt.n_epochs,
-                 i, len(dataloader),
-                 loss_D.item(), loss_G.item(),
-                 loss_GAN.item(), loss_pixelwise.item(),
-                 loss_cycle.item(), time_left))
+            if batches_done % opt.log_interval == 0:
+                metrics.log(batches_done, remaining=opt.n_epochs * len(dataloader) - batches_done,
+                            epoch=epoch, n_epochs=opt.n_epochs, batch=i, n_batches=len(dataloader))
 
             # If at sample interval save image
             if batches_done % opt.sample_interval == 0:
@@ -226,7 +264,6 @@ if __name__ == '__main__':
 
         if opt.checkpoint_interval != -1 and epoch % opt.checkpoint_interval == 0:
             # Save model checkpoints
-            torch.save(G_AB.state_dict(), 'saved_models/%s/G_AB_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(G_BA.state_dict(), 'saved_models/%s/G_BA_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(D_A.state_dict(), 'saved_models/%s/D_A_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(D_B.state_dict(), 'saved_models/%s/D_B_%d.pth' % (opt.dataset_name, epoch))
+            checkpoints.save(epoch, **state)
+
+    checkpoints.close()
@@ -0,0 +1,19 @@
+import torch
+
+
+def fused_discriminator_losses(criterion, targets, domains):
+    """Real/fake losses of several discriminators with one forward pass each
+
+    domains is a sequence of (D, real, fake) triples, targets a TargetCache. Each
+    discriminator sees its real and fake batches concatenated along dim 0 and gets
+    the usual (real + fake) / 2 loss. This is exact for discriminators that normalize
+    per sample (InstanceNorm PatchGANs). The discriminators share no parameters, so
+    one backward through the summed losses gives each of them the same gradients as
+    separate backward passes.
+    """
+    losses = []
+    for D, real, fake in domains:
+        pred_real, pred_fake = D(torch.cat((real, fake))).split([real.size(0), fake.size(0)])
+        losses.append((criterion(pred_real, targets.like(pred_real, 1.0)) +
+                       criterion(pred_fake, targets.like(pred_fake, 0.0))) / 2)
+    return losses
@@ -12,6 +12,8 @@ from torch.autograd import Variable
 
 import torchvision.transforms as transforms
 from torchvision.utils import save_image
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 os.makedirs('images', exist_ok=True)
 
@@ -31,6 +33,8 @@ print(opt)
 
 img_shape = (opt.channels, opt.img_size, opt.img_size)
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 
 
 class Generator(nn.Module):
@@ -115,8 +119,8 @@ for epoch in range(opt.n_epochs):
     for i, (imgs, _) in enumerate(dataloader):
 
         # adversarial ground truth
-        valid = Variable(Tensor(imgs.size(0), 1).fill_(1.0), requires_grad=False)
-        fake = Variable(Tensor(imgs.size(0), 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((imgs.size(0), 1))
+        fake = targets.zeros((imgs.size(0), 1))
 
         # configure input
         real_imgs = Variable(imgs.type(Tensor))
@@ -127,7 +131,7 @@ for epoch in range(opt.n_epochs):
         optimizer_G.zero_grad()
 
         # sample noise as generator input
-        z = Variable(Tensor(np.random.normal(0, 1, (imgs.shape[0], opt.latent_dim))))
+        z = sampler.normal((imgs.shape[0], opt.latent_dim), key='z')
 
         # generate a batch of images
         gen_imgs = generator(z)
@@ -0,0 +1,89 @@
+import torch
+
+
+class GradientAccumulator(object):
+    """Runs one optimizer step's forward/backward over micro-batches of a larger batch
+
+    run() splits the batch tensors along dim 0 and calls the step function once per
+    micro-batch. The step function calls backward() on this accumulator, which scales
+    each loss by its micro-batch's share of the batch, so mean-reduced losses add up
+    to the full-batch gradient. That only holds for models that treat samples
+    independently (InstanceNorm, no norm): BatchNorm normalizes with, and updates its
+    running statistics from, each micro-batch, so a model with BatchNorm (e.g. the
+    resnet18 Encoder of BicycleGAN) trains differently once the batch is split.
+
+    With micro_batch_size=None (auto) the first batch is tried whole and the size is
+    halved when a CUDA out-of-memory error is raised in the first micro-batch; the
+    optimizers are zeroed and the step is run again from the start. The size that
+    fits is kept for later batches. Anything the failed attempt did besides the
+    gradients (RNG draws, replay buffer pushes, running statistics) is not undone. An
+    out-of-memory error after a micro-batch has completed is raised, so a step never
+    repeats the work of whole micro-batches. Losses go through precision.backward()
+    when a Precision is given, so fp16 loss scaling applies to every micro-batch.
+    """
+
+    def __init__(self, micro_batch_size=None, precision=None):
+        self.auto = not micro_batch_size
+        self.micro_batch_size = micro_batch_size or None
+        self.precision = precision
+        self.scale = 1.0
+        self.batch_size = 0
+        self.completed = 0
+
+    @staticmethod
+    def _is_oom(e):
+        return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+    def backward(self, loss, **kwargs):
+        """Backpropagates loss weighted by the current micro-batch's share of the batch"""
+        if self.precision is not None:
+            self.precision.backward(loss * self.scale, **kwargs)
+        else:
+            (loss * self.scale).backward(**kwargs)
+
+    def run(self, step, *tensors, optimizers=()):
+        """Calls step(*micro_batch) for every micro-batch and gathers what it returns
+
+        step may return a dict. Tensors with a batch dimension are concatenated back
+        into full-batch tensors (detach them inside step); scalars are detached and
+        averaged with the micro-batch weights.
+        """
+        while True:
+            try:
+                return self._run(step, tensors)
+            except RuntimeError as e:
+                if not (self.auto and self._is_oom(e) and self.micro_batch_size > 1 and self.completed == 0):
+                    raise
+            # Retried outside the except block so the failed step's tensors are freed
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            torch.cuda.empty_cache()
+            self.micro_batch_size //= 2
+            print("Out of memory, retrying with micro-batches of %d" % self.micro_batch_size)
+
+    def _run(self, step, tensors):
+        self.batch_size = tensors[0].size(0)
+        if self.micro_batch_size is None:
+            self.micro_batch_size = self.batch_size
+
+        outputs = []
+        scales = []
+        self.completed = 0
+        for chunk in zip(*[t.split(self.micro_batch_size) for t in tensors]):
+            self.scale = chunk[0].size(0) / self.batch_size
+            outputs.append(step(*chunk))
+            scales.append(self.scale)
+            self.completed += 1
+        self.scale = 1.0
+
+        if outputs[0] is None:
+            return None
+        gathered = {}
+        for key, value in outputs[0].items():
+            values = [out[key] for out in outputs]
+            if torch.is_tensor(value) and value.dim() > 0:
+                gathered[key] = torch.cat(values)
+            else:
+                gathered[key] = sum((v.detach() if torch.is_tensor(v) else v) * s
+                                    for v, s in zip(values, scales))
+        return gathered
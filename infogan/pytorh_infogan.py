@@ -14,6 +14,8 @@ from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 os.makedirs('images/static/', exist_ok=True)
 os.makedirs('images/varying_c1/', exist_ok=True)
@@ -36,6 +38,8 @@ opt = parser.parse_args()
 print(opt)
 
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 
 
 def weights_init_normal(m):
@@ -47,12 +51,9 @@ def weights_init_normal(m):
         torch.nn.init.constant_(m.bias.data, 0.0)
 
 
-def to_categorical(y, num_columns):
-    """Returns one-hot encoded Variable"""
-    y_cat = np.zeros((y.shape[0], num_columns))
-    y_cat[range(y.shape[0]), y] = 1.
-
-    return Variable(FloatTensor(y_cat))
+def to_categorical(y, num_columns, key=None):
+    """Returns one-hot encoded tensor on the training device"""
+    return sampler.one_hot(torch.as_tensor(y), num_columns, key=key)
 
 
 class Generator(nn.Module):
@@ -172,15 +173,14 @@ LongTensor = torch.cuda.LongTensor if cuda else torch.LongTensor
 
 # Static generator inputs for sampling
 static_z = Variable(FloatTensor(np.zeros((opt.n_classes ** 2, opt.latent_dim))))
-static_label = to_categorical(np.array([num for _ in range(opt.n_classes) for num in range(opt.n_classes)]),
-                              num_columns=opt.n_classes)
+static_label = to_categorical(torch.arange(opt.n_classes).repeat(opt.n_classes), num_columns=opt.n_classes)
 static_code = Variable(FloatTensor(np.zeros((opt.n_classes ** 2, opt.code_dim))))
 
 
 def sample_image(n_row, batches_done):
     """Saves a grid of generated digits ranging from 0 to n_classes"""
     # Static sample
-    z = Variable(FloatTensor(np.random.normal(0, 1, (n_row ** 2, opt.latent_dim))))
+    z = sampler.normal((n_row ** 2, opt.latent_dim))
     static_sample = generator(z, static_label, static_code)
     save_image(static_sample.data, 'images/static/%d.png' % batches_done, nrow=n_row, normalize=True)
 
@@ -205,12 +205,12 @@ for epoch in range(opt.n_epochs):
         batch_size = imgs.shape[0]
 
         # Adversarial ground truths
-        valid = Variable(FloatTensor(batch_size, 1).fill_(1.0), requires_grad=False)
-        fake = Variable(FloatTensor(batch_size, 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((batch_size, 1))
+        fake = targets.zeros((batch_size, 1))
 
         # Configure input
         real_imgs = Variable(imgs.type(FloatTensor))
-        labels = to_categorical(labels.numpy(), num_columns=opt.n_classes)
+        labels = to_categorical(labels, num_columns=opt.n_classes, key='labels')
 
         # -----------------
         #  Train Generator
@@ -219,9 +219,10 @@ for epoch in range(opt.n_epochs):
         optimizer_G.zero_grad()
 
         # Sample noise and labels as generator input
-        z = Variable(FloatTensor(np.random.normal(0, 1, (batch_size, opt.latent_dim))))
-        label_input = to_categorical(np.random.randint(0, opt.n_classes, batch_size), num_columns=opt.n_classes)
-        code_input = Variable(FloatTensor(np.random.uniform(-1, 1, (batch_size, opt.code_dim))))
+        z = sampler.normal((batch_size, opt.latent_dim), key='z')
+        label_input = to_categorical(sampler.categorical(batch_size, opt.n_classes, key='labels_G'),
+                                     num_columns=opt.n_classes, key='label_input')
+        code_input = sampler.uniform((batch_size, opt.code_dim), -1, 1, key='code')
 
         # Generate a batch of images
         gen_imgs = generator(z, label_input, code_input)
@@ -260,15 +261,15 @@ for epoch in range(opt.n_epochs):
         optimizer_info.zero_grad()
 
         # Sample labels
-        sampled_labels = np.random.randint(0, opt.n_classes, batch_size)
+        sampled_labels = sampler.categorical(batch_size, opt.n_classes, key='labels_info')
 
         # Ground truth labels
-        gt_labels = Variable(LongTensor(sampled_labels), requires_grad=False)
+        gt_labels = sampled_labels
 
         # Sample noise, labels and code as generator input
-        z = Variable(FloatTensor(np.random.normal(0, 1, (batch_size, opt.latent_dim))))
-        label_input = to_categorical(sampled_labels, num_columns=opt.n_classes)
-        code_input = Variable(FloatTensor(np.random.normal(-1, 1, (batch_size, opt.code_dim))))
+        z = sampler.normal((batch_size, opt.latent_dim), key='z_info')
+        label_input = to_categorical(sampled_labels, num_columns=opt.n_classes, key='label_input_info')
+        code_input = sampler.normal((batch_size, opt.code_dim), mean=-1, key='code_info')
 
         gen_imgs = generator(z, label_input, code_input)
         _, pred_label, pred_code = discriminator(gen_imgs)
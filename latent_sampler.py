@@ -0,0 +1,59 @@
+import torch
+
+
+class LatentSampler(object):
+    """Samples generator inputs (noise, codes, labels) directly on the training device
+
+    Draws come from a seedable torch.Generator living on the device, so there is no host
+    RNG call or host-to-device copy per step. Passing a key makes the call fill a
+    buffer that is reused on every later call with the same key and shape; only reuse a
+    key once the tensors it returned earlier are no longer needed (e.g. after backward).
+    Calls without a key return freshly allocated tensors.
+    """
+
+    def __init__(self, device=None, seed=None, dtype=torch.float32):
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.dtype = dtype
+        self.generator = torch.Generator(device=self.device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+        self.buffers = {}
+
+    def _empty(self, shape, dtype, key):
+        shape = tuple(shape)
+        if key is None:
+            return torch.empty(shape, device=self.device, dtype=dtype)
+
+        buf = self.buffers.get((key, shape, dtype))
+        if buf is None:
+            buf = torch.empty(shape, device=self.device, dtype=dtype)
+            self.buffers[(key, shape, dtype)] = buf
+        return buf
+
+    def normal(self, shape, mean=0.0, std=1.0, key=None):
+        return self._empty(shape, self.dtype, key).normal_(mean, std, generator=self.generator)
+
+    def uniform(self, shape, low=0.0, high=1.0, key=None):
+        return self._empty(shape, self.dtype, key).uniform_(low, high, generator=self.generator)
+
+    def categorical(self, n, num_classes, key=None):
+        """n class indices drawn uniformly from [0, num_classes) as a LongTensor"""
+        return self._empty((n,), torch.long, key).random_(0, num_classes, generator=self.generator)
+
+    def bernoulli(self, shape, p=0.5, key=None):
+        """0/1 codes of the sampler dtype, each 1 with probability p"""
+        return self._empty(shape, self.dtype, key).bernoulli_(p, generator=self.generator)
+
+    def one_hot(self, labels, num_classes, key=None):
+        """One-hot encodes a LongTensor of class indices with a single scatter"""
+        labels = labels.to(self.device, non_blocking=True).long().view(-1, 1)
+        out = self._empty((labels.size(0), num_classes), self.dtype, key)
+        return out.zero_().scatter_(1, labels, 1)
+
+    def state_dict(self):
+        return {'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state_dict):
+        self.generator.set_state(state_dict['generator'])
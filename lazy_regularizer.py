@@ -0,0 +1,86 @@
+import time
+
+import torch
+
+
+class LazyRegularizer(object):
+    """Computes a regularization term (gradient penalty, R1) only on every interval-th call
+
+    On the calls where the penalty is computed its weight is multiplied by interval,
+    so it contributes to the updates as much on average as an every-step penalty,
+    while the other calls skip its extra discriminator forward and double backward.
+    The time spent in the penalty callable is recorded (with CUDA events on the GPU,
+    so no host sync per step; events are folded into the total as soon as the device
+    has passed them) and report() estimates how much the skipped calls saved.
+    The penalty's double backward runs later with the loss and is not timed, so the
+    estimate is a lower bound.
+    """
+
+    def __init__(self, weight, interval=1, device=None):
+        assert interval >= 1, 'Regularization interval must be at least 1, got %d' % interval
+        self.weight = weight
+        self.interval = interval
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.calls = 0
+        self.value = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.applied = 0
+        self.skipped = 0
+        self.seconds = 0.
+        self.events = []
+
+    def due(self):
+        """Whether the next call computes the penalty"""
+        return self.calls % self.interval == 0
+
+    def __call__(self, penalty):
+        """Returns weight * interval * penalty() when due, 0. without calling penalty otherwise"""
+        due = self.due()
+        self.calls += 1
+        if not due:
+            self.skipped += 1
+            return 0.
+
+        if self.device.type == 'cuda':
+            self._collect_events()
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            self.value = penalty()
+            end.record()
+            self.events.append((start, end))
+        else:
+            start = time.perf_counter()
+            self.value = penalty()
+            self.seconds += time.perf_counter() - start
+        self.applied += 1
+        return self.weight * self.interval * self.value
+
+    def _collect_events(self, wait=False):
+        """Adds the timings of the recorded events to seconds, waiting for the pending ones if wait"""
+        if wait and self.events:
+            self.events[-1][1].synchronize()
+        pending = []
+        for start, end in self.events:
+            # query() does not block, events still queued on the device are kept for later
+            if end.query():
+                self.seconds += start.elapsed_time(end) / 1000.
+            else:
+                pending.append((start, end))
+        self.events = pending
+
+    def report(self):
+        """Describes the penalties computed and the time saved since the last report"""
+        self._collect_events(wait=True)
+        per_call = self.seconds / self.applied if self.applied else 0.
+        line = "Penalty computed on %d of %d steps (%.1f ms each), about %.1fs saved" % (
+            self.applied, self.applied + self.skipped, per_call * 1000., per_call * self.skipped)
+        self._reset_stats()
+        return line
+
+    def state_dict(self):
+        return {'calls': self.calls}
+
+    def load_state_dict(self, state_dict):
+        self.calls = state_dict['calls']
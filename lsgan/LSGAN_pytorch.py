@@ -21,6 +21,8 @@ from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 os.makedirs('images', exist_ok=True)
 
@@ -39,6 +41,8 @@ opt = parser.parse_args()
 print(opt)
 
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 
 
 def weights_init_normal(m):
@@ -149,8 +153,8 @@ for epoch in range(opt.n_epochs):
     for i, (imgs, _) in enumerate(dataloader):
 
         # Adversarial ground truths
-        valid = Variable(Tensor(imgs.shape[0], 1).fill_(1.0), requires_grad=False)
-        fake = Variable(Tensor(imgs.shape[0], 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((imgs.shape[0], 1))
+        fake = targets.zeros((imgs.shape[0], 1))
 
         # Configure input
         real_imgs = Variable(imgs.type(Tensor))
@@ -162,7 +166,7 @@ for epoch in range(opt.n_epochs):
         optimizer_G.zero_grad()
 
         # Sample noise as generator input
-        z = Variable(Tensor(np.random.normal(0, 1, (imgs.shape[0], opt.latent_dim))))
+        z = sampler.normal((imgs.shape[0], opt.latent_dim), key='z')
 
         # Generate a batch of images
         gen_imgs = generator(z)
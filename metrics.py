@@ -0,0 +1,118 @@
+import csv
+import datetime
+import os
+import sys
+import time
+
+import torch
+
+
+class ConsoleSink(object):
+    """Writes a str.format template filled with the step, the metric means and the log context"""
+
+    def __init__(self, template, stream=None):
+        self.template = template
+        self.stream = stream
+
+    def __call__(self, step, values, context):
+        stream = self.stream or sys.stdout
+        stream.write(self.template.format(step=step, **dict(values, **context)))
+        stream.flush()
+
+
+class CsvSink(object):
+    """Appends one row per log step; the columns are fixed by the first row written"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fieldnames = None
+
+    def __call__(self, step, values, context):
+        row = dict(values, step=step)
+        if self.fieldnames is None:
+            self.fieldnames = ['step'] + list(values)
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, self.fieldnames, restval='', extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
+
+
+class TensorBoardSink(object):
+    """Adds every metric mean as a scalar summary (needs tensorboardX)"""
+
+    def __init__(self, log_dir):
+        from tensorboardX import SummaryWriter
+        self.writer = SummaryWriter(log_dir)
+
+    def __call__(self, step, values, context):
+        for name, value in values.items():
+            self.writer.add_scalar(name, value, step)
+
+
+class Metrics(object):
+    """Running means of training metrics that stay on the device between log steps
+
+    update() adds the detached loss tensors to per-name running sums without reading
+    them back, so an iteration that is not logged does not wait for the device. log()
+    copies all the sums to the host at once (a single sync), divides them by the
+    number of updates each name got, passes the means to every sink and starts over.
+    Sinks are callables sink(step, values, context); the context holds what only the
+    console line needs (epoch, batch, ETA). Call tick() once per training iteration and
+    pass remaining=<iterations left> to log() for an ETA measured over the whole
+    interval rather than the last iteration; update() may be called any number of
+    times per iteration (e.g. separately for D and G).
+    """
+
+    def __init__(self, console=None, csv_path=None, log_dir=None):
+        self.sinks = []
+        if console is not None:
+            self.sinks.append(ConsoleSink(console))
+        if csv_path is not None:
+            self.sinks.append(CsvSink(csv_path))
+        if log_dir is not None:
+            self.sinks.append(TensorBoardSink(log_dir))
+        self.last_time = None
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+        self.iterations = 0
+
+    def update(self, **values):
+        if self.last_time is None:
+            self.last_time = time.time()
+        for name, value in values.items():
+            if torch.is_tensor(value):
+                value = value.detach().float()
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def tick(self):
+        """Marks the end of one training iteration, for the ETA"""
+        if self.last_time is None:
+            self.last_time = time.time()
+        self.iterations += 1
+
+    def compute(self):
+        """The current means as Python floats, read back from the device in one copy"""
+        names = [name for name, value in self.sums.items() if torch.is_tensor(value)]
+        means = dict(self.sums)
+        if names:
+            means.update(zip(names, torch.stack([self.sums[name] for name in names]).tolist()))
+        return {name: float(value) / self.counts[name] for name, value in means.items()}
+
+    def log(self, step, remaining=None, **context):
+        """Hands the means since the last log to the sinks and returns them"""
+        values = self.compute()
+        now = time.time()
+        if remaining is not None:
+            per_iteration = (now - self.last_time) / max(self.iterations, 1)
+            context['eta'] = datetime.timedelta(seconds=remaining * per_iteration)
+        self.last_time = now
+        for sink in self.sinks:
+            sink(step, values, context)
+        self.reset()
+        return values
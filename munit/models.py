@@ -46,9 +46,11 @@ class Encoder(nn.Module):
 #################################
 
 class Decoder(nn.Module):
-    def __init__(self, out_channels=3, dim=64, n_residual=3, n_upsample=2, style_dim=8):
+    def __init__(self, out_channels=3, dim=64, n_residual=3, n_upsample=2, style_dim=8, layer_norm='fused'):
         super(Decoder, self).__init__()
 
+        norm_layer = FusedLayerNorm if layer_norm == 'fused' else LayerNorm
+
         layers = []
         dim = dim * 2 ** n_upsample
         # Residual blocks
@@ -59,7 +61,7 @@ class Decoder(nn.Module):
         for _ in range(n_upsample):
             layers += [nn.Upsample(scale_factor=2),
                        nn.Conv2d(dim, dim // 2, 5, stride=1, padding=2),
-                       LayerNorm(dim // 2),
+                       norm_layer(dim // 2),
                        nn.ReLU(inplace=True)]
             dim = dim // 2
 
@@ -70,31 +72,27 @@ class Decoder(nn.Module):
 
         self.model = nn.Sequential(*layers)
 
+        # Widths of the mean and std of each AdaIN layer in the MLP output, in model order
+        self.adain_sizes = [n for m in self.adain_layers() for n in (m.num_features, m.num_features)]
+
         # Initiate mlp (predicts AdaIN parameters)
         num_adain_params = self.get_num_adain_params()
         self.mlp = MLP(style_dim, num_adain_params)
 
+    def adain_layers(self):
+        return [m for m in self.model.modules() if isinstance(m, AdaptiveInstanceNorm2d)]
+
     def get_num_adain_params(self):
         """Return the number of AdaIN parameters needed by the model"""
-        num_adain_params = 0
-        for m in self.modules():
-            if m.__class__.__name__ == "AdaptiveInstanceNorm2d":
-                num_adain_params += 2 * m.num_features
-        return num_adain_params
+        return sum(self.adain_sizes)
 
     def assign_adain_params(self, adain_params):
         """Assign the adain_params to the AdaIN layers in model"""
-        for m in self.modules():
-            if m.__class__.__name__ == "AdaptiveInstanceNorm2d":
-                # Extract mean and std predictions
-                mean = adain_params[:, :m.num_features]
-                std = adain_params[:, m.num_features:2 * m.num_features]
-                # Update bias and weight
-                m.bias = mean.contiguous().view(-1)
-                m.weight = std.contiguous().view(-1)
-                # Move pointer
-                if adain_params.size(1) > 2 * m.num_features:
-                    adain_params = adain_params[:, 2 * m.num_features:]
+        # One split into (batch, num_features) views, no per-layer slicing or copies
+        params = adain_params.split(self.adain_sizes, dim=1)
+        for m, mean, std in zip(self.adain_layers(), params[0::2], params[1::2]):
+            m.bias = mean
+            m.weight = std
 
     def forward(self, content_code, style_code):
         # Update AdaIN parameters by MLP prediction based off style code
@@ -219,6 +217,20 @@ class MultiDiscriminator(nn.Module):
         loss = sum([torch.mean((out - gt) ** 2) for out in self.forward(x)])
         return loss
 
+    def compute_losses(self, real, fake, real_gt=1, fake_gt=0):
+        """compute_loss(real, real_gt) and compute_loss(fake, fake_gt) from one pass over both
+
+        The two batches are concatenated, so the input pyramid is pooled once and each
+        scale runs once. The scales normalize per sample (InstanceNorm), so the losses
+        are the same as from two separate calls.
+        """
+        n = real.size(0)
+        loss_real, loss_fake = 0, 0
+        for out in self.forward(torch.cat((real, fake))):
+            loss_real = loss_real + torch.mean((out[:n] - real_gt) ** 2)
+            loss_fake = loss_fake + torch.mean((out[n:] - fake_gt) ** 2)
+        return loss_real, loss_fake
+
     def forward(self, x):
         outputs = []
         for m in self.models:
@@ -256,7 +268,12 @@ class ResidualBlock(nn.Module):
 ##############################
 
 class AdaptiveInstanceNorm2d(nn.Module):
-    """Reference: https://github.com/NVlabs/MUNIT/blob/master/networks.py"""
+    """Reference: https://github.com/NVlabs/MUNIT/blob/master/networks.py
+
+    weight and bias hold one scale/shift per sample and channel, shaped (batch, num_features)
+    (or flattened). Each sample is normalized with its own statistics by the native instance
+    norm and the style affine is applied with a single addcmul.
+    """
 
     def __init__(self, num_features, eps=1e-5, momentum=0.1):
         super(AdaptiveInstanceNorm2d, self).__init__()
@@ -266,24 +283,18 @@ class AdaptiveInstanceNorm2d(nn.Module):
         # weight and bias are dynamically assigned
         self.weight = None
         self.bias = None
-        # just dummy buffers, not used
+        # just dummy buffers, not used (kept so existing checkpoints load)
         self.register_buffer('running_mean', torch.zeros(num_features))
         self.register_buffer('running_var', torch.ones(num_features))
 
     def forward(self, x):
         assert self.weight is not None and self.bias is not None, "Please assign weight and bias before calling AdaIN!"
         b, c, h, w = x.size()
-        running_mean = self.running_mean.repeat(b)
-        running_var = self.running_var.repeat(b)
 
         # Apply instance norm
-        x_reshaped = x.contiguous().view(1, b * c, h, w)
-
-        out = F.batch_norm(
-            x_reshaped, running_mean, running_var, self.weight, self.bias,
-            True, self.momentum, self.eps)
+        out = F.instance_norm(x, eps=self.eps)
 
-        return out.view(b, c, h, w)
+        return torch.addcmul(self.bias.reshape(b, c, 1, 1), out, self.weight.reshape(b, c, 1, 1))
 
     def __repr__(self):
         return self.__class__.__name__ + '(' + str(self.num_features) + ')'
@@ -310,3 +321,53 @@ class LayerNorm(nn.Module):
             shape = [1, -1] + [1] * (x.dim() - 2)
             x = x * self.gamma.view(*shape) + self.beta.view(*shape)
         return x
+
+
+class FusedLayerNorm(LayerNorm):
+    """LayerNorm with the same parameters and output in one reduction and one elementwise pass
+
+    The per-sample mean and (unbiased) std come from a single Welford pass (std_mean),
+    and the normalization and affine are folded into a per-sample, per-channel scale and
+    shift applied with one addcmul, so no full-size temporaries besides the output are
+    allocated (and saved for backward) per call.
+    """
+
+    def forward(self, x):
+        b, c = x.size(0), x.size(1)
+        shape = (b,) + (1,) * (x.dim() - 1)
+        std, mean = torch.std_mean(x.reshape(b, -1), dim=1)
+        scale = (1 / (std + self.eps)).view(shape)
+        shift = -mean.view(shape) * scale
+
+        if self.affine:
+            gamma = self.gamma.view((1, c) + (1,) * (x.dim() - 2))
+            beta = self.beta.view((1, c) + (1,) * (x.dim() - 2))
+            scale = scale * gamma
+            shift = shift * gamma + beta
+        return torch.addcmul(shift, x, scale)
+
+
+if __name__ == '__main__':
+    # Times LayerNorm against FusedLayerNorm (forward + backward) on decoder-sized activations
+    import time
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    x = torch.randn(8, 128, 128, 128, device=device, requires_grad=True)
+    reference, fused = LayerNorm(128).to(device), FusedLayerNorm(128).to(device)
+    fused.load_state_dict(reference.state_dict())
+    print("Max abs difference: %g" % (reference(x) - fused(x)).abs().max().item())
+
+    for name, norm in (('LayerNorm', reference), ('FusedLayerNorm', fused)):
+        for step in range(25):
+            if step == 5:
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                start = time.perf_counter()
+            norm(x).sum().backward()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        line = "%s: %.2f ms" % (name, (time.perf_counter() - start) / 20 * 1000)
+        if device == 'cuda':
+            line += ", peak %.0f MB" % (torch.cuda.max_memory_allocated() / 2 ** 20)
+        print(line)
@@ -20,12 +20,18 @@ from datasets import *
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from weighted_losses import WeightedLosses
+from grad_accumulation import GradientAccumulator
+from precision import Precision
+from checkpoint_manager import CheckpointManager
+from metrics import Metrics
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--epoch', type=int, default=0, help='epoch to start training from')
 parser.add_argument('--n_epochs', type=int, default=200, help='number of epochs of training')
 parser.add_argument('--dataset_name', type=str, default="edges2shoes", help='name of the dataset')
 parser.add_argument('--batch_size', type=int, default=1, help='size of the batches')
+parser.add_argument('--micro_batch_size', type=int, default=0, help='samples per forward/backward pass, 0 picks the largest that fits in memory')
 parser.add_argument('--lr', type=float, default=0.0001, help='adam: learning rate')
 parser.add_argument('--b1', type=float, default=0.5, help='adam: decay of first order momentum of gradient')
 parser.add_argument('--b2', type=float, default=0.999, help='adam: decay of first order momentum of gradient')
@@ -36,14 +42,21 @@ parser.add_argument('--img_width', type=int, default=128, help='size of image wi
 parser.add_argument('--channels', type=int, default=3, help='number of image channels')
 parser.add_argument('--sample_interval', type=int, default=400, help='interval between sampling images from generators')
 parser.add_argument('--checkpoint_interval', type=int, default=-1, help='interval between saving model checkpoints')
+parser.add_argument('--log_interval', type=int, default=20, help='interval between printing the running mean losses (each print waits for the device)')
+parser.add_argument('--metrics_csv', type=str, default=None, help='also append the logged losses to this CSV file')
+parser.add_argument('--tensorboard_dir', type=str, default=None, help='also write the logged losses as TensorBoard scalars (needs tensorboardX)')
+parser.add_argument('--keep_checkpoints', type=int, default=0, help='number of most recent checkpoints to keep, 0 keeps all')
 parser.add_argument('--n_downsample', type=int, default=2, help='number downsampling layers in encoder')
 parser.add_argument('--n_residual', type=int, default=3, help='number of residual blocks in encoder / decoder')
 parser.add_argument('--dim', type=int, default=64, help='number of filters in first encoder layer')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='precision of the forward passes (bf16/fp16 run under autocast)')
 parser.add_argument('--style_dim', type=int, default=8, help='dimensionality of the style code')
+parser.add_argument('--layer_norm', type=str, default='fused', choices=['fused', 'reference'], help='decoder layer norm: single-pass fused or the original two-reduction one')
 opt = parser.parse_args()
 print(opt)
 
 cuda = True if torch.cuda.is_available() else False
+amp = Precision(opt.precision, device='cuda' if cuda else 'cpu')
 
 # Create sample and checkpoint directories
 os.makedirs('images/%s' % opt.dataset_name, exist_ok=True)
@@ -53,9 +66,11 @@ criterion_recon = torch.nn.L1Loss()
 
 # Initialize encoders, generators and discriminators
 Enc1 = Encoder(dim=opt.dim, n_downsample=opt.n_downsample, n_residual=opt.n_residual, style_dim=opt.style_dim)
-Dec1 = Decoder(dim=opt.dim, n_upsample=opt.n_downsample, n_residual=opt.n_residual, style_dim=opt.style_dim)
+Dec1 = Decoder(dim=opt.dim, n_upsample=opt.n_downsample, n_residual=opt.n_residual, style_dim=opt.style_dim,
+               layer_norm=opt.layer_norm)
 Enc2 = Encoder(dim=opt.dim, n_downsample=opt.n_downsample, n_residual=opt.n_residual, style_dim=opt.style_dim)
-Dec2 = Decoder(dim=opt.dim, n_upsample=opt.n_downsample, n_residual=opt.n_residual, style_dim=opt.style_dim)
+Dec2 = Decoder(dim=opt.dim, n_upsample=opt.n_downsample, n_residual=opt.n_residual, style_dim=opt.style_dim,
+               layer_norm=opt.layer_norm)
 D1 = MultiDiscriminator()
 D2 = MultiDiscriminator()
 
@@ -68,15 +83,7 @@ if cuda:
     D2 = D2.cuda()
     criterion_recon.cuda()
 
-if opt.epoch != 0:
-    # Load pretrained models
-    Enc1.load_state_dict(torch.load('saved_models/%s/Enc1_%d.pth' % (opt.dataset_name, opt.epoch)))
-    Dec1.load_state_dict(torch.load('saved_models/%s/Dec1_%d.pth' % (opt.dataset_name, opt.epoch)))
-    Enc2.load_state_dict(torch.load('saved_models/%s/Enc2_%d.pth' % (opt.dataset_name, opt.epoch)))
-    Dec2.load_state_dict(torch.load('saved_models/%s/Dec2_%d.pth' % (opt.dataset_name, opt.epoch)))
-    D1.load_state_dict(torch.load('saved_models/%s/D1_%d.pth' % (opt.dataset_name, opt.epoch)))
-    D2.load_state_dict(torch.load('saved_models/%s/D2_%d.pth' % (opt.dataset_name, opt.epoch)))
-else:
+if opt.epoch == 0:
     # Initialize weights
     Enc1.apply(weights_init_normal)
     Dec1.apply(weights_init_normal)
@@ -92,6 +99,15 @@ lambda_style    = 1
 lambda_cont     = 1
 lambda_cyc      = 0
 
+# Generator loss terms; terms with zero weight are not computed at all
+g_losses = WeightedLosses()
+g_losses.add('GAN', lambda_gan)
+g_losses.add('ID', lambda_id, passes='Dec1(c_code_1, s_code_1), Dec2(c_code_2, s_code_2)')
+g_losses.add('style', lambda_style)
+g_losses.add('content', lambda_cont)
+g_losses.add('cycle', lambda_cyc, passes='Dec1(c_code_12, s_code_1), Dec2(c_code_21, s_code_2)')
+print(g_losses.summary(opt.epoch))
+
 # Optimizers
 optimizer_G = torch.optim.Adam(itertools.chain(Enc1.parameters(), Dec1.parameters(), Enc2.parameters(), Dec2.parameters()),
                                 lr=opt.lr, betas=(opt.b1, opt.b2))
@@ -103,6 +119,17 @@ lr_scheduler_G = torch.optim.lr_scheduler.LambdaLR(optimizer_G, lr_lambda=Lambda
 lr_scheduler_D1 = torch.optim.lr_scheduler.LambdaLR(optimizer_D1, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
 lr_scheduler_D2 = torch.optim.lr_scheduler.LambdaLR(optimizer_D2, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch, opt.decay_epoch).step)
 
+# Everything a checkpoint holds. The LR schedulers are rebuilt from --epoch instead
+# (LambdaLR offsets the decay by it)
+state = dict(Enc1=Enc1, Dec1=Dec1, Enc2=Enc2, Dec2=Dec2, D1=D1, D2=D2, optimizer_G=optimizer_G,
+             optimizer_D1=optimizer_D1, optimizer_D2=optimizer_D2, amp=amp)
+
+checkpoints = CheckpointManager('saved_models/%s' % opt.dataset_name, keep=opt.keep_checkpoints,
+                                legacy='{name}_{step}.pth')
+if opt.epoch != 0:
+    # Load pretrained models
+    checkpoints.restore(opt.epoch, **state)
+
 Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
 
 # Configure dataloaders
@@ -120,24 +147,65 @@ val_dataloader = DataLoader(ImageDataset("../../data/%s" % opt.dataset_name, tra
 def sample_images(batches_done):
     """Saves a generated sample from the validation set"""
     imgs = next(iter(val_dataloader))
-    img_samples = None
-    for img1, img2 in zip(imgs['A'], imgs['B']):
-        # Create copies of image
-        X1 = img1.unsqueeze(0).repeat(opt.style_dim, 1, 1, 1)
-        X1 = Variable(X1.type(Tensor))
+    with torch.no_grad():
+        X1 = Variable(imgs['A'].type(Tensor))
+        n = X1.size(0)
+        # Encode each image once and pair its content code with every style code
+        c_code_1, _ = Enc1(X1)
+        c_code_1 = c_code_1.repeat_interleave(opt.style_dim, dim=0)
         # Get interpolated style codes
         s_code = np.repeat(np.linspace(-1, 1, opt.style_dim)[:, np.newaxis], opt.style_dim, 1)
-        s_code = Variable(Tensor(s_code))
-        # Generate samples
-        c_code_1, _ = Enc1(X1)
-        X12 = Dec2(c_code_1, s_code)
-        # Concatenate samples horisontally
-        X12 = torch.cat([x for x in X12.data.cpu()], -1)
-        img_sample = torch.cat((img1, X12), -1).unsqueeze(0)
-        # Concatenate with previous samples vertically
-        img_samples = img_sample if img_samples is None else torch.cat((img_samples, img_sample), -2)
+        s_code = Tensor(s_code).repeat(n, 1)
+        # Generate all samples in one decoder pass
+        X12 = Dec2(c_code_1, s_code).view(n, opt.style_dim, *X1.shape[1:])
+    # One row per image: the image followed by its samples horizontally, rows stacked vertically
+    img_samples = torch.cat((X1.unsqueeze(1), X12), 1).permute(2, 0, 3, 1, 4)
+    img_samples = img_samples.reshape(1, X1.size(1), n * X1.size(2), -1).cpu()
     save_image(img_samples, 'images/%s/%s.png' % (opt.dataset_name, batches_done), nrow=5, normalize=True)
 
+accum = GradientAccumulator(opt.micro_batch_size, precision=amp)
+
+
+def generator_step(X1, X2, style_1, style_2):
+    """Encoder/generator forward and backward passes over one micro-batch"""
+    with amp.autocast():
+        # Get shared latent representation
+        c_code_1, s_code_1 = Enc1(X1)
+        c_code_2, s_code_2 = Enc2(X2)
+
+        # Translate images
+        X21 = Dec1(c_code_2, style_1)
+        X12 = Dec2(c_code_1, style_2)
+
+        # Encode translations, shared by the style, content and cycle terms
+        if g_losses.active('style', epoch) or g_losses.active('content', epoch) or g_losses.active('cycle', epoch):
+            c_code_21, s_code_21 = Enc1(X21)
+            c_code_12, s_code_12 = Enc2(X12)
+
+        # Losses
+        loss_G, terms = g_losses.compute({
+            'GAN': lambda: D1.compute_loss(X21, valid) + D2.compute_loss(X12, valid),
+            'ID': lambda: criterion_recon(Dec1(c_code_1, s_code_1), X1) + criterion_recon(Dec2(c_code_2, s_code_2), X2),
+            'style': lambda: criterion_recon(s_code_12, style_1) + criterion_recon(s_code_21, style_2),
+            'content': lambda: criterion_recon(c_code_12, c_code_1.detach()) + criterion_recon(c_code_21, c_code_2.detach()),
+            'cycle': lambda: criterion_recon(Dec1(c_code_12, s_code_1), X1) + criterion_recon(Dec2(c_code_21, s_code_2), X2),
+        }, step=epoch)
+
+    accum.backward(loss_G)
+    return {'G': loss_G, 'X21': X21.detach(), 'X12': X12.detach()}
+
+
+def discriminator_step(D, X, X_fake):
+    """Discriminator forward and backward passes over one micro-batch"""
+    with amp.autocast():
+        # Real and fake go through the discriminator scales together
+        loss_real, loss_fake = D.compute_losses(X, X_fake, valid, fake)
+        loss_D = loss_real + loss_fake
+
+    accum.backward(loss_D)
+    return {'D': loss_D}
+
+
 # ----------
 #  Training
 # ----------
@@ -146,7 +214,9 @@ def sample_images(batches_done):
 valid = 1
 fake = 0
 
-prev_time = time.time()
+metrics = Metrics("\r[Epoch {epoch}/{n_epochs}] [Batch {batch}/{n_batches}] [D loss: {D:f}] [G loss: {G:f}] ETA: {eta}",
+                  csv_path=opt.metrics_csv, log_dir=opt.tensorboard_dir)
+
 for epoch in range(opt.epoch, opt.n_epochs):
     for i, batch in enumerate(dataloader):
 
@@ -163,99 +233,50 @@ for epoch in range(opt.epoch, opt.n_epochs):
         # -------------------------------
 
         optimizer_G.zero_grad()
-
-        # Get shared latent representation
-        c_code_1, s_code_1 = Enc1(X1)
-        c_code_2, s_code_2 = Enc2(X2)
-
-        # Reconstruct images
-        X11 = Dec1(c_code_1, s_code_1)
-        X22 = Dec2(c_code_2, s_code_2)
-
-        # Translate images
-        X21 = Dec1(c_code_2, style_1)
-        X12 = Dec2(c_code_1, style_2)
-
-        # Cycle translation
-        c_code_21, s_code_21 = Enc1(X21)
-        c_code_12, s_code_12 = Enc2(X12)
-        X121 = Dec1(c_code_12, s_code_1) if lambda_cyc > 0 else 0
-        X212 = Dec2(c_code_21, s_code_2) if lambda_cyc > 0 else 0
-
-        # Losses
-        loss_GAN_1  = lambda_gan    * D1.compute_loss(X21, valid)
-        loss_GAN_2  = lambda_gan    * D2.compute_loss(X12, valid)
-        loss_ID_1   = lambda_id     * criterion_recon(X11, X1)
-        loss_ID_2   = lambda_id     * criterion_recon(X22, X2)
-        loss_s_1    = lambda_style  * criterion_recon(s_code_12, style_1)
-        loss_s_2    = lambda_style  * criterion_recon(s_code_21, style_2)
-        loss_c_1    = lambda_cont   * criterion_recon(c_code_12, c_code_1.detach())
-        loss_c_2    = lambda_cont   * criterion_recon(c_code_21, c_code_2.detach())
-        loss_cyc_1  = lambda_cyc    * criterion_recon(X121, X1) if lambda_cyc > 0 else 0
-        loss_cyc_2  = lambda_cyc    * criterion_recon(X212, X2) if lambda_cyc > 0 else 0
-
-        # Total loss
-        loss_G =    loss_GAN_1 + \
-                    loss_GAN_2 + \
-                    loss_ID_1 + \
-                    loss_ID_2 + \
-                    loss_s_1 + \
-                    loss_s_2 + \
-                    loss_c_1 + \
-                    loss_c_2 + \
-                    loss_cyc_1 + \
-                    loss_cyc_2
-
-        loss_G.backward()
-        optimizer_G.step()
+        outputs = accum.run(generator_step, X1, X2, style_1, style_2, optimizers=[optimizer_G])
+        loss_G, X21, X12 = outputs['G'], outputs['X21'], outputs['X12']
+        amp.step(optimizer_G)
 
         # -----------------------
         #  Train Discriminator 1
         # -----------------------
 
         optimizer_D1.zero_grad()
-
-        loss_D1 =   D1.compute_loss(X1, valid) + \
-                    D1.compute_loss(X21.detach(), fake)
-
-        loss_D1.backward()
-        optimizer_D1.step()
+        loss_D1 = accum.run(lambda X, X_fake: discriminator_step(D1, X, X_fake),
+                            X1, X21, optimizers=[optimizer_D1])['D']
+        amp.step(optimizer_D1)
 
         # -----------------------
         #  Train Discriminator 2
         # -----------------------
 
         optimizer_D2.zero_grad()
-
-        loss_D2 =   D2.compute_loss(X2, valid) + \
-                    D2.compute_loss(X12.detach(), fake)
-
-        loss_D2.backward()
-        optimizer_D2.step()
+        loss_D2 = accum.run(lambda X, X_fake: discriminator_step(D2, X, X_fake),
+                            X2, X12, optimizers=[optimizer_D2])['D']
+        amp.step(optimizer_D2)
+        amp.update()
 
         # --------------
         #  Log Progress
         # --------------
 
-        # Determine approximate time left
+        metrics.update(D=loss_D1 + loss_D2, G=loss_G)
+        metrics.tick()
+
+        # Print log, with the approximate time left
         batches_done = epoch * len(dataloader) + i
-        batches_left = opt.n_epochs * len(dataloader) - batches_done
-        time_left = datetime.timedelta(seconds=batches_left * (time.time() - prev_time))
-        prev_time = time.time()
-
-        # Print log
-        sys.stdout.write("\r[Epoch %d/%d] [Batch %d/%d] [D loss: %f] [G loss: %f] ETA: %s" %
-                                                        (epoch, opt.n_epochs,
-                                                        i, len(dataloader),
-                                                        (loss_D1 + loss_D2).item(),
-                                                        loss_G.item(),
-                                                        time_left))
+        if batches_done % opt.log_interval == 0:
+            metrics.log(batches_done, remaining=opt.n_epochs * len(dataloader) - batches_done,
+                        epoch=epoch, n_epochs=opt.n_epochs, batch=i, n_batches=len(dataloader))
 
         # If at sample interval save image
         if batches_done % opt.sample_interval == 0:
             sample_images(batches_done)
 
 
+    if g_losses.elided:
+        print(g_losses.report())
+
     # Update learning rates
     lr_scheduler_G.step()
     lr_scheduler_D1.step()
@@ -263,9 +284,6 @@ for epoch in range(opt.epoch, opt.n_epochs):
 
     if opt.checkpoint_interval != -1 and epoch % opt.checkpoint_interval == 0:
         # Save model checkpoints
-        torch.save(Enc1.state_dict(), 'saved_models/%s/Enc1_%d.pth' % (opt.dataset_name, epoch))
-        torch.save(Dec1.state_dict(), 'saved_models/%s/Dec1_%d.pth' % (opt.dataset_name, epoch))
-        torch.save(Enc2.state_dict(), 'saved_models/%s/Enc2_%d.pth' % (opt.dataset_name, epoch))
-        torch.save(Dec2.state_dict(), 'saved_models/%s/Dec2_%d.pth' % (opt.dataset_name, epoch))
-        torch.save(D1.state_dict(), 'saved_models/%s/D1_%d.pth' % (opt.dataset_name, epoch))
-        torch.save(D2.state_dict(), 'saved_models/%s/D2_%d.pth' % (opt.dataset_name, epoch))
+        checkpoints.save(epoch, **state)
+
+checkpoints.close()
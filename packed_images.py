@@ -0,0 +1,112 @@
+import glob
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from PIL import Image
+
+
+def domain_name(domain, mode, split_dirs=True):
+    """Folder (and packed file prefix) of a domain: '<mode><domain>', or just '<domain>' for unsplit datasets"""
+    return '%s%s' % (mode, domain) if split_dirs else domain
+
+
+def pack_domain(files, out_prefix, base_size):
+    """Decodes every image of a domain once into a uint8 (N, H, W, 3) memory-mapped array
+
+    Writes '<out_prefix>.npy' and '<out_prefix>_index.txt' (one source file per row).
+    """
+    data = np.lib.format.open_memmap(out_prefix + '.npy', mode='w+', dtype=np.uint8,
+                                     shape=(len(files), base_size, base_size, 3))
+    for i, path in enumerate(files):
+        img = Image.open(path).convert('RGB').resize((base_size, base_size), Image.BICUBIC)
+        data[i] = np.asarray(img, dtype=np.uint8)
+    data.flush()
+    del data
+
+    with open(out_prefix + '_index.txt', 'w') as f:
+        f.write('\n'.join(files))
+
+
+def pack_dataset(root, out_dir, base_size, mode='train', split_dirs=True):
+    """Packs both domains of a '<mode>A' / '<mode>B' split (or 'A' / 'B' folders) for PackedImageDataset"""
+    os.makedirs(out_dir, exist_ok=True)
+    for domain in ('A', 'B'):
+        name = domain_name(domain, mode, split_dirs)
+        files = sorted(glob.glob(os.path.join(root, name) + '/*.*'))
+        pack_domain(files, os.path.join(out_dir, name), base_size)
+        print("Packed %d images of domain %s" % (len(files), domain))
+
+
+class PackedImageDataset(Dataset):
+    """Unaligned ImageDataset served from the arrays written by pack_dataset
+
+    Random crops and horizontal flips are taken straight from the memmap, so no JPEG
+    decoding or PIL resampling happens in the data loader workers. Outputs are
+    normalized to [-1, 1] like the Normalize((0.5,)*3, (0.5,)*3) pipeline. With
+    split_dirs=False the arrays are 'A.npy' / 'B.npy' whatever the mode, and
+    swap_domains returns domain A under 'B' and vice versa.
+    """
+    def __init__(self, root, crop_size, unaligned=True, mode='train', flip=True, split_dirs=True,
+                 swap_domains=False):
+        self.unaligned = unaligned
+        self.crop_size = crop_size
+        self.flip = flip
+        self.keys = ('B', 'A') if swap_domains else ('A', 'B')
+
+        self.path_A = os.path.join(root, domain_name('A', mode, split_dirs) + '.npy')
+        self.path_B = os.path.join(root, domain_name('B', mode, split_dirs) + '.npy')
+        # Opened lazily so every worker maps the file itself instead of pickling the array
+        self.data_A = None
+        self.data_B = None
+        self.len_A = np.load(self.path_A, mmap_mode='r').shape[0]
+        self.len_B = np.load(self.path_B, mmap_mode='r').shape[0]
+
+        print("Total images in domain A: %d" % self.len_A)
+        print("Total images in domain B: %d" % self.len_B)
+
+    def _sample(self, data, index):
+        h, w = self.crop_size
+        top = random.randint(0, data.shape[1] - h)
+        left = random.randint(0, data.shape[2] - w)
+        img = data[index, top:top + h, left:left + w]
+        if self.flip and random.random() < 0.5:
+            img = img[:, ::-1]
+        img = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+        return img.float().div_(127.5).sub_(1)
+
+    def __getitem__(self, index):
+        if self.data_A is None:
+            self.data_A = np.load(self.path_A, mmap_mode='r')
+            self.data_B = np.load(self.path_B, mmap_mode='r')
+
+        item_A = self._sample(self.data_A, index % self.len_A)
+
+        if self.unaligned:
+            item_B = self._sample(self.data_B, random.randint(0, self.len_B - 1))
+        else:
+            item_B = self._sample(self.data_B, index % self.len_B)
+
+        return {self.keys[0]: item_A, self.keys[1]: item_B}
+
+    def __len__(self):
+        return max(self.len_A, self.len_B)
+
+
+def pack_main(base_size, split_dirs=True):
+    """Command line packer, run from the __main__ block of a trainer's datasets.py"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pack an unaligned image dataset into uint8 memmaps')
+    parser.add_argument('--root', type=str, required=True,
+                        help='dataset root containing %s' % ('<mode>A and <mode>B' if split_dirs else 'A and B'))
+    parser.add_argument('--out_dir', type=str, required=True, help='directory to write the packed arrays to')
+    parser.add_argument('--base_size', type=int, default=base_size, help='resolution images are stored at')
+    if split_dirs:
+        parser.add_argument('--modes', type=str, nargs='+', default=['train', 'test'], help='splits to pack')
+    opt = parser.parse_args()
+
+    for mode in (opt.modes if split_dirs else ['train']):
+        pack_dataset(opt.root, opt.out_dir, opt.base_size, mode, split_dirs)
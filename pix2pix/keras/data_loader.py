@@ -1,45 +1,75 @@
-import scipy.misc
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-import skimage
+from PIL import Image
+
+from prefetcher import Prefetcher
 
 
 class DataLoader():
-    def __init__(self, dataset_name, img_res=(128, 128)):
+    def __init__(self, dataset_name, img_res=(128, 128), n_workers=4):
         self.dataset_name = dataset_name
         self.img_res = img_res
+        self.n_workers = n_workers
+        self.paths = {}
+
+    def get_paths(self, data_type):
+        # The split is globbed once and reused for every batch
+        if data_type not in self.paths:
+            self.paths[data_type] = sorted(glob('E:\\Datasets\\'+self.dataset_name+'\\'+data_type+'\\*'))
+        return self.paths[data_type]
+
+    def load_pair(self, img_path, is_testing=False):
+        img = self.imread(img_path)
+
+        w, h = img.size
+        _w = int(w / 2)
+        img_A = self.imresize(img.crop((0, 0, _w, h)))
+        img_B = self.imresize(img.crop((_w, 0, w, h)))
+
+        # If training => do random flip
+        if not is_testing and np.random.random() < 0.5:
+            img_A = img_A[:, ::-1]
+            img_B = img_B[:, ::-1]
+
+        return img_A, img_B
 
     def load_data(self, batch_size=1, is_testing=False):
         data_type = "train" if not is_testing else "test"
-        path = glob('E:\\Datasets\\'+self.dataset_name+'\\'+data_type+'\\*')
-
-        batch_images = np.random.choice(path, size=batch_size)
+        batch_images = np.random.choice(self.get_paths(data_type), size=batch_size)
 
-        imgs_A = []
-        imgs_B = []
-        for img_path in batch_images:
-            img = self.imread(img_path)
+        return self.collate([self.load_pair(img_path, is_testing) for img_path in batch_images])
 
-            h, w, _ = img.shape
-            _w = int(w / 2)
-            img_A, img_B = img[:, :_w, :], img[:, _w:, :]
+    def stream(self, batch_size=1, is_testing=False, prefetch=8):
+        """Endless iterator of (imgs_A, imgs_B) batches
 
-            img_A = scipy.misc.imresize(img_A, self.img_res)
-            img_B = scipy.misc.imresize(img_B, self.img_res)
+        The split is reshuffled every epoch and images are decoded on n_workers threads
+        ahead of the training loop, with at most `prefetch` batches queued.
+        """
+        data_type = "train" if not is_testing else "test"
+        paths = self.get_paths(data_type)
+        if len(paths) < batch_size:
+            # Only full batches are drawn, so the stream would never yield
+            raise ValueError("%s has %d images, fewer than batch_size=%d" % (data_type, len(paths), batch_size))
 
-            # If training => do random flip
-            if not is_testing and np.random.random() < 0.5:
-                img_A = np.fliplr(img_A)
-                img_B = np.fliplr(img_B)
+        def batches():
+            with ThreadPoolExecutor(self.n_workers) as pool:
+                while True:
+                    order = np.random.permutation(len(paths))
+                    for start in range(0, len(order) - batch_size + 1, batch_size):
+                        batch_images = [paths[i] for i in order[start:start + batch_size]]
+                        yield self.collate(list(pool.map(lambda p: self.load_pair(p, is_testing), batch_images)))
 
-            imgs_A.append(img_A)
-            imgs_B.append(img_B)
+        return Prefetcher(batches(), prefetch)
 
-        imgs_A = np.array(imgs_A) / 127.5 - 1.
-        imgs_B = np.array(imgs_B) / 127.5 - 1.
+    def collate(self, pairs):
+        imgs_A = np.stack([img_A for img_A, _ in pairs]).astype(np.float32) / 127.5 - 1.
+        imgs_B = np.stack([img_B for _, img_B in pairs]).astype(np.float32) / 127.5 - 1.
 
         return imgs_A, imgs_B
 
+    def imresize(self, img):
+        return np.asarray(img.resize((self.img_res[1], self.img_res[0]), Image.BILINEAR))
+
     def imread(self, path):
-        return scipy.misc.imread(path, mode='RGB').astype(np.float)
+        return Image.open(path).convert('RGB')
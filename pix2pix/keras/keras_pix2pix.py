@@ -136,6 +136,9 @@ class Pix2Pix():
 
         start_time = datetime.datetime.now()
 
+        # Batches are decoded on background threads while the models train
+        batches = self.data_loader.stream(batch_size)
+
         for epoch in range(epochs):
 
             # ----------------------
@@ -143,7 +146,7 @@ class Pix2Pix():
             # ----------------------
 
             # Sample images and their conditioning counterparts
-            imgs_A, imgs_B = self.data_loader.load_data(batch_size)
+            imgs_A, imgs_B = next(batches)
 
             # Condition on B and generate a translated version
             fake_A = self.generator.predict(imgs_B)
@@ -161,7 +164,7 @@ class Pix2Pix():
             # ------------------
 
             # Sample images and their conditioning counterparts
-            imgs_A, imgs_B = self.data_loader.load_data(batch_size)
+            imgs_A, imgs_B = next(batches)
 
             # The generators want the discriminators to label the generated images as real
             valid = np.ones((batch_size,) + self.disc_patch)
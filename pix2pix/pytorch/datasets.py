@@ -2,6 +2,7 @@ import glob
 import random
 import os
 import numpy as np
+import torch
 
 from torch.utils.data import Dataset
 from PIL import Image
@@ -12,9 +13,7 @@ class ImageDataset(Dataset):
     def __init__(self, root, transforms_=None, mode='train'):
         self.transform = transforms.Compose(transforms_)
 
-        self.files = sorted(glob.glob(os.path.join(root, mode) + '/*.*'))
-        if mode == 'train':
-            self.files.extend(sorted(glob.glob(os.path.join(root, 'test') + '/*.*')))
+        self.files = list_files(root, mode)
 
         print("Total number of image %s" %self.__len__())
 
@@ -26,8 +25,8 @@ class ImageDataset(Dataset):
         img_B = img.crop((w / 2, 0, w, h))
 
         if np.random.random() < 0.5:
-            img_A = Image.fromarray(np.array(img_A)[:, ::-1, :], 'RGB')
-            img_B = Image.fromarray(np.array(img_B)[:, ::-1, :], 'RGB')
+            img_A = img_A.transpose(Image.FLIP_LEFT_RIGHT)
+            img_B = img_B.transpose(Image.FLIP_LEFT_RIGHT)
 
         img_A = self.transform(img_A)
         img_B = self.transform(img_B)
@@ -36,3 +35,82 @@ class ImageDataset(Dataset):
 
     def __len__(self):
         return len(self.files)
+
+
+def list_files(root, mode='train'):
+    files = sorted(glob.glob(os.path.join(root, mode) + '/*.*'))
+    if mode == 'train':
+        files.extend(sorted(glob.glob(os.path.join(root, 'test') + '/*.*')))
+    return files
+
+
+def pack_pairs(root, out_dir, base_size, mode='train'):
+    """Decodes every side-by-side image of a split once into a uint8 (N, 2, H, W, 3) memmap
+
+    Plane 0 holds the left half (A) and plane 1 the right half (B), both resized to
+    base_size. Writes '<mode>.npy' and '<mode>_index.txt' to out_dir.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    files = list_files(root, mode)
+    data = np.lib.format.open_memmap(os.path.join(out_dir, '%s.npy' % mode), mode='w+', dtype=np.uint8,
+                                     shape=(len(files), 2, base_size, base_size, 3))
+    for i, path in enumerate(files):
+        img = Image.open(path).convert('RGB')
+        w, h = img.size
+        data[i, 0] = np.asarray(img.crop((0, 0, w // 2, h)).resize((base_size, base_size), Image.BICUBIC))
+        data[i, 1] = np.asarray(img.crop((w // 2, 0, w, h)).resize((base_size, base_size), Image.BICUBIC))
+    data.flush()
+    del data
+
+    with open(os.path.join(out_dir, '%s_index.txt' % mode), 'w') as f:
+        f.write('\n'.join(files))
+    print("Packed %d image pairs for %s" % (len(files), mode))
+
+
+class PackedImageDataset(Dataset):
+    """ImageDataset served from the arrays written by pack_pairs
+
+    A and B are cropped and flipped together as one (2, 3, H, W) tensor, so the pair
+    stays aligned without any PIL round trips. Outputs are normalized to [-1, 1].
+    """
+    def __init__(self, root, crop_size, mode='train', flip=True):
+        self.path = os.path.join(root, '%s.npy' % mode)
+        self.crop_size = crop_size
+        self.flip = flip
+        # Opened lazily so every worker maps the file itself instead of pickling the array
+        self.data = None
+        self.length = np.load(self.path, mmap_mode='r').shape[0]
+
+        print("Total number of image %s" % self.__len__())
+
+    def __getitem__(self, index):
+        if self.data is None:
+            self.data = np.load(self.path, mmap_mode='r')
+
+        h, w = self.crop_size
+        top = random.randint(0, self.data.shape[2] - h)
+        left = random.randint(0, self.data.shape[3] - w)
+        pair = torch.from_numpy(np.ascontiguousarray(self.data[index % self.length, :, top:top + h, left:left + w]))
+        pair = pair.permute(0, 3, 1, 2)
+        if self.flip and np.random.random() < 0.5:
+            pair = pair.flip(3)
+        pair = pair.float().div_(127.5).sub_(1)
+
+        return {'A': pair[0], 'B': pair[1]}
+
+    def __len__(self):
+        return self.length
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pack a side-by-side paired dataset into uint8 memmaps')
+    parser.add_argument('--root', type=str, required=True, help='dataset root containing the split folders')
+    parser.add_argument('--out_dir', type=str, required=True, help='directory to write the packed arrays to')
+    parser.add_argument('--base_size', type=int, default=256, help='resolution each half is stored at')
+    parser.add_argument('--modes', type=str, nargs='+', default=['train', 'val'], help='splits to pack')
+    opt = parser.parse_args()
+
+    for mode in opt.modes:
+        pack_pairs(opt.root, opt.out_dir, opt.base_size, mode)
@@ -20,6 +20,11 @@ from datasets import *
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from grad_accumulation import GradientAccumulator
+from precision import Precision
+from checkpoint_manager import CheckpointManager
+from metrics import Metrics
 
 
 def sample_images(batches_done):
@@ -38,6 +43,7 @@ if __name__ == '__main__':
     parser.add_argument('--n_epochs', type=int, default=200, help='number of epochs of training')
     parser.add_argument('--dataset_name', type=str, default="facades", help='name of the dataset')
     parser.add_argument('--batch_size', type=int, default=1, help='size of the batches')
+    parser.add_argument('--micro_batch_size', type=int, default=0, help='samples per forward/backward pass, 0 picks the largest that fits in memory')
     parser.add_argument('--lr', type=float, default=0.0002, help='adam: learning rate')
     parser.add_argument('--b1', type=float, default=0.5, help='adam: decay of first order momentum of gradient')
     parser.add_argument('--b2', type=float, default=0.999, help='adam: decay of first order momentum of gradient')
@@ -49,6 +55,12 @@ if __name__ == '__main__':
     parser.add_argument('--sample_interval', type=int, default=500,
                         help='interval between sampling of images from generators')
     parser.add_argument('--checkpoint_interval', type=int, default=-1, help='interval between model checkpoints')
+    parser.add_argument('--log_interval', type=int, default=20, help='interval between printing the running mean losses (each print waits for the device)')
+    parser.add_argument('--metrics_csv', type=str, default=None, help='also append the logged losses to this CSV file')
+    parser.add_argument('--tensorboard_dir', type=str, default=None, help='also write the logged losses as TensorBoard scalars (needs tensorboardX)')
+    parser.add_argument('--keep_checkpoints', type=int, default=0, help='number of most recent checkpoints to keep, 0 keeps all')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='precision of the forward passes (bf16/fp16 run under autocast)')
+    parser.add_argument('--packed_root', type=str, default=None, help='directory of arrays written by datasets.py (skips JPEG decoding)')
     opt = parser.parse_args()
     print(opt)
 
@@ -56,6 +68,8 @@ if __name__ == '__main__':
     os.makedirs('saved_models/%s' % opt.dataset_name, exist_ok=True)
 
     cuda = True if torch.cuda.is_available() else False
+    targets = TargetCache(device='cuda' if cuda else 'cpu')
+    amp = Precision(opt.precision, device='cuda' if cuda else 'cpu')
 
     # Loss functions
     criterion_GAN = torch.nn.MSELoss()
@@ -77,12 +91,7 @@ if __name__ == '__main__':
         criterion_GAN.cuda()
         criterion_pixelwise.cuda()
 
-    if opt.epoch != 0:
-        # Load pretrained models
-        generator.load_state_dict(torch.load('saved_models/%s/generator_%d.pth' % (opt.dataset_name, opt.epoch)))
-        discriminator.load_state_dict(
-            torch.load('saved_models/%s/discriminator_%d.pth' % (opt.dataset_name, opt.epoch)))
-    else:
+    if opt.epoch == 0:
         # Initialize weights
         generator.apply(weights_init_normal)
         discriminator.apply(weights_init_normal)
@@ -91,26 +100,76 @@ if __name__ == '__main__':
     optimizer_G = torch.optim.Adam(generator.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
     optimizer_D = torch.optim.Adam(discriminator.parameters(), lr=opt.lr, betas=(opt.b1, opt.b2))
 
+    state = dict(generator=generator, discriminator=discriminator,
+                 optimizer_G=optimizer_G, optimizer_D=optimizer_D, amp=amp)
+
+    checkpoints = CheckpointManager('saved_models/%s' % opt.dataset_name, keep=opt.keep_checkpoints,
+                                    legacy='{name}_{step}.pth')
+    if opt.epoch != 0:
+        # Load pretrained models
+        checkpoints.restore(opt.epoch, **state)
+
     # Configure dataloaders
     transforms_ = [transforms.Resize((opt.img_height, opt.img_width), Image.BICUBIC),
                    transforms.ToTensor(),
                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
 
-    dataloader = DataLoader(ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_),
-                            batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu)
+    if opt.packed_root is not None:
+        train_dataset = PackedImageDataset(opt.packed_root, (opt.img_height, opt.img_width))
+        val_dataset = PackedImageDataset(opt.packed_root, (opt.img_height, opt.img_width), mode='val', flip=False)
+    else:
+        train_dataset = ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_)
+        val_dataset = ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, mode='val')
+
+    dataloader = DataLoader(train_dataset, batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu)
 
-    val_dataloader = DataLoader(ImageDataset("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, mode='val'),
-                                batch_size=10, shuffle=True, num_workers=1)
+    val_dataloader = DataLoader(val_dataset, batch_size=10, shuffle=True, num_workers=1)
 
     # Tensor type
     Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 
+    accum = GradientAccumulator(opt.micro_batch_size, precision=amp)
+
+    # Forward/backward passes over one micro-batch, driven by accum.run
+    def generator_step(real_A, real_B):
+        with amp.autocast():
+            # GAN loss
+            fake_B = generator(real_A)
+            pred_fake = discriminator(fake_B, real_A)
+            loss_GAN = criterion_GAN(pred_fake, targets.ones((real_A.size(0), *patch)))
+            # Pixel-wise loss
+            loss_pixel = criterion_pixelwise(fake_B, real_B)
+
+            # Total loss
+            loss_G = loss_GAN + lambda_pixel * loss_pixel
+
+        accum.backward(loss_G)
+        return {'G': loss_G, 'GAN': loss_GAN, 'pixel': loss_pixel, 'fake_B': fake_B.detach()}
+
+    def discriminator_step(real_A, real_B, fake_B):
+        with amp.autocast():
+            # Real loss
+            pred_real = discriminator(real_B, real_A)
+            loss_real = criterion_GAN(pred_real, targets.ones((real_A.size(0), *patch)))
+
+            # Fake loss
+            pred_fake = discriminator(fake_B, real_A)
+            loss_fake = criterion_GAN(pred_fake, targets.zeros((real_A.size(0), *patch)))
+
+            # Total loss
+            loss_D = 0.5 * (loss_real + loss_fake)
+
+        accum.backward(loss_D)
+        return {'D': loss_D}
+
+    metrics = Metrics("\r[Epoch {epoch}/{n_epochs}] [Batch {batch}/{n_batches}] [D loss: {D:f}] "
+                      "[G loss: {G:f}, pixel: {pixel:f}, adv: {GAN:f}] ETA: {eta}",
+                      csv_path=opt.metrics_csv, log_dir=opt.tensorboard_dir)
+
     # ----------
     #  Training
     # ----------
 
-    start_time = time.time()
-
     for epoch in range(opt.epoch, opt.n_epochs):
         for i, batch in enumerate(dataloader):
 
@@ -118,66 +177,36 @@ if __name__ == '__main__':
             real_A = Variable(batch['B'].type(Tensor))
             real_B = Variable(batch['A'].type(Tensor))
 
-            # Adversarial ground truths
-            valid = Variable(Tensor(np.ones((real_A.size(0), *patch))), requires_grad=False)
-            fake = Variable(Tensor(np.zeros((real_A.size(0), *patch))), requires_grad=False)
-
             # ------------------
             #  Train Generators
             # ------------------
 
             optimizer_G.zero_grad()
-
-            # GAN loss
-            fake_B = generator(real_A)
-            pred_fake = discriminator(fake_B, real_A)
-            loss_GAN = criterion_GAN(pred_fake, valid)
-            # Pixel-wise loss
-            loss_pixel = criterion_pixelwise(fake_B, real_B)
-
-            # Total loss
-            loss_G = loss_GAN + lambda_pixel * loss_pixel
-
-            loss_G.backward()
-
-            optimizer_G.step()
+            losses = accum.run(generator_step, real_A, real_B, optimizers=[optimizer_G])
+            loss_G, loss_GAN, loss_pixel = losses['G'], losses['GAN'], losses['pixel']
+            amp.step(optimizer_G)
 
             # ---------------------
             #  Train Discriminator
             # ---------------------
 
             optimizer_D.zero_grad()
-
-            # Real loss
-            pred_real = discriminator(real_B, real_A)
-            loss_real = criterion_GAN(pred_real, valid)
-
-            # Fake loss
-            pred_fake = discriminator(fake_B.detach(), real_A)
-            loss_fake = criterion_GAN(pred_fake, fake)
-
-            # Total loss
-            loss_D = 0.5 * (loss_real + loss_fake)
-
-            loss_D.backward()
-            optimizer_D.step()
+            loss_D = accum.run(discriminator_step, real_A, real_B, losses['fake_B'], optimizers=[optimizer_D])['D']
+            amp.step(optimizer_D)
+            amp.update()
 
             # --------------
             #  Log Progress
             # --------------
 
-            # Determine approximate time left
-            batches_done = epoch * len(dataloader) + i
-            batches_left = opt.n_epochs * len(dataloader) - batches_done
-            time_left = datetime.timedelta(seconds=batches_left * (time.time() - start_time) / (batches_done + 1))
+            metrics.update(D=loss_D, G=loss_G, pixel=loss_pixel, GAN=loss_GAN)
+            metrics.tick()
 
-            # Print log
-            sys.stdout.write("\r[Epoch %d/%d] [Batch %d/%d] [D loss: %f] [G loss: %f, pixel: %f, adv: %f] ETA: %s" %
-                             (epoch, opt.n_epochs,
-                              i, len(dataloader),
-                              loss_D.item(), loss_G.item(),
-                              loss_pixel.item(), loss_GAN.item(),
-                              time_left))
+            # Print log, with the approximate time left
+            batches_done = epoch * len(dataloader) + i
+            if batches_done % opt.log_interval == 0:
+                metrics.log(batches_done, remaining=opt.n_epochs * len(dataloader) - batches_done,
+                            epoch=epoch, n_epochs=opt.n_epochs, batch=i, n_batches=len(dataloader))
 
             # If at sample interval save image
             if batches_done % opt.sample_interval == 0:
@@ -185,5 +214,6 @@ if __name__ == '__main__':
 
         if opt.checkpoint_interval != -1 and epoch % opt.checkpoint_interval == 0:
             # Save model checkpoints
-            torch.save(generator.state_dict(), 'saved_models/%s/generator_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(discriminator.state_dict(), 'saved_models/%s/discriminator_%d.pth' % (opt.dataset_name, epoch))
+            checkpoints.save(epoch, **state)
+
+    checkpoints.close()
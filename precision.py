@@ -0,0 +1,60 @@
+import contextlib
+
+import torch
+
+
+class Precision(object):
+    """Autocast region and loss scaling for a --precision mode (fp32, bf16 or fp16)
+
+    Forward passes and losses run inside autocast(), so convolutions and matmuls use
+    the reduced dtype while parameters and optimizer state stay float32. bf16 has
+    float32's exponent range and needs no loss scaling, which makes it the mode for
+    CPUs with AVX512-BF16/AMX. fp16 is CUDA only and goes through a GradScaler:
+    call backward() and step() instead of loss.backward() and optimizer.step(), and
+    update() once per iteration. In fp32 mode every method reduces to the plain call.
+    Numerically sensitive code (gradient penalties, power iterations) should run in
+    an fp32() region on float32 inputs.
+    """
+
+    dtypes = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+    def __init__(self, mode='fp32', device=None):
+        assert mode in self.dtypes, 'Unknown precision %s, expected one of %s' % (mode, ', '.join(self.dtypes))
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        assert mode != 'fp16' or self.device.type == 'cuda', 'fp16 needs a CUDA device, use bf16 on CPU'
+        self.mode = mode
+        self.dtype = self.dtypes[mode]
+        self.enabled = mode != 'fp32'
+        self.scaler = torch.cuda.amp.GradScaler(enabled=mode == 'fp16')
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, dtype=self.dtype)
+
+    def fp32(self):
+        """Region that runs in float32 even when nested in autocast()"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, enabled=False)
+
+    def scale(self, loss):
+        return self.scaler.scale(loss)
+
+    def backward(self, loss, **kwargs):
+        self.scaler.scale(loss).backward(**kwargs)
+
+    def step(self, optimizer):
+        """Steps the optimizer, skipping the step if fp16 gradients overflowed"""
+        self.scaler.step(optimizer)
+
+    def update(self):
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        # A disabled scaler saves an empty state (runs resumed with another --precision)
+        if state_dict:
+            self.scaler.load_state_dict(state_dict)
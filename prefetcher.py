@@ -0,0 +1,34 @@
+import queue
+import threading
+
+
+class Prefetcher(object):
+    """Runs a batch iterator on a background thread, keeping at most `size` batches ready
+
+    An exception raised by the iterator is re-raised by next() in the consuming thread.
+    """
+    _end = object()
+
+    def __init__(self, batches, size=8):
+        self.queue = queue.Queue(maxsize=size)
+        self.thread = threading.Thread(target=self._fill, args=(batches,), daemon=True)
+        self.thread.start()
+
+    def _fill(self, batches):
+        try:
+            for batch in batches:
+                self.queue.put(batch)
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(self._end)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if item is self._end:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
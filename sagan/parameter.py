@@ -16,6 +16,7 @@ def get_parameters():
     parser.add_argument('--g_conv_dim', type=int, default=64)
     parser.add_argument('--d_conv_dim', type=int, default=64)
     parser.add_argument('--lambda_gp', type=float, default=10)
+    parser.add_argument('--gp_interval', type=int, default=1)
     parser.add_argument('--version', type=str, default='sagan_1')
 
     # Training setting
@@ -28,6 +29,7 @@ def get_parameters():
     parser.add_argument('--lr_decay', type=float, default=0.95)
     parser.add_argument('--beta1', type=float, default=0.0)
     parser.add_argument('--beta2', type=float, default=0.9)
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
 
     # using pretrained
     parser.add_argument('--pretrained_model', type=int, default=None)
@@ -35,6 +37,7 @@ def get_parameters():
     # Misc
     parser.add_argument('--train', type=str2bool, default=True)
     parser.add_argument('--parallel', type=str2bool, default=False)
+    parser.add_argument('--debug_attention', type=str2bool, default=False)
     parser.add_argument('--dataset', type=str, default='char', choices=['lsun', 'celeb'])
     parser.add_argument('--use_tensorboard', type=str2bool, default=False)
 
@@ -49,6 +52,7 @@ def get_parameters():
     parser.add_argument('--log_step', type=int, default=1)
     parser.add_argument('--sample_step', type=int, default=100)
     parser.add_argument('--model_save_step', type=float, default=1.0)
+    parser.add_argument('--keep_checkpoints', type=int, default=0)
 
 
     return parser.parse_args()
\ No newline at end of file
@@ -1,16 +1,95 @@
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 from spectral import SpectralNorm
 import numpy as np
 
+@contextlib.contextmanager
+def double_backward(model):
+    """Region where the Self_Attn layers of model must support create_graph=True gradients
+
+    The fused attention kernels have no second derivative, so inside this region (the
+    discriminator forward of a gradient penalty) the layers use TiledAttention.
+    """
+    layers = [m for m in model.modules() if isinstance(m, Self_Attn)]
+    previous = [m.double_backward for m in layers]
+    for m in layers:
+        m.double_backward = True
+    try:
+        yield
+    finally:
+        for m, value in zip(layers, previous):
+            m.double_backward = value
+
+
+def _attend_tile(query, key, value):
+    return torch.bmm(torch.softmax(torch.bmm(query, key.transpose(1, 2)), dim=-1), value)
+
+
+def _attend_tile_grads(query, key, value, grad_out):
+    """Gradients of _attend_tile with respect to query, key and value, as differentiable ops"""
+    grad_out = grad_out.to(query.dtype)
+    attention = torch.softmax(torch.bmm(query, key.transpose(1, 2)), dim=-1)
+    grad_value = torch.bmm(attention.transpose(1, 2), grad_out)
+    grad_attention = torch.bmm(grad_out, value.transpose(1, 2))
+    grad_energy = attention * (grad_attention - (grad_attention * attention).sum(dim=-1, keepdim=True))
+    return torch.bmm(grad_energy, key), torch.bmm(grad_energy.transpose(1, 2), query), grad_value
+
+
+class TiledAttention(torch.autograd.Function):
+    """softmax(query key^T) value over chunk_size query rows at a time, twice differentiable
+
+    Only query, key and value are saved. backward() recomputes each tile's attention and
+    writes its gradients with differentiable ops, each tile under a non-reentrant
+    checkpoint, so a create_graph=True backward (a gradient penalty) keeps the tile
+    inputs rather than the tiles for the second backward. Memory stays at one
+    chunk_size x N tile per pass instead of the B X N X N matrix.
+    """
+
+    @staticmethod
+    def forward(ctx, query, key, value, chunk_size):
+        ctx.save_for_backward(query, key, value)
+        ctx.chunk_size = chunk_size
+        return torch.cat([_attend_tile(q, key, value) for q in query.split(chunk_size, dim=1)], dim=1)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        query, key, value = ctx.saved_tensors
+        grad_query, grad_key, grad_value = [], 0, 0
+        for q, g in zip(query.split(ctx.chunk_size, dim=1), grad_out.split(ctx.chunk_size, dim=1)):
+            if torch.is_grad_enabled():
+                # create_graph=True: keep the tile inputs, recompute the tile in the second backward
+                dq, dk, dv = checkpoint(_attend_tile_grads, q, key, value, g, use_reentrant=False)
+            else:
+                dq, dk, dv = _attend_tile_grads(q, key, value, g)
+            grad_query.append(dq)
+            grad_key = grad_key + dk
+            grad_value = grad_value + dv
+        return torch.cat(grad_query, dim=1), grad_key, grad_value, None
+
+
 class Self_Attn(nn.Module):
-    """ Self attention Layer"""
-    def __init__(self,in_dim,activation):
+    """ Self attention Layer
+
+    The N x N attention matrix (N = W*H) is not stored. Where PyTorch has it,
+    F.scaled_dot_product_attention runs fused kernels that compute the softmax online
+    over key tiles; otherwise, and inside double_backward() where the fused kernels
+    cannot be differentiated twice, TiledAttention processes queries chunk_size rows at
+    a time and recomputes each tile in backward. The full matrix is built and returned
+    only with return_attention, for looking at the attention maps.
+    """
+    def __init__(self,in_dim,activation,return_attention=False,chunk_size=1024):
         super(Self_Attn,self).__init__()
         self.chanel_in = in_dim
         self.activation = activation
+        self.return_attention = return_attention
+        self.chunk_size = chunk_size
+        # Set by double_backward()
+        self.double_backward = False
         
         self.query_conv = nn.Conv2d(in_channels = in_dim , out_channels = in_dim//8 , kernel_size= 1)
         self.key_conv = nn.Conv2d(in_channels = in_dim , out_channels = in_dim//8 , kernel_size= 1)
@@ -25,26 +104,37 @@ class Self_Attn(nn.Module):
                 x : input feature maps( B X C X W X H)
             returns :
                 out : self attention value + input feature 
-                attention: B X N X N (N is Width*Height)
+                attention: B X N X N (N is Width*Height) with return_attention, else None
         """
         m_batchsize,C,width ,height = x.size()
-        proj_query  = self.query_conv(x).view(m_batchsize,-1,width*height).permute(0,2,1) # B X C X (N)
+        proj_query  = self.query_conv(x).view(m_batchsize,-1,width*height).permute(0,2,1) # B X (N) X C
         proj_key =  self.key_conv(x).view(m_batchsize,-1,width*height) # B X C x (*W*H)
-        energy =  torch.bmm(proj_query,proj_key) # transpose check
-        attention = self.softmax(energy) # BX (N) X (N) 
         proj_value = self.value_conv(x).view(m_batchsize,-1,width*height) # B X C X N
 
-        out = torch.bmm(proj_value,attention.permute(0,2,1) )
-        out = out.view(m_batchsize,C,width,height)
+        if self.return_attention:
+            energy =  torch.bmm(proj_query,proj_key) # transpose check
+            attention = self.softmax(energy) # BX (N) X (N) 
+            out = torch.bmm(proj_value,attention.permute(0,2,1) )
+        else:
+            attention = None
+            out = self.attend(proj_query, proj_key.permute(0,2,1), proj_value.permute(0,2,1)).permute(0,2,1)
+        out = out.reshape(m_batchsize,C,width,height)
         
         out = self.gamma*out + x
         return out,attention
 
+    def attend(self, query, key, value):
+        """softmax(query key^T) value for B X N X C queries/keys and values, without the N X N matrix"""
+        if not self.double_backward and hasattr(F, 'scaled_dot_product_attention'):
+            # SAGAN does not scale the energies by 1/sqrt(C)
+            return F.scaled_dot_product_attention(query, key, value, scale=1.0)
+        return TiledAttention.apply(query, key, value, self.chunk_size)
+
 
 class Generator(nn.Module):
     """Generator."""
 
-    def __init__(self, batch_size, image_size=64, z_dim=100, conv_dim=64):
+    def __init__(self, batch_size, image_size=64, z_dim=100, conv_dim=64, return_attention=False):
         super(Generator, self).__init__()
         self.imsize = image_size
         layer1 = []
@@ -87,8 +177,8 @@ class Generator(nn.Module):
         last.append(nn.Tanh())
         self.last = nn.Sequential(*last)
 
-        self.attn1 = Self_Attn( 128, 'relu')
-        self.attn2 = Self_Attn( 64,  'relu')
+        self.attn1 = Self_Attn( 128, 'relu', return_attention)
+        self.attn2 = Self_Attn( 64,  'relu', return_attention)
 
     def forward(self, z):
         z = z.view(z.size(0), z.size(1), 1, 1)
@@ -106,7 +196,7 @@ class Generator(nn.Module):
 class Discriminator(nn.Module):
     """Discriminator, Auxiliary Classifier."""
 
-    def __init__(self, batch_size=64, image_size=64, conv_dim=64):
+    def __init__(self, batch_size=64, image_size=64, conv_dim=64, return_attention=False):
         super(Discriminator, self).__init__()
         self.imsize = image_size
         layer1 = []
@@ -140,8 +230,8 @@ class Discriminator(nn.Module):
         last.append(nn.Conv2d(curr_dim, 1, 4))
         self.last = nn.Sequential(*last)
 
-        self.attn1 = Self_Attn(256, 'relu')
-        self.attn2 = Self_Attn(512, 'relu')
+        self.attn1 = Self_Attn(256, 'relu', return_attention)
+        self.attn2 = Self_Attn(512, 'relu', return_attention)
 
     def forward(self, x):
         out = self.l1(x)
@@ -12,11 +12,25 @@ def l2normalize(v, eps=1e-12):
 
 
 class SpectralNorm(nn.Module):
+    """Divides the wrapped module's weight by its largest singular value
+
+    In training mode every forward does power_iterations steps of power iteration on
+    the persistent u/v estimates. In eval mode u and v are left alone and w / sigma is
+    computed once and reused until the raw weight changes (an optimizer step or a
+    load_state_dict), so sampling costs no more than an unnormalized layer. fold()
+    writes w / sigma into a plain weight parameter for exported inference models.
+    State dicts keep the weight_bar/_u/_v layout until folded. sigma is computed from
+    copies of u and v in training, so the next forward's in-place power iteration does
+    not invalidate the graph of an earlier one (e.g. D(real) and D(fake) before one
+    backward).
+    """
     def __init__(self, module, name='weight', power_iterations=1):
         super(SpectralNorm, self).__init__()
         self.module = module
         self.name = name
         self.power_iterations = power_iterations
+        self.folded = False
+        self._cache_key = None
         if not self._made_params():
             self._make_params()
 
@@ -25,15 +39,49 @@ class SpectralNorm(nn.Module):
         v = getattr(self.module, self.name + "_v")
         w = getattr(self.module, self.name + "_bar")
 
-        height = w.data.shape[0]
-        for _ in range(self.power_iterations):
-            v.data = l2normalize(torch.mv(torch.t(w.view(height,-1).data), u.data))
-            u.data = l2normalize(torch.mv(w.view(height,-1).data, v.data))
-
-        # sigma = torch.dot(u.data, torch.mv(w.view(height,-1).data, v.data))
-        sigma = u.dot(w.view(height, -1).mv(v))
+        # Kept in float32 under autocast, where mv would round u, v and sigma to half precision
+        with torch.autocast(w.device.type, enabled=False):
+            height = w.data.shape[0]
+            if self.training:
+                with torch.no_grad():
+                    w_mat = w.view(height, -1)
+                    for _ in range(self.power_iterations):
+                        v.copy_(l2normalize(torch.mv(torch.t(w_mat), u)))
+                        u.copy_(l2normalize(torch.mv(w_mat, v)))
+                # The graph keeps the copies, not the buffers the next forward overwrites
+                u = u.clone(memory_format=torch.contiguous_format)
+                v = v.clone(memory_format=torch.contiguous_format)
+
+            # sigma = torch.dot(u.data, torch.mv(w.view(height,-1).data, v.data))
+            sigma = u.dot(w.view(height, -1).mv(v))
         setattr(self.module, self.name, w / sigma.expand_as(w))
 
+    def _cached_weight(self):
+        """Sets w / sigma from the current u/v, only if the weight or u/v changed since the last call"""
+        u = getattr(self.module, self.name + "_u")
+        v = getattr(self.module, self.name + "_v")
+        w = getattr(self.module, self.name + "_bar")
+        # In-place updates (optimizer steps, load_state_dict, power iteration) bump _version
+        key = (w.data_ptr(), w._version, u._version, v._version)
+        if key != self._cache_key:
+            self._update_u_v()
+            self._cache_key = key
+
+    def fold(self):
+        """Replaces weight_bar/_u/_v by a plain weight holding w / sigma, for inference"""
+        if self.folded:
+            return
+        with torch.no_grad():
+            training, self.training = self.training, False
+            self._update_u_v()
+            self.training = training
+            w = getattr(self.module, self.name)
+        delattr(self.module, self.name)
+        for suffix in ("_u", "_v", "_bar"):
+            del self.module._parameters[self.name + suffix]
+        self.module.register_parameter(self.name, Parameter(w.detach().clone()))
+        self.folded = True
+
     def _made_params(self):
         try:
             u = getattr(self.module, self.name + "_u")
@@ -64,5 +112,29 @@ class SpectralNorm(nn.Module):
 
 
     def forward(self, *args):
-        self._update_u_v()
-        return self.module.forward(*args)
\ No newline at end of file
+        if self.folded:
+            return self.module.forward(*args)
+        if self.training or torch.is_grad_enabled():
+            # The normalized weight is part of the autograd graph, so it is rebuilt every call
+            self._update_u_v()
+            self._cache_key = None
+        else:
+            self._cached_weight()
+        return self.module.forward(*args)
+
+
+def fold_spectral_norm(model):
+    """Folds every SpectralNorm layer of model into its weight (see SpectralNorm.fold)"""
+    for module in model.modules():
+        if isinstance(module, SpectralNorm):
+            module.fold()
+    return model
+
+
+if __name__ == '__main__':
+    # Two training forwards before one backward, as in a discriminator step on real and fake
+    layer = SpectralNorm(nn.Conv2d(3, 8, 3))
+    real, fake = torch.randn(2, 3, 8, 8), torch.randn(2, 3, 8, 8)
+    (layer(real).mean() - layer(fake).mean()).backward()
+    assert layer.module.weight_bar.grad is not None
+    print("Two forwards, one backward: OK")
@@ -7,8 +7,11 @@ import torch.nn as nn
 from torch.autograd import Variable
 from torchvision.utils import save_image
 
-from sagan_models import Generator, Discriminator
+from sagan_models import Generator, Discriminator, double_backward
 from utils import *
+from precision import Precision
+from lazy_regularizer import LazyRegularizer
+from checkpoint_manager import CheckpointManager
 
 from tensorboardX import SummaryWriter
 
@@ -50,6 +53,7 @@ class Trainer(object):
         self.parallel = config.parallel
 
         self.lambda_gp = config.lambda_gp
+        self.gp_interval = config.gp_interval
         self.total_step = config.total_step
         self.d_iters = config.d_iters
         self.batch_size = config.batch_size
@@ -59,7 +63,9 @@ class Trainer(object):
         self.lr_decay = config.lr_decay
         self.beta1 = config.beta1
         self.beta2 = config.beta2
+        self.precision = config.precision
         self.pretrained_model = config.pretrained_model
+        self.debug_attention = config.debug_attention
 
         self.dataset = config.dataset
         self.use_tensorboard = config.use_tensorboard
@@ -77,6 +83,10 @@ class Trainer(object):
         self.sample_path = os.path.join(config.sample_path, self.version)
         self.model_save_path = os.path.join(config.model_save_path, self.version)
 
+        # Bundled checkpoints written in the background; old {step}_G/D.pth files still load
+        self.checkpoints = CheckpointManager(self.model_save_path, keep=config.keep_checkpoints, prefix='',
+                                             suffix='_checkpoint.pth', legacy='{step}_{name}.pth')
+
         self.build_model()
 
         if self.use_tensorboard:
@@ -121,69 +131,61 @@ class Trainer(object):
             # Compute loss with real images
             # dr1, dr2, df1, df2, gf1, gf2 are attention scores
             real_images = tensor2var(real_images)
-            d_out_real,dr1,dr2 = self.D(real_images)
-            if self.adv_loss == 'wgan-gp':
-                d_loss_real = - torch.mean(d_out_real)
-            elif self.adv_loss == 'hinge':
-                d_loss_real = torch.nn.ReLU()(1.0 - d_out_real).mean()
+            with self.amp.autocast():
+                d_out_real,dr1,dr2 = self.D(real_images)
+                if self.adv_loss == 'wgan-gp':
+                    d_loss_real = - torch.mean(d_out_real)
+                elif self.adv_loss == 'hinge':
+                    d_loss_real = torch.nn.ReLU()(1.0 - d_out_real).mean()
 
-            # apply Gumbel Softmax
-            z = tensor2var(torch.randn(real_images.size(0), self.z_dim))
-            fake_images,gf1,gf2 = self.G(z)
-            d_out_fake,df1,df2 = self.D(fake_images)
+                # apply Gumbel Softmax
+                z = tensor2var(torch.randn(real_images.size(0), self.z_dim))
+                fake_images,gf1,gf2 = self.G(z)
+                d_out_fake,df1,df2 = self.D(fake_images)
 
-            if self.adv_loss == 'wgan-gp':
-                d_loss_fake = d_out_fake.mean()
-            elif self.adv_loss == 'hinge':
-                d_loss_fake = torch.nn.ReLU()(1.0 + d_out_fake).mean()
+                if self.adv_loss == 'wgan-gp':
+                    d_loss_fake = d_out_fake.mean()
+                elif self.adv_loss == 'hinge':
+                    d_loss_fake = torch.nn.ReLU()(1.0 + d_out_fake).mean()
 
 
-            # Backward + Optimize
-            d_loss = d_loss_real + d_loss_fake
+                # Backward + Optimize
+                d_loss = d_loss_real + d_loss_fake
             self.reset_grad()
-            d_loss.backward()
-            self.d_optimizer.step()
+            self.amp.backward(d_loss)
+            self.amp.step(self.d_optimizer)
+            # D may step again for the penalty, and a scaler allows one step per update
+            self.amp.update()
 
 
             if self.adv_loss == 'wgan-gp':
-                # Compute gradient penalty
-                alpha = torch.rand(real_images.size(0), 1, 1, 1).expand_as(real_images)
-                interpolated = Variable(alpha * real_images.data + (1 - alpha) * fake_images.data, requires_grad=True)
-                out,_,_ = self.D(interpolated)
-
-                grad = torch.autograd.grad(outputs=out,
-                                           inputs=interpolated,
-                                           grad_outputs=torch.ones(out.size()),
-                                           retain_graph=True,
-                                           create_graph=True,
-                                           only_inputs=True)[0]
-
-                grad = grad.view(grad.size(0), -1)
-                grad_l2norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
-                d_loss_gp = torch.mean((grad_l2norm - 1) ** 2)
+                # Compute gradient penalty, weighted and only every gp_interval steps
+                d_loss = self.gp(lambda: self.gradient_penalty(real_images, fake_images))
 
                 # Backward + Optimize
-                d_loss = self.lambda_gp * d_loss_gp
-
-                self.reset_grad()
-                d_loss.backward()
-                self.d_optimizer.step()
+                if torch.is_tensor(d_loss):
+                    self.reset_grad()
+                    self.amp.backward(d_loss)
+                    self.amp.step(self.d_optimizer)
+                    self.amp.update()
 
             # ================== Train G and gumbel ================== #
-            # Create random noise
-            z = tensor2var(torch.randn(real_images.size(0), self.z_dim))
-            fake_images,_,_ = self.G(z)
-
-            # Compute loss with fake images
-            g_out_fake,_,_ = self.D(fake_images)  # batch x n
-            if self.adv_loss == 'wgan-gp':
-                g_loss_fake = - g_out_fake.mean()
-            elif self.adv_loss == 'hinge':
-                g_loss_fake = - g_out_fake.mean()
+            with self.amp.autocast():
+                # Create random noise
+                z = tensor2var(torch.randn(real_images.size(0), self.z_dim))
+                fake_images,_,_ = self.G(z)
+
+                # Compute loss with fake images
+                g_out_fake,_,_ = self.D(fake_images)  # batch x n
+                if self.adv_loss == 'wgan-gp':
+                    g_loss_fake = - g_out_fake.mean()
+                elif self.adv_loss == 'hinge':
+                    g_loss_fake = - g_out_fake.mean()
 
             self.reset_grad()
-            g_loss_fake.backward()
-            self.g_optimizer.step()
+            self.amp.backward(g_loss_fake)
+            self.amp.step(self.g_optimizer)
+            self.amp.update()
 
 
             # Print out log info
@@ -198,20 +200,43 @@ class Trainer(object):
 
             # Sample images
             if (step + 1) % self.sample_step == 0:
-                fake_images,_,_= self.G(fixed_z)
+                with torch.no_grad():
+                    fake_images,_,_= self.G(fixed_z)
                 save_image(denorm(fake_images.data),
                            os.path.join(self.sample_path, '{}_fake.png'.format(step + 1)))
 
             if (step+1) % model_save_step==0:
-                torch.save(self.G.state_dict(),
-                           os.path.join(self.model_save_path, '{}_G.pth'.format(step + 1)))
-                torch.save(self.D.state_dict(),
-                           os.path.join(self.model_save_path, '{}_D.pth'.format(step + 1)))
+                self.checkpoints.save(step + 1, **self.checkpoint_state())
+                if self.adv_loss == 'wgan-gp' and self.gp_interval > 1:
+                    print(self.gp.report())
+
+        self.checkpoints.close()
+
+    def gradient_penalty(self, real_images, fake_images):
+        # Computed in float32 whatever the precision
+        with self.amp.fp32():
+            alpha = torch.rand(real_images.size(0), 1, 1, 1).expand_as(real_images)
+            interpolated = Variable(alpha * real_images.data + (1 - alpha) * fake_images.data.float(), requires_grad=True)
+            # The penalty is differentiated twice, which the fused attention kernels do not support
+            with double_backward(self.D):
+                out,_,_ = self.D(interpolated)
+
+            grad = torch.autograd.grad(outputs=out,
+                                       inputs=interpolated,
+                                       grad_outputs=torch.ones(out.size()),
+                                       retain_graph=True,
+                                       create_graph=True,
+                                       only_inputs=True)[0]
+
+            grad = grad.view(grad.size(0), -1)
+            grad_l2norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
+            return torch.mean((grad_l2norm - 1) ** 2)
 
     def build_model(self):
 
-        self.G = Generator(self.batch_size,self.imsize, self.z_dim, self.g_conv_dim)        
-        self.D = Discriminator(self.batch_size,self.imsize, self.d_conv_dim)
+        # Attention maps are only materialized (and returned) when debugging them
+        self.G = Generator(self.batch_size,self.imsize, self.z_dim, self.g_conv_dim, self.debug_attention)
+        self.D = Discriminator(self.batch_size,self.imsize, self.d_conv_dim, self.debug_attention)
         if self.parallel:
             self.G = nn.DataParallel(self.G)
             self.D = nn.DataParallel(self.D)
@@ -222,6 +247,9 @@ class Trainer(object):
         self.d_optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, self.D.parameters()), self.d_lr, [self.beta1, self.beta2])
 
         self.c_loss = torch.nn.CrossEntropyLoss()
+        self.amp = Precision(self.precision, device='cuda' if torch.cuda.is_available() else 'cpu')
+        # Gradient penalty applied every gp_interval D steps, with its weight scaled to match
+        self.gp = LazyRegularizer(self.lambda_gp, self.gp_interval, device='cuda' if torch.cuda.is_available() else 'cpu')
         # print networks
         print(self.G)
         print(self.D)
@@ -230,11 +258,12 @@ class Trainer(object):
         from logger import logger
         self.logger = logger(self.log_path)
 
+    def checkpoint_state(self):
+        return dict(G=self.G, D=self.D, g_optimizer=self.g_optimizer, d_optimizer=self.d_optimizer,
+                    amp=self.amp, gp=self.gp)
+
     def load_pretrained_model(self):
-        self.G.load_state_dict(torch.load(os.path.join(
-            self.model_save_path, '{}_G.pth'.format(self.pretrained_model))))
-        self.D.load_state_dict(torch.load(os.path.join(
-            self.model_save_path, '{}_D.pth'.format(self.pretrained_model))))
+        self.checkpoints.restore(self.pretrained_model, **self.checkpoint_state())
         print('loaded trained models (step: {})..!'.format(self.pretrained_model))
 
     def reset_grad(self):
@@ -19,6 +19,8 @@ from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from latent_sampler import LatentSampler
 
 os.makedirs('images', exist_ok=True)
 
@@ -38,6 +40,8 @@ opt = parser.parse_args()
 print(opt)
 
 cuda = True if torch.cuda.is_available() else False
+targets = TargetCache(device='cuda' if cuda else 'cpu')
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 
 
 # Gan visualization
@@ -45,7 +49,7 @@ def create_summary_writer(model_g, model_d, data_loader, log_dir='./logs'):
     writer_g = SummaryWriter(os.path.join(log_dir, 'g'))
     writer_d = SummaryWriter(os.path.join(log_dir, 'd'))
 
-    z = Variable(FloatTensor(np.random.normal(0, 1, (opt.batch_size, opt.latent_dim))))
+    z = sampler.normal((opt.batch_size, opt.latent_dim))
     gen_imgs = model_g(z)
 
     try:
@@ -182,8 +186,8 @@ for epoch in range(opt.n_epochs):
         batch_size = imgs.shape[0]
 
         # Adversarial ground truths
-        valid = Variable(FloatTensor(batch_size, 1).fill_(1.0), requires_grad=False)
-        fake = Variable(FloatTensor(batch_size, 1).fill_(0.0), requires_grad=False)
+        valid = targets.ones((batch_size, 1))
+        fake = targets.zeros((batch_size, 1))
         fake_aux_gt = Variable(LongTensor(batch_size).fill_(opt.num_classes), requires_grad=False)
 
         # Configure input
@@ -197,7 +201,7 @@ for epoch in range(opt.n_epochs):
         optimizer_G.zero_grad()
 
         # Sample noise and labels as generator input
-        z = Variable(FloatTensor(np.random.normal(0, 1, (batch_size, opt.latent_dim))))
+        z = sampler.normal((batch_size, opt.latent_dim), key='z')
 
         # Generate a batch of images
         gen_imgs = generator(z)
@@ -2,6 +2,8 @@ import glob
 import random
 import os
 import numpy as np
+import torch
+import torch.nn.functional as F
 
 from torch.utils.data import Dataset
 from PIL import Image
@@ -24,3 +26,56 @@ class ImageDataset(Dataset):
 
     def __len__(self):
         return len(self.files)
+
+
+def pack_hr(root, out_path, hr_shape):
+    """Decodes and resizes every image once into a uint8 (N, H, W, 3) memmap for HRImageDataset"""
+    files = sorted(glob.glob(root + '/*.*'))
+    data = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=(len(files),) + tuple(hr_shape) + (3,))
+    for i, path in enumerate(files):
+        img = Image.open(path).convert('RGB').resize((hr_shape[1], hr_shape[0]), Image.BICUBIC)
+        data[i] = np.asarray(img)
+    data.flush()
+    print("Packed %d images at %dx%d" % (len(files), hr_shape[0], hr_shape[1]))
+
+
+class HRImageDataset(Dataset):
+    """Decodes each image once and derives the LR image from the HR tensor
+
+    The HR image is resized from the source (or read from a pack_hr memmap when cache
+    is given) and the LR image is an antialiased bicubic downsample of it by factor,
+    like the bicubic Resize of ImageDataset, instead of resampling the full-size
+    source twice. Both are normalized to [-1, 1].
+    """
+    def __init__(self, root, hr_shape, factor=4, cache=None):
+        self.hr_shape = hr_shape
+        self.factor = factor
+        self.cache = cache
+        self.data = None
+
+        if cache is not None:
+            self.length = np.load(cache, mmap_mode='r').shape[0]
+        else:
+            self.files = sorted(glob.glob(root + '/*.*'))
+            self.length = len(self.files)
+
+    def load_hr(self, index):
+        if self.cache is not None:
+            # Opened lazily so every worker maps the file itself instead of pickling the array
+            if self.data is None:
+                self.data = np.load(self.cache, mmap_mode='r')
+            return np.ascontiguousarray(self.data[index])
+
+        img = Image.open(self.files[index]).convert('RGB')
+        return np.asarray(img.resize((self.hr_shape[1], self.hr_shape[0]), Image.BICUBIC))
+
+    def __getitem__(self, index):
+        img_hr = torch.from_numpy(self.load_hr(index % self.length)).permute(2, 0, 1).float().div_(127.5).sub_(1)
+        lr_shape = (self.hr_shape[0] // self.factor, self.hr_shape[1] // self.factor)
+        img_lr = F.interpolate(img_hr.unsqueeze(0), size=lr_shape, mode='bicubic', align_corners=False,
+                               antialias=True).squeeze(0).clamp_(-1, 1)
+
+        return {'lr': img_lr, 'hr': img_hr}
+
+    def __len__(self):
+        return self.length
@@ -24,6 +24,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch
 from tensorboardX import SummaryWriter
+from checkpoint_manager import CheckpointManager
 
 os.makedirs('images', exist_ok=True)
 os.makedirs('saved_models', exist_ok=True)
@@ -59,6 +60,12 @@ hr_width = 256
 channels = 3
 sample_interval = 1000
 checkpoint_interval = -1
+# Number of most recent checkpoints to keep, 0 keeps all
+keep_checkpoints = 0
+# Decode each image once and downsample the LR image from the HR one (see HRImageDataset)
+single_decode = True
+# Optional memmap written by datasets.pack_hr, skips JPEG decoding entirely
+hr_cache = None
 
 cuda = True if torch.cuda.is_available() else False
 
@@ -82,11 +89,7 @@ if cuda:
     criterion_GAN = criterion_GAN.cuda()
     criterion_content = criterion_content.cuda()
 
-if epoch != 0:
-    # Load pretrained models
-    generator.load_state_dict(torch.load('saved_models/generator_%d.pth'))
-    discriminator.load_state_dict(torch.load('saved_models/discriminator_%d.pth'))
-else:
+if epoch == 0:
     # Initialize weights
     generator.apply(weights_init_normal)
     discriminator.apply(weights_init_normal)
@@ -95,6 +98,13 @@ else:
 optimizer_G = torch.optim.Adam(generator.parameters(), lr=lr, betas=(b1, b2))
 optimizer_D = torch.optim.Adam(discriminator.parameters(), lr=lr, betas=(b1, b2))
 
+state = dict(generator=generator, discriminator=discriminator, optimizer_G=optimizer_G, optimizer_D=optimizer_D)
+
+checkpoints = CheckpointManager('saved_models', keep=keep_checkpoints, legacy='{name}_{step}.pth')
+if epoch != 0:
+    # Load pretrained models
+    checkpoints.restore(epoch, **state)
+
 # Inputs & targets memory allocation
 Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
 input_lr = Tensor(batch_size, channels, hr_height // 4, hr_width // 4)
@@ -112,9 +122,12 @@ hr_transforms = [transforms.Resize((hr_height, hr_height), Image.BICUBIC),
                  transforms.ToTensor(),
                  transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
 
-dataloader = DataLoader(
-    ImageDataset("E:\\Datasets\\%s" % dataset_name, lr_transforms=lr_transforms, hr_transforms=hr_transforms),
-    batch_size=batch_size, shuffle=True)
+if single_decode or hr_cache is not None:
+    dataset = HRImageDataset("E:\\Datasets\\%s" % dataset_name, (hr_height, hr_width), cache=hr_cache)
+else:
+    dataset = ImageDataset("E:\\Datasets\\%s" % dataset_name, lr_transforms=lr_transforms, hr_transforms=hr_transforms)
+
+dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
 
 # ----------
 #  Training
@@ -185,5 +198,6 @@ for epoch in range(epoch, n_epochs):
 
     if checkpoint_interval != -1 and epoch % checkpoint_interval == 0:
         # Save model checkpoints
-        torch.save(generator.state_dict(), 'saved_models/generator_%d.pth' % epoch)
-        torch.save(discriminator.state_dict(), 'saved_models/discriminator_%d.pth' % epoch)
+        checkpoints.save(epoch, **state)
+
+checkpoints.close()
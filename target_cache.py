@@ -0,0 +1,43 @@
+import torch
+
+
+class TargetCache(object):
+    """Hands out constant adversarial targets (valid/fake labels) that live on the device
+
+    A target is a zero-stride view of a single device-resident scalar expanded to the
+    requested shape, so nothing the size of the discriminator output is ever allocated
+    or copied from the host. Targets are keyed by (shape, value, device, dtype) and
+    reused across iterations; MSELoss/BCELoss broadcast over them like regular tensors.
+    Treat them as read-only.
+    """
+
+    def __init__(self, device=None, dtype=torch.float32):
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.dtype = dtype
+        self.scalars = {}
+        self.targets = {}
+
+    def full(self, shape, value, device=None, dtype=None):
+        device = torch.device(device) if device is not None else self.device
+        dtype = dtype if dtype is not None else self.dtype
+        shape = tuple(shape)
+        key = (shape, float(value), device, dtype)
+
+        target = self.targets.get(key)
+        if target is None:
+            scalar_key = key[1:]
+            if scalar_key not in self.scalars:
+                self.scalars[scalar_key] = torch.full((1,), value, device=device, dtype=dtype)
+            target = self.scalars[scalar_key].expand(shape)
+            self.targets[key] = target
+        return target
+
+    def ones(self, shape, device=None, dtype=None):
+        return self.full(shape, 1.0, device, dtype)
+
+    def zeros(self, shape, device=None, dtype=None):
+        return self.full(shape, 0.0, device, dtype)
+
+    def like(self, tensor, value):
+        """Target with the shape, device and dtype of a discriminator output"""
+        return self.full(tensor.shape, value, tensor.device, tensor.dtype)
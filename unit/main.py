@@ -24,6 +24,10 @@ from datasets import *
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
+from target_cache import TargetCache
+from weighted_losses import WeightedLosses
+from checkpoint_manager import CheckpointManager
+from metrics import Metrics
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -42,12 +46,18 @@ if __name__ == '__main__':
     parser.add_argument('--sample_interval', type=int, default=100,
                         help='interval between sampling images from generators')
     parser.add_argument('--checkpoint_interval', type=int, default=-1, help='interval between saving model checkpoints')
+    parser.add_argument('--log_interval', type=int, default=20, help='interval between printing the running mean losses (each print waits for the device)')
+    parser.add_argument('--metrics_csv', type=str, default=None, help='also append the logged losses to this CSV file')
+    parser.add_argument('--tensorboard_dir', type=str, default=None, help='also write the logged losses as TensorBoard scalars (needs tensorboardX)')
+    parser.add_argument('--keep_checkpoints', type=int, default=0, help='number of most recent checkpoints to keep, 0 keeps all')
     parser.add_argument('--n_downsample', type=int, default=2, help='number downsampling layers in encoder')
     parser.add_argument('--dim', type=int, default=64, help='number of filters in first encoder layer')
+    parser.add_argument('--packed_root', type=str, default=None, help='directory of arrays written by datasets.py (skips JPEG decoding)')
     opt = parser.parse_args()
     print(opt)
 
     cuda = True if torch.cuda.is_available() else False
+    targets = TargetCache(device='cuda' if cuda else 'cpu')
 
     # Create sample and checkpoint directories
     os.makedirs('images/%s' % opt.dataset_name, exist_ok=True)
@@ -83,15 +93,7 @@ if __name__ == '__main__':
         criterion_GAN.cuda()
         criterion_pixel.cuda()
 
-    if opt.epoch != 0:
-        # Load pretrained models
-        E1.load_state_dict(torch.load('saved_models/%s/E1_%d.pth' % (opt.dataset_name, opt.epoch)))
-        E2.load_state_dict(torch.load('saved_models/%s/E2_%d.pth' % (opt.dataset_name, opt.epoch)))
-        G1.load_state_dict(torch.load('saved_models/%s/G1_%d.pth' % (opt.dataset_name, opt.epoch)))
-        G2.load_state_dict(torch.load('saved_models/%s/G2_%d.pth' % (opt.dataset_name, opt.epoch)))
-        D1.load_state_dict(torch.load('saved_models/%s/D1_%d.pth' % (opt.dataset_name, opt.epoch)))
-        D2.load_state_dict(torch.load('saved_models/%s/D2_%d.pth' % (opt.dataset_name, opt.epoch)))
-    else:
+    if opt.epoch == 0:
         # Initialize weights
         E1.apply(weights_init_normal)
         E2.apply(weights_init_normal)
@@ -107,6 +109,15 @@ if __name__ == '__main__':
     lambda_3 = 0.1  # KL (encoded translated images)
     lambda_4 = 100  # Cycle pixel-wise
 
+    # Generator loss terms; terms with zero weight are not computed at all
+    g_losses = WeightedLosses()
+    g_losses.add('GAN', lambda_0)
+    g_losses.add('KL', lambda_1)
+    g_losses.add('ID', lambda_2, passes='G1(Z1), G2(Z2)')
+    g_losses.add('KL_cycle', lambda_3, passes='E1(fake_X1), E2(fake_X2) unless cycle is on')
+    g_losses.add('cycle', lambda_4, passes='G1(Z2_), G2(Z1_) and E1/E2 unless KL_cycle is on')
+    print(g_losses.summary(opt.epoch))
+
     # Optimizers
     optimizer_G = torch.optim.Adam(itertools.chain(E1.parameters(), E2.parameters(), G1.parameters(), G2.parameters()),
                                    lr=opt.lr, betas=(opt.b1, opt.b2))
@@ -121,6 +132,17 @@ if __name__ == '__main__':
     lr_scheduler_D2 = torch.optim.lr_scheduler.LambdaLR(optimizer_D2, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch,
                                                                                          opt.decay_epoch).step)
 
+    # Everything a checkpoint holds. The LR schedulers are rebuilt from --epoch instead
+    # (LambdaLR offsets the decay by it)
+    state = dict(E1=E1, E2=E2, G1=G1, G2=G2, D1=D1, D2=D2, optimizer_G=optimizer_G,
+                 optimizer_D1=optimizer_D1, optimizer_D2=optimizer_D2)
+
+    checkpoints = CheckpointManager('saved_models/%s' % opt.dataset_name, keep=opt.keep_checkpoints,
+                                    legacy='{name}_{step}.pth')
+    if opt.epoch != 0:
+        # Load pretrained models
+        checkpoints.restore(opt.epoch, **state)
+
     Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
 
     # Image transformations
@@ -129,14 +151,17 @@ if __name__ == '__main__':
                    transforms.ToTensor(),
                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
 
+    if opt.packed_root is not None:
+        train_dataset = PackedImageDataset(opt.packed_root, (opt.img_height, opt.img_width), unaligned=True)
+        val_dataset = PackedImageDataset(opt.packed_root, (opt.img_height, opt.img_width), unaligned=True, mode='test')
+    else:
+        train_dataset = ImageDatasetSeperate("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, unaligned=True)
+        val_dataset = ImageDatasetSeperate("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, unaligned=True, mode='test')
+
     # Training data loader
-    dataloader = DataLoader(
-        ImageDatasetSeperate("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, unaligned=True),
-        batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu)
+    dataloader = DataLoader(train_dataset, batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu)
     # Test data loader
-    val_dataloader = DataLoader(
-        ImageDatasetSeperate("E:/Datasets/%s" % opt.dataset_name, transforms_=transforms_, unaligned=True, mode='test'),
-        batch_size=5, shuffle=True, num_workers=1)
+    val_dataloader = DataLoader(val_dataset, batch_size=5, shuffle=True, num_workers=1)
 
 
     def sample_images(batches_done):
@@ -159,11 +184,13 @@ if __name__ == '__main__':
         return loss
 
 
+    metrics = Metrics("\r[Epoch {epoch}/{n_epochs}] [Batch {batch}/{n_batches}] [D loss: {D:f}] [G loss: {G:f}] ETA: {eta}\n",
+                      csv_path=opt.metrics_csv, log_dir=opt.tensorboard_dir)
+
     # ----------
     #  Training
     # ----------
 
-    prev_time = time.time()
     for epoch in range(opt.epoch, opt.n_epochs):
         for i, batch in enumerate(dataloader):
 
@@ -172,8 +199,8 @@ if __name__ == '__main__':
             X2 = Variable(batch['B'].type(Tensor))
 
             # Adversarial ground truths
-            valid = Variable(Tensor(np.ones((X1.size(0), *patch))), requires_grad=False)
-            fake = Variable(Tensor(np.zeros((X1.size(0), *patch))), requires_grad=False)
+            valid = targets.ones((X1.size(0), *patch))
+            fake = targets.zeros((X1.size(0), *patch))
 
             # -------------------------------
             #  Train Encoders and Generators
@@ -185,43 +212,23 @@ if __name__ == '__main__':
             mu1, Z1 = E1(X1)
             mu2, Z2 = E2(X2)
 
-            # Reconstruct images
-            recon_X1 = G1(Z1)
-            recon_X2 = G2(Z2)
-
             # Translate images
             fake_X1 = G1(Z2)
             fake_X2 = G2(Z1)
 
-            # Cycle translation
-            mu1_, Z1_ = E1(fake_X1)
-            mu2_, Z2_ = E2(fake_X2)
-            cycle_X1 = G1(Z2_)
-            cycle_X2 = G2(Z1_)
+            # Cycle encoding, shared by the cycle KL and cycle pixel-wise terms
+            if g_losses.active('KL_cycle', epoch) or g_losses.active('cycle', epoch):
+                mu1_, Z1_ = E1(fake_X1)
+                mu2_, Z2_ = E2(fake_X2)
 
             # Losses
-            loss_GAN_1 = lambda_0 * criterion_GAN(D1(fake_X1), valid)
-            loss_GAN_2 = lambda_0 * criterion_GAN(D2(fake_X2), valid)
-            loss_KL_1 = lambda_1 * compute_kl(mu1)
-            loss_KL_2 = lambda_1 * compute_kl(mu2)
-            loss_ID_1 = lambda_2 * criterion_pixel(recon_X1, X1)
-            loss_ID_2 = lambda_2 * criterion_pixel(recon_X2, X2)
-            loss_KL_1_ = lambda_3 * compute_kl(mu1_)
-            loss_KL_2_ = lambda_3 * compute_kl(mu2_)
-            loss_cyc_1 = lambda_4 * criterion_pixel(cycle_X1, X1)
-            loss_cyc_2 = lambda_4 * criterion_pixel(cycle_X2, X2)
-
-            # Total loss
-            loss_G = loss_KL_1 + \
-                     loss_KL_2 + \
-                     loss_ID_1 + \
-                     loss_ID_2 + \
-                     loss_GAN_1 + \
-                     loss_GAN_2 + \
-                     loss_KL_1_ + \
-                     loss_KL_2_ + \
-                     loss_cyc_1 + \
-                     loss_cyc_2
+            loss_G, terms = g_losses.compute({
+                'KL': lambda: compute_kl(mu1) + compute_kl(mu2),
+                'ID': lambda: criterion_pixel(G1(Z1), X1) + criterion_pixel(G2(Z2), X2),
+                'GAN': lambda: criterion_GAN(D1(fake_X1), valid) + criterion_GAN(D2(fake_X2), valid),
+                'KL_cycle': lambda: compute_kl(mu1_) + compute_kl(mu2_),
+                'cycle': lambda: criterion_pixel(G1(Z2_), X1) + criterion_pixel(G2(Z1_), X2),
+            }, step=epoch)
 
             loss_G.backward()
             optimizer_G.step()
@@ -254,24 +261,22 @@ if __name__ == '__main__':
             #  Log Progress
             # --------------
 
-            # Determine approximate time left
+            metrics.update(D=loss_D1 + loss_D2, G=loss_G)
+            metrics.tick()
+
+            # Print log, with the approximate time left
             batches_done = epoch * len(dataloader) + i
-            batches_left = opt.n_epochs * len(dataloader) - batches_done
-            time_left = datetime.timedelta(seconds=batches_left * (time.time() - prev_time))
-            prev_time = time.time()
-
-            # Print log
-            sys.stdout.write("\r[Epoch %d/%d] [Batch %d/%d] [D loss: %f] [G loss: %f] ETA: %s\n" %
-                             (epoch, opt.n_epochs,
-                              i, len(dataloader),
-                              (loss_D1 + loss_D2).item(),
-                              loss_G.item(),
-                              time_left))
+            if batches_done % opt.log_interval == 0:
+                metrics.log(batches_done, remaining=opt.n_epochs * len(dataloader) - batches_done,
+                            epoch=epoch, n_epochs=opt.n_epochs, batch=i, n_batches=len(dataloader))
 
             # If at sample interval save image
             if batches_done % opt.sample_interval == 0:
                 sample_images(batches_done)
 
+        if g_losses.elided:
+            print(g_losses.report())
+
         # Update learning rates
         lr_scheduler_G.step()
         lr_scheduler_D1.step()
@@ -279,9 +284,6 @@ if __name__ == '__main__':
 
         if opt.checkpoint_interval != -1 and epoch % opt.checkpoint_interval == 0:
             # Save model checkpoints
-            torch.save(E1.state_dict(), 'saved_models/%s/E1_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(E2.state_dict(), 'saved_models/%s/E2_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(G1.state_dict(), 'saved_models/%s/G1_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(G2.state_dict(), 'saved_models/%s/G2_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(D1.state_dict(), 'saved_models/%s/D1_%d.pth' % (opt.dataset_name, epoch))
-            torch.save(D2.state_dict(), 'saved_models/%s/D2_%d.pth' % (opt.dataset_name, epoch))
+            checkpoints.save(epoch, **state)
+
+    checkpoints.close()
@@ -72,8 +72,7 @@ class Encoder(nn.Module):
         self.shared_block = shared_block
 
     def reparameterization(self, mu):
-        Tensor = torch.cuda.FloatTensor if mu.is_cuda else torch.FloatTensor
-        z = Variable(Tensor(np.random.normal(0, 1, mu.shape)))
+        z = torch.randn_like(mu)
         return z + mu
 
     def forward(self, x):
@@ -42,50 +42,57 @@ def UTKFace_data():
         return X, y
 
 
-def load_mnist(dataset):
+def read_idx(filename):
+    """Reads a gzipped IDX file (the MNIST distribution format) into a uint8 array"""
+    with gzip.open(filename) as bytestream:
+        magic = bytestream.read(4)
+        ndim = magic[3]
+        shape = tuple(np.frombuffer(bytestream.read(4 * ndim), dtype='>i4'))
+        data = np.frombuffer(bytestream.read(), dtype=np.uint8)
+    return data.reshape(shape)
+
+
+def load_mnist(dataset, seed=547):
+    """Loads train+test MNIST as uint8 images (N, 1, 28, 28) and float32 one-hot labels (N, 10)
+
+    The IDX files are parsed and shuffled once, then cached next to them as .npy files
+    that later calls memory-map (if the directory is not writable the parsed arrays
+    are used directly). Images stay uint8; use mnist_to_float on each batch to
+    normalize it to [0, 1] on the target device.
+    """
     data_dir = os.path.join("./data", dataset)
+    images_cache = os.path.join(data_dir, 'mnist_images_%d.npy' % seed)
+    labels_cache = os.path.join(data_dir, 'mnist_labels_%d.npy' % seed)
 
-    def extract_data(filename, num_data, head_size, data_size):
-        with gzip.open(filename) as bytestream:
-            bytestream.read(head_size)
-            buf = bytestream.read(data_size * num_data)
-            data = np.frombuffer(buf, dtype=np.uint8).astype(np.float)
-        return data
-
-    data = extract_data(data_dir + '/train-images-idx3-ubyte.gz', 60000, 16, 28 * 28)
-    trX = data.reshape((60000, 28, 28, 1))
-
-    data = extract_data(data_dir + '/train-labels-idx1-ubyte.gz', 60000, 8, 1)
-    trY = data.reshape((60000))
-
-    data = extract_data(data_dir + '/t10k-images-idx3-ubyte.gz', 10000, 16, 28 * 28)
-    teX = data.reshape((10000, 28, 28, 1))
-
-    data = extract_data(data_dir + '/t10k-labels-idx1-ubyte.gz', 10000, 8, 1)
-    teY = data.reshape((10000))
-
-    trY = np.asarray(trY).astype(np.int)
-    teY = np.asarray(teY)
-
-    X = np.concatenate((trX, teX), axis=0)
-    y = np.concatenate((trY, teY), axis=0).astype(np.int)
-
-    seed = 547
-    np.random.seed(seed)
-    np.random.shuffle(X)
-    np.random.seed(seed)
-    np.random.shuffle(y)
-
-    y_vec = np.zeros((len(y), 10), dtype=np.float)
-    for i, label in enumerate(y):
-        y_vec[i, y[i]] = 1
+    if os.path.exists(images_cache) and os.path.exists(labels_cache):
+        # Copy-on-write maps give writable arrays torch can wrap without reading the whole file
+        X = torch.from_numpy(np.load(images_cache, mmap_mode='c'))
+        y = torch.from_numpy(np.load(labels_cache)).long()
+    else:
+        X = np.concatenate((read_idx(data_dir + '/train-images-idx3-ubyte.gz'),
+                            read_idx(data_dir + '/t10k-images-idx3-ubyte.gz')), axis=0)
+        y = np.concatenate((read_idx(data_dir + '/train-labels-idx1-ubyte.gz'),
+                            read_idx(data_dir + '/t10k-labels-idx1-ubyte.gz')), axis=0)
+
+        perm = np.random.RandomState(seed).permutation(len(y))
+        X, y = X[perm][:, np.newaxis], y[perm]
+        try:
+            # Written under a temporary name so an interrupted run leaves no truncated cache
+            for path, array in ((images_cache, X), (labels_cache, y)):
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, array)
+                os.replace(path + '.tmp', path)
+        except OSError as e:
+            print("Could not cache MNIST in %s (%s)" % (data_dir, e))
+        X, y = torch.from_numpy(X), torch.from_numpy(y).long()
+
+    y_vec = torch.zeros(len(y), 10).scatter_(1, y.unsqueeze(1), 1)
+    return X, y_vec
 
-    X = X.transpose(0, 3, 1, 2) / 255.
-    # y_vec = y_vec.transpose(0, 3, 1, 2)
 
-    X = torch.from_numpy(X).type(torch.FloatTensor)
-    y_vec = torch.from_numpy(y_vec).type(torch.FloatTensor)
-    return X, y_vec
+def mnist_to_float(x, device=None):
+    """Moves a uint8 image batch to device and scales it to float32 in [0, 1]"""
+    return x.to(device, non_blocking=True).float().div_(255)
 
 
 def load_celebA(dir, transform, batch_size, shuffle):
@@ -1,18 +1,172 @@
-import numpy as np
-import cv2 as cv
+"""
+Generates inverted Canny edge maps for a folder of images (e.g. the edges2shoes A domain)
+
+    python edge_detector.py --src E:/Datasets/edge2shoes/A --dst E:/Datasets/edge2shoes/B
+
+Files are split across a process pool and outputs newer than their source are skipped,
+as long as the thresholds (and --base_size) match the ones recorded with the outputs.
+With --packed the edges are written straight into the uint8 memmap format read by
+PackedImageDataset in packed_images.py instead of one JPEG per image.
+Files OpenCV cannot read are skipped and listed at the end.
+"""
+import argparse
 import glob
-from matplotlib import pyplot as plt
+import json
 import os
+from multiprocessing import Pool
+
+import numpy as np
+import cv2 as cv
 from tqdm import tqdm
 
-files = sorted(glob.glob(os.path.join('E:\\Datasets\\edge2shoes\\A') + '/*.*'))
-print("Total files to process: "+str(len(files)))
 
-for i in tqdm(range(len(files))):
-    image = files[i]
-    img = cv.imread(image,0)
-    edges = cv.Canny(img,128,128)
-    edges = cv.bitwise_not(edges)
+def edge_map(path, low, high):
+    img = cv.imread(path, 0)
+    if img is None:
+        # Not an image, or one OpenCV cannot decode
+        return None
+    edges = cv.Canny(img, low, high)
+    return cv.bitwise_not(edges)
+
+
+def output_path(path, dst):
+    return os.path.join(dst, '%s.jpg' % os.path.basename(path))
+
+
+def is_up_to_date(src, out):
+    return os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(src)
+
+
+def load_manifest(path):
+    """The parameters and source files recorded with earlier outputs, or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, params, files):
+    with open(path, 'w') as f:
+        json.dump(dict(params, files=files), f)
+
+
+def report_skipped(skipped):
+    if skipped:
+        print("Skipped %d files that could not be read as images:" % len(skipped))
+        for path in skipped:
+            print("    %s" % path)
+
+
+def write_edges(args):
+    """Writes the edge map of one file, returns the path if it could not be read"""
+    path, dst, low, high = args
+    edges = edge_map(path, low, high)
+    if edges is None:
+        return path
+    cv.imwrite(output_path(path, dst), edges)
+    return None
+
+
+def packed_edges(args):
+    path, low, high, base_size = args
+    edges = edge_map(path, low, high)
+    if edges is None:
+        return None
+    edges = cv.resize(edges, (base_size, base_size))
+    return np.repeat(edges[:, :, np.newaxis], 3, axis=2)
+
+
+def run_files(files, opt):
+    os.makedirs(opt.dst, exist_ok=True)
+    params = dict(low=opt.low, high=opt.high)
+    names = [os.path.basename(path) for path in files]
+
+    # Dot file, so the image globs of the datasets do not pick it up
+    manifest_path = os.path.join(opt.dst, '.edge_detector.json')
+    manifest = load_manifest(manifest_path)
+    if manifest is not None:
+        # Outputs of sources removed since the last run
+        current = set(names)
+        for name in manifest['files']:
+            if name not in current and os.path.exists(output_path(name, opt.dst)):
+                os.remove(output_path(name, opt.dst))
+
+    # Outputs made with other thresholds, or by a run that recorded none, are all stale
+    stale = opt.force or manifest is None or any(manifest.get(k) != v for k, v in params.items())
+    todo = [path for path in files if stale or not is_up_to_date(path, output_path(path, opt.dst))]
+    print("Skipping %d up to date files, processing %d" % (len(files) - len(todo), len(todo)))
+
+    with Pool(opt.workers) as pool:
+        jobs = [(path, opt.dst, opt.low, opt.high) for path in todo]
+        skipped = [path for path in tqdm(pool.imap_unordered(write_edges, jobs, chunksize=opt.chunksize),
+                                         total=len(jobs)) if path is not None]
+    report_skipped(sorted(skipped))
+
+    save_manifest(manifest_path, params, names)
+
+
+def run_packed(files, opt):
+    out = opt.packed + '.npy'
+    params = dict(low=opt.low, high=opt.high, base_size=opt.base_size)
+    manifest_path = opt.packed + '_params.json'
+    if (not opt.force and os.path.exists(out) and load_manifest(manifest_path) == dict(params, files=files)
+            and os.path.getmtime(out) >= max(map(os.path.getmtime, files), default=0)):
+        print("%s is up to date" % out)
+        return
+
+    data = np.lib.format.open_memmap(out + '.tmp', mode='w+', dtype=np.uint8,
+                                     shape=(len(files), opt.base_size, opt.base_size, 3))
+    packed, skipped = [], []
+    with Pool(opt.workers) as pool:
+        jobs = [(path, opt.low, opt.high, opt.base_size) for path in files]
+        for path, edges in zip(files, tqdm(pool.imap(packed_edges, jobs, chunksize=opt.chunksize), total=len(jobs))):
+            if edges is None:
+                skipped.append(path)
+            else:
+                data[len(packed)] = edges
+                packed.append(path)
+    data.flush()
+
+    if skipped:
+        # Copy the filled rows into an array without the ones reserved for skipped files
+        trimmed = np.lib.format.open_memmap(out + '.trim', mode='w+', dtype=np.uint8,
+                                            shape=(len(packed),) + data.shape[1:])
+        for start in range(0, len(packed), 1024):
+            trimmed[start:start + 1024] = data[start:start + 1024]
+        trimmed.flush()
+        del trimmed, data
+        os.remove(out + '.tmp')
+        os.replace(out + '.trim', out)
+    else:
+        del data
+        os.replace(out + '.tmp', out)
+    report_skipped(skipped)
+
+    with open(opt.packed + '_index.txt', 'w') as f:
+        f.write('\n'.join(packed))
+    save_manifest(manifest_path, params, files)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate inverted Canny edge maps in parallel')
+    parser.add_argument('--src', type=str, required=True, help='folder of source images')
+    parser.add_argument('--dst', type=str, default=None, help='folder to write <name>.jpg edge maps to')
+    parser.add_argument('--packed', type=str, default=None, help='write a packed <prefix>.npy/<prefix>_index.txt instead')
+    parser.add_argument('--base_size', type=int, default=256, help='resolution of packed edge maps')
+    parser.add_argument('--low', type=int, default=128, help='lower Canny hysteresis threshold')
+    parser.add_argument('--high', type=int, default=128, help='upper Canny hysteresis threshold')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--chunksize', type=int, default=64, help='files handed to a worker at a time')
+    parser.add_argument('--force', action='store_true', help='regenerate outputs even if they are up to date')
+    opt = parser.parse_args()
+
+    if (opt.dst is None) == (opt.packed is None):
+        parser.error('exactly one of --dst and --packed is required')
+
+    files = sorted(glob.glob(os.path.join(opt.src, '*.*')))
+    print("Total files to process: " + str(len(files)))
 
-    name = image.split("\\")[-1]
-    cv.imwrite('E:\\Datasets\\edge2shoes\\B\\'+'%s.jpg'%name, edges)
+    if opt.packed is not None:
+        run_packed(files, opt)
+    else:
+        run_files(files, opt)
@@ -0,0 +1,55 @@
+from collections import OrderedDict, Counter
+
+
+class WeightedLosses(object):
+    """A named set of weighted loss terms where terms that are switched off are never computed
+
+    Each term has a weight, either a number or a function of the training step (e.g. the
+    epoch) so it can be scheduled on and off, and an optional description of the forward
+    passes that only it needs. compute() takes zero-argument callables producing the
+    unweighted losses and only calls those whose weight is non-zero, so the skipped
+    forward passes never run and autograd never keeps their activations.
+    """
+
+    def __init__(self):
+        self.terms = OrderedDict()
+        self.elided = Counter()
+
+    def add(self, name, weight, passes=''):
+        self.terms[name] = (weight, passes)
+        return self
+
+    def weight(self, name, step=None):
+        weight = self.terms[name][0]
+        return weight(step) if callable(weight) else weight
+
+    def active(self, name, step=None):
+        return self.weight(name, step) != 0
+
+    def compute(self, losses, step=None):
+        """Returns the weighted total and a dict of unweighted term values (0. when skipped)"""
+        total = 0
+        values = OrderedDict()
+        for name, loss in losses.items():
+            weight = self.weight(name, step)
+            if weight == 0:
+                self.elided[name] += 1
+                values[name] = 0.
+                continue
+            values[name] = loss()
+            total = total + weight * values[name]
+        return total, values
+
+    def summary(self, step=None):
+        lines = []
+        for name, (_, passes) in self.terms.items():
+            if not self.active(name, step):
+                lines.append("%s loss is off, skipping %s" % (name, passes or 'its computation'))
+        return '\n'.join(lines)
+
+    def report(self):
+        """Describes which terms (and forward passes) were skipped since the last report"""
+        lines = ["Skipped %s loss %d times (%s)" % (name, count, self.terms[name][1] or 'no extra passes')
+                 for name, count in self.elided.items()]
+        self.elided.clear()
+        return '\n'.join(lines)
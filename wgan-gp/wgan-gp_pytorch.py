@@ -15,6 +15,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.autograd as autograd
 import torch
+from latent_sampler import LatentSampler
+from precision import Precision
+from lazy_regularizer import LazyRegularizer
 
 os.makedirs('images', exist_ok=True)
 
@@ -30,6 +33,8 @@ parser.add_argument('--img_size', type=int, default=28, help='size of each image
 parser.add_argument('--channels', type=int, default=1, help='number of image channels')
 parser.add_argument('--n_critic', type=int, default=5, help='number of training steps for discriminator per iter')
 parser.add_argument('--clip_value', type=float, default=0.01, help='lower and upper clip value for disc. weights')
+parser.add_argument('--gp_interval', type=int, default=1, help='compute the gradient penalty every n discriminator steps, with its weight scaled by n')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='precision of the forward passes (bf16/fp16 run under autocast)')
 parser.add_argument('--sample_interval', type=int, default=400, help='interval betwen image samples')
 opt = parser.parse_args()
 print(opt)
@@ -37,6 +42,8 @@ print(opt)
 img_shape = (opt.channels, opt.img_size, opt.img_size)
 
 cuda = True if torch.cuda.is_available() else False
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
+amp = Precision(opt.precision, device='cuda' if cuda else 'cpu')
 
 
 class Generator(nn.Module):
@@ -85,6 +92,8 @@ class Discriminator(nn.Module):
 
 # Loss weight for gradient penalty
 lambda_gp = 10
+# Gradient penalty applied every opt.gp_interval discriminator steps
+gp = LazyRegularizer(lambda_gp, opt.gp_interval, device='cuda' if cuda else 'cpu')
 
 # Initialize generator and discriminator
 generator = Generator()
@@ -113,18 +122,21 @@ Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 
 def compute_gradient_penalty(D, real_samples, fake_samples):
     """Calculates the gradient penalty loss for WGAN GP"""
-    # Random weight term for interpolation between real and fake samples
-    alpha = Tensor(np.random.random((real_samples.size(0), 1, 1, 1)))
-    # Get random interpolation between real and fake samples
-    interpolates = (alpha * real_samples + ((1 - alpha) * fake_samples)).requires_grad_(True)
-    d_interpolates = D(interpolates)
-    fake = Variable(Tensor(real_samples.shape[0], 1).fill_(1.0), requires_grad=False)
-    # Get gradient w.r.t. interpolates
-    gradients = autograd.grad(outputs=d_interpolates, inputs=interpolates,
-                              grad_outputs=fake, create_graph=True, retain_graph=True,
-                              only_inputs=True)[0]
-    gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
-    return gradient_penalty
+    # Interpolation, D and the gradient norm run in float32 whatever --precision is
+    with amp.fp32():
+        real_samples, fake_samples = real_samples.float(), fake_samples.float()
+        # Random weight term for interpolation between real and fake samples
+        alpha = Tensor(np.random.random((real_samples.size(0), 1, 1, 1)))
+        # Get random interpolation between real and fake samples
+        interpolates = (alpha * real_samples + ((1 - alpha) * fake_samples)).requires_grad_(True)
+        d_interpolates = D(interpolates)
+        fake = Variable(Tensor(real_samples.shape[0], 1).fill_(1.0), requires_grad=False)
+        # Get gradient w.r.t. interpolates
+        gradients = autograd.grad(outputs=d_interpolates, inputs=interpolates,
+                                  grad_outputs=fake, create_graph=True, retain_graph=True,
+                                  only_inputs=True)[0]
+        gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
+        return gradient_penalty
 
 
 # ----------
@@ -145,22 +157,22 @@ for epoch in range(opt.n_epochs):
         optimizer_D.zero_grad()
 
         # Sample noise as generator input
-        z = Variable(Tensor(np.random.normal(0, 1, (imgs.shape[0], opt.latent_dim))))
+        z = sampler.normal((imgs.shape[0], opt.latent_dim), key='z')
 
-        # Generate a batch of images
-        fake_imgs = generator(z)
+        with amp.autocast():
+            # Generate a batch of images
+            fake_imgs = generator(z)
 
-        # Real images
-        real_validity = discriminator(real_imgs)
-        # Fake images
-        fake_validity = discriminator(fake_imgs)
-        # Gradient penalty
-        gradient_penalty = compute_gradient_penalty(discriminator, real_imgs.data, fake_imgs.data)
-        # Adversarial loss
-        d_loss = -torch.mean(real_validity) + torch.mean(fake_validity) + lambda_gp * gradient_penalty
+            # Real images
+            real_validity = discriminator(real_imgs)
+            # Fake images
+            fake_validity = discriminator(fake_imgs)
+            # Adversarial loss with the (lazily applied) gradient penalty
+            d_loss = -torch.mean(real_validity) + torch.mean(fake_validity) + \
+                     gp(lambda: compute_gradient_penalty(discriminator, real_imgs.data, fake_imgs.data))
 
-        d_loss.backward()
-        optimizer_D.step()
+        amp.backward(d_loss)
+        amp.step(optimizer_D)
 
         optimizer_G.zero_grad()
 
@@ -171,15 +183,16 @@ for epoch in range(opt.n_epochs):
             #  Train Generator
             # -----------------
 
-            # Generate a batch of images
-            fake_imgs = generator(z)
-            # Loss measures generator's ability to fool the discriminator
-            # Train on fake images
-            fake_validity = discriminator(fake_imgs)
-            g_loss = -torch.mean(fake_validity)
+            with amp.autocast():
+                # Generate a batch of images
+                fake_imgs = generator(z)
+                # Loss measures generator's ability to fool the discriminator
+                # Train on fake images
+                fake_validity = discriminator(fake_imgs)
+                g_loss = -torch.mean(fake_validity)
 
-            g_loss.backward()
-            optimizer_G.step()
+            amp.backward(g_loss)
+            amp.step(optimizer_G)
 
             print("[Epoch %d/%d] [Batch %d/%d] [D loss: %f] [G loss: %f]" % (epoch, opt.n_epochs,
                                                                              i, len(dataloader),
@@ -189,3 +202,8 @@ for epoch in range(opt.n_epochs):
                 save_image(fake_imgs.data[:25], 'images/%d.png' % batches_done, nrow=5, normalize=True)
 
             batches_done += opt.n_critic
+
+        amp.update()
+
+    if opt.gp_interval > 1:
+        print(gp.report())
@@ -15,6 +15,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch
 from tensorboardX import SummaryWriter
+from latent_sampler import LatentSampler
 
 os.makedirs('images', exist_ok=True)
 
@@ -35,6 +36,7 @@ print(opt)
 img_shape = (opt.channels, opt.img_size, opt.img_size)
 
 cuda = True if torch.cuda.is_available() else False
+sampler = LatentSampler(device='cuda' if cuda else 'cpu')
 
 
 class Generator(nn.Module):
@@ -126,7 +128,7 @@ for epoch in range(opt.n_epochs):
         optimizer_D.zero_grad()
 
         # Sample noise as generator input
-        z = Variable(Tensor(np.random.normal(0, 1, (imgs.shape[0], opt.latent_dim))))
+        z = sampler.normal((imgs.shape[0], opt.latent_dim), key='z')
 
         # Generate a batch of images
         fake_imgs = generator(z).detach()